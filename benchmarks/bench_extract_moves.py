@@ -0,0 +1,80 @@
+import csv
+import io
+import sqlite3
+
+import pytest
+
+import synthetic
+from conftest import load_module
+
+N_ITEMS = 20000
+
+
+@pytest.fixture(scope='module')
+def logging_xml():
+    return synthetic.logging_xml(N_ITEMS, seed=1).encode('utf-8')
+
+
+def bench_iter_elems(benchmark, logging_xml):
+    extract_moves = load_module('extract_moves')
+    tag = extract_moves.MEDIAWIKI_NS + 'logitem'
+
+    def run():
+        return sum(1 for _ in extract_moves.iter_elems(
+            io.BytesIO(logging_xml), tag))
+
+    assert benchmark(run) == N_ITEMS
+    benchmark.extra_info['items'] = N_ITEMS
+
+
+def bench_iter_moves(benchmark, logging_xml):
+    extract_moves = load_module('extract_moves')
+
+    def run():
+        return sum(1 for _ in extract_moves.iter_moves(io.BytesIO(logging_xml)))
+
+    moves = benchmark(run)
+    assert 0 < moves < N_ITEMS
+    benchmark.extra_info['items'] = N_ITEMS
+
+
+def bench_moves_two_step(benchmark, logging_xml):
+    # extract-moves to CSV, then load-moves from that CSV
+    extract_moves = load_module('extract_moves')
+    moves_csv_to_sqlite = load_module('moves_csv_to_sqlite')
+
+    def setup():
+        connection = sqlite3.connect(':memory:')
+        moves_csv_to_sqlite.create_tables(connection)
+        return (connection,), {}
+
+    def run(connection):
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(('timestamp', 'from', 'to'))
+        for move in extract_moves.iter_moves(io.BytesIO(logging_xml)):
+            writer.writerow(move)
+        output.seek(0)
+        with connection:
+            moves_csv_to_sqlite.insert_moves(connection, 'en', output)
+
+    benchmark.pedantic(run, setup=setup, rounds=5)
+    benchmark.extra_info['items'] = N_ITEMS
+
+
+def bench_moves_pipeline(benchmark, logging_xml):
+    moves_csv_to_sqlite = load_module('moves_csv_to_sqlite')
+    moves_pipeline = load_module('moves_pipeline')
+
+    def setup():
+        connection = sqlite3.connect(':memory:')
+        moves_csv_to_sqlite.create_tables(connection)
+        return (connection,), {}
+
+    def run(connection):
+        with connection:
+            moves_pipeline.load_moves(
+                connection, 'en', io.BytesIO(logging_xml))
+
+    benchmark.pedantic(run, setup=setup, rounds=5)
+    benchmark.extra_info['items'] = N_ITEMS
@@ -0,0 +1,54 @@
+import csv
+import io
+import tracemalloc
+
+import pytest
+
+import synthetic
+from conftest import load_module
+
+N_ROWS = 100000
+
+
+@pytest.fixture(scope='module')
+def identifier_history():
+    return synthetic.identifier_history_csv(N_ROWS, seed=8)
+
+
+def retained_memory(build):
+    tracemalloc.start()
+    try:
+        result = build()
+        current, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return current
+
+
+def bench_parse_records(benchmark, identifier_history):
+    utils = load_module('utils')
+
+    def run():
+        return [
+            utils.parse_identifier_history_record(r)
+            for r in csv.reader(io.StringIO(identifier_history))
+        ]
+
+    assert len(benchmark(run)) == N_ROWS
+    benchmark.extra_info['bytes_per_million_rows'] = (
+        retained_memory(run) * 10**6 // N_ROWS)
+
+
+def bench_parse_batches(benchmark, identifier_history):
+    pytest.importorskip('numpy')
+    utils = load_module('utils')
+
+    def run():
+        return list(utils.iter_identifier_history_batches(
+            io.StringIO(identifier_history)))
+
+    batches = benchmark(run)
+    assert sum(len(b.page_id) for b in batches) == N_ROWS
+    benchmark.extra_info['bytes_per_million_rows'] = (
+        retained_memory(run) * 10**6 // N_ROWS)
@@ -0,0 +1,135 @@
+import io
+import sqlite3
+
+import pytest
+
+import synthetic
+from conftest import load_module
+
+N_ROWS = 50000
+ROUNDS = 5
+
+
+def sqlite_round(create_tables, text):
+    def setup():
+        connection = sqlite3.connect(':memory:')
+        create_tables(connection)
+        return (connection, io.StringIO(text)), {}
+    return setup
+
+
+def mysql_round(connection, create_tables, table, text):
+    def setup():
+        create_tables(connection.cursor())
+        with connection.cursor() as cursor:
+            cursor.execute('TRUNCATE TABLE `{}`'.format(table))
+        connection.commit()
+        return (connection.cursor(), io.StringIO(text)), {}
+    return setup
+
+
+def bench_moves_csv_to_sqlite(benchmark):
+    moves_csv_to_sqlite = load_module('moves_csv_to_sqlite')
+    text = synthetic.moves_csv(N_ROWS, seed=3)
+
+    def run(connection, input_file):
+        with connection:
+            moves_csv_to_sqlite.insert_moves(connection, 'en', input_file)
+
+    benchmark.pedantic(
+        run,
+        setup=sqlite_round(moves_csv_to_sqlite.create_tables, text),
+        rounds=ROUNDS,
+    )
+    benchmark.extra_info['rows'] = N_ROWS
+
+
+def bench_pageids_to_sqlite(benchmark):
+    pageids_to_db = load_module('pageids_to_db')
+    text = synthetic.pageids_csv(N_ROWS, seed=4)
+
+    def run(connection, input_file):
+        with connection:
+            pageids_to_db.insert_pages(connection, input_file)
+
+    benchmark.pedantic(
+        run,
+        setup=sqlite_round(pageids_to_db.create_tables_and_indexes, text),
+        rounds=ROUNDS,
+    )
+    benchmark.extra_info['rows'] = N_ROWS
+
+
+@pytest.mark.parametrize('sorted_input', [False, True],
+                         ids=['staged', 'sorted'])
+def bench_pageids_refresh(benchmark, sorted_input):
+    # Refresh of a loaded Page table from a dump where 1% of the pages
+    # changed title, against bench_pageids_to_sqlite's full load
+    pageids_to_db = load_module('pageids_to_db')
+    old_text = synthetic.pageids_csv(N_ROWS, seed=4)
+    lines = sorted(
+        old_text.splitlines(),
+        key=lambda line: (line.split(',')[0], int(line.split(',')[1])),
+    )
+    new_text = ''.join(
+        line + ('_moved' if i % 100 == 0 else '') + '\n'
+        for i, line in enumerate(lines)
+    )
+
+    def setup():
+        connection = sqlite3.connect(':memory:')
+        pageids_to_db.create_tables_and_indexes(connection)
+        with connection:
+            pageids_to_db.insert_pages(connection, io.StringIO(old_text))
+        return (connection, io.StringIO(new_text)), {}
+
+    def run(connection, input_file):
+        return pageids_to_db.refresh_pages(
+            connection, [input_file], sorted_input=sorted_input)
+
+    benchmark.pedantic(run, setup=setup, rounds=ROUNDS)
+    benchmark.extra_info['rows'] = N_ROWS
+
+
+def bench_identifiershistory_to_mysql(benchmark, mysql_connection):
+    identifiershistory_to_db = load_module('identifiershistory_to_db')
+    text = synthetic.identifier_history_csv(N_ROWS, seed=5)
+
+    def run(cursor, input_file):
+        with cursor:
+            identifiershistory_to_db.insert_records(cursor, input_file)
+        mysql_connection.commit()
+
+    benchmark.pedantic(
+        run,
+        setup=mysql_round(
+            mysql_connection,
+            identifiershistory_to_db.create_tables_and_indexes,
+            'identifiershistory',
+            text,
+        ),
+        rounds=ROUNDS,
+    )
+    benchmark.extra_info['rows'] = N_ROWS
+
+
+def bench_mag_papers_to_mysql(benchmark, mysql_connection):
+    mag_papers_to_db = load_module('mag_papers_to_db')
+    text = synthetic.mag_papers_tsv(N_ROWS, seed=6)
+
+    def run(cursor, input_file):
+        with cursor:
+            mag_papers_to_db.insert_papers(cursor, input_file)
+        mysql_connection.commit()
+
+    benchmark.pedantic(
+        run,
+        setup=mysql_round(
+            mysql_connection,
+            mag_papers_to_db.create_tables_and_indexes,
+            'mag_papers',
+            text,
+        ),
+        rounds=ROUNDS,
+    )
+    benchmark.extra_info['rows'] = N_ROWS
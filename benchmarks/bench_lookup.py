@@ -0,0 +1,150 @@
+import csv
+import http.client
+import io
+import json
+import random
+import sqlite3
+import threading
+
+import pytest
+
+import synthetic
+from conftest import load_module
+
+N_PAGES = 100000
+N_MOVES = 50000
+ROUNDS = 2000
+
+
+@pytest.fixture(scope='module')
+def databases(tmp_path_factory):
+    pageids_to_db = load_module('pageids_to_db')
+    moves_csv_to_sqlite = load_module('moves_csv_to_sqlite')
+    tmp_path = tmp_path_factory.mktemp('lookup')
+
+    pages_db = tmp_path / 'pages.sqlite'
+    pages_text = synthetic.pageids_csv(N_PAGES, seed=11)
+    connection = sqlite3.connect(str(pages_db))
+    pageids_to_db.create_tables_and_indexes(connection)
+    with connection:
+        pageids_to_db.insert_pages(connection, io.StringIO(pages_text))
+    connection.close()
+
+    moves_db = tmp_path / 'moves.sqlite'
+    moves_text = synthetic.moves_csv(N_MOVES, seed=12)
+    connection = sqlite3.connect(str(moves_db))
+    moves_csv_to_sqlite.create_tables(connection)
+    with connection:
+        moves_csv_to_sqlite.insert_moves(
+            connection, 'en', io.StringIO(moves_text))
+    moves_csv_to_sqlite.create_indexes(connection)
+    connection.close()
+
+    pages = [tuple(r) for r in csv.reader(io.StringIO(pages_text))]
+    move_titles = [r[2] for r in csv.reader(io.StringIO(moves_text))][1:]
+    return pages_db, moves_db, pages, move_titles
+
+
+@pytest.fixture(scope='module')
+def server(databases):
+    lookup = load_module('lookup')
+    pages_db, moves_db, _, _ = databases
+    server = lookup.make_server(
+        lookup.Lookup(pages_db, moves_db), port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server.server_address
+    server.shutdown()
+    server.server_close()
+
+
+def record_percentiles(benchmark):
+    # No timings with --benchmark-disable
+    stats = getattr(benchmark, 'stats', None)
+    if benchmark.disabled or stats is None or not stats.stats.data:
+        return
+    data = sorted(stats.stats.data)
+    benchmark.extra_info['p50_us'] = 1e6 * data[len(data) // 2]
+    benchmark.extra_info['p99_us'] = 1e6 * data[int(len(data) * 0.99)]
+
+
+def keys(databases, seed=0):
+    # Mostly repeated hot titles, as in identifier histories
+    _, _, pages, _ = databases
+    rng = random.Random(seed)
+    hot = rng.sample(pages, 1000)
+    while True:
+        yield rng.choice(hot) if rng.random() < 0.8 else rng.choice(pages)
+
+
+def bench_library_page_id(benchmark, databases):
+    lookup = load_module('lookup')
+    pages_db, moves_db, _, _ = databases
+    instance = lookup.Lookup(pages_db, moves_db)
+    pages = keys(databases)
+
+    def run():
+        project, _, title = next(pages)
+        return instance.page_id(project, title)
+
+    benchmark.pedantic(run, rounds=ROUNDS, warmup_rounds=100)
+    record_percentiles(benchmark)
+    benchmark.extra_info.update(instance.page_id_cache.info())
+
+
+def bench_http_page_id(benchmark, databases, server):
+    host, port = server
+    connection = http.client.HTTPConnection(host, port)
+    pages = keys(databases)
+
+    def run():
+        project, _, title = next(pages)
+        connection.request('GET', '/page_id?' + '&'.join((
+            'project=' + project,
+            'title=' + title,
+        )))
+        response = connection.getresponse()
+        assert response.status == 200
+        return json.loads(response.read())
+
+    benchmark.pedantic(run, rounds=ROUNDS, warmup_rounds=100)
+    record_percentiles(benchmark)
+    connection.close()
+
+
+@pytest.mark.parametrize('batch_size', [100, 1000, 5000])
+def bench_http_page_ids_batch(benchmark, databases, server, batch_size):
+    host, port = server
+    connection = http.client.HTTPConnection(host, port)
+    pages = keys(databases, seed=batch_size)
+
+    def run():
+        titles = [next(pages)[2] for _ in range(batch_size)]
+        body = json.dumps(dict(project='en', titles=titles))
+        connection.request('POST', '/page_ids', body=body)
+        response = connection.getresponse()
+        assert response.status == 200
+        return json.loads(response.read())
+
+    benchmark.pedantic(run, rounds=50, warmup_rounds=5)
+    record_percentiles(benchmark)
+    benchmark.extra_info['keys_per_call'] = batch_size
+    connection.close()
+
+
+def bench_http_moves(benchmark, databases, server):
+    host, port = server
+    _, _, _, move_titles = databases
+    connection = http.client.HTTPConnection(host, port)
+    rng = random.Random(3)
+
+    def run():
+        body = json.dumps(dict(project='en', titles=[rng.choice(move_titles)]))
+        connection.request('POST', '/moves', body=body)
+        response = connection.getresponse()
+        assert response.status == 200
+        return json.loads(response.read())
+
+    benchmark.pedantic(run, rounds=ROUNDS, warmup_rounds=100)
+    record_percentiles(benchmark)
+    connection.close()
@@ -0,0 +1,64 @@
+import shutil
+import subprocess
+
+import pytest
+
+import synthetic
+from conftest import load_module
+
+N_ROWS = 50000
+
+
+@pytest.fixture(scope='module')
+def identifier_history():
+    return synthetic.identifier_history_csv(N_ROWS, seed=2)
+
+
+@pytest.mark.parametrize('suffix', ['.csv', '.gz', '.7z'])
+def bench_open_compressed_file(benchmark, write_input, identifier_history,
+                               suffix):
+    utils = load_module('utils')
+
+    if suffix == '.7z':
+        if shutil.which('7z') is None:
+            pytest.skip('7z is not installed')
+        plain = write_input('input.csv', identifier_history)
+        path = plain.with_suffix('.7z')
+        subprocess.check_call(
+            ['7z', 'a', '-bd', str(path), str(plain)],
+            stdout=subprocess.DEVNULL,
+        )
+    else:
+        path = write_input('input' + suffix, identifier_history)
+
+    def run():
+        with utils.open_compressed_file(path) as f:
+            return sum(1 for _ in f)
+
+    assert benchmark(run) == N_ROWS
+    benchmark.extra_info['bytes'] = len(identifier_history)
+
+
+@pytest.mark.parametrize('suffix', ['.csv', '.gz', '.bz2', '.zst'])
+@pytest.mark.parametrize('external', [False, True])
+def bench_open_output_file(benchmark, tmp_path, identifier_history,
+                           suffix, external):
+    utils = load_module('utils')
+    if suffix == '.zst' and shutil.which('zstd') is None:
+        pytest.skip('zstd is not installed')
+    commands = utils.EXTERNAL_COMPRESSORS.get(suffix, [])
+    if external and not any(shutil.which(c[0]) for c in commands):
+        pytest.skip('no external compressor for ' + suffix)
+    if suffix == '.zst' and not external:
+        pytest.skip('zstd is always external')
+
+    lines = identifier_history.splitlines(keepends=True)
+    path = tmp_path / ('output' + suffix)
+
+    def run():
+        with utils.open_output_file(path, external=external) as f:
+            for line in lines:
+                f.write(line)
+
+    benchmark(run)
+    benchmark.extra_info['bytes'] = len(identifier_history)
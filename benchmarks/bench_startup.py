@@ -0,0 +1,33 @@
+import subprocess
+import sys
+
+import pytest
+
+from conftest import ROOT
+from wikidump import cli
+
+
+def run_help(argv):
+    return subprocess.run(
+        [sys.executable, '-m', 'wikidump'] + argv + ['--help'],
+        cwd=str(ROOT),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+
+
+def bench_startup_bare(benchmark):
+    # Interpreter start plus the subcommand dispatcher alone
+    benchmark.pedantic(run_help, args=([],), rounds=10)
+
+
+@pytest.mark.parametrize('command', sorted(cli.COMMANDS))
+def bench_startup(benchmark, command):
+    # `--help` imports the subcommand's module and builds its parser,
+    # without doing any work.
+    result = run_help([command])
+    if result.returncode != 0:
+        pytest.skip(result.stderr.decode('utf-8', 'replace').strip()
+                    .splitlines()[-1])
+
+    benchmark.pedantic(run_help, args=([command],), rounds=10)
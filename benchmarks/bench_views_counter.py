@@ -0,0 +1,203 @@
+import csv
+import datetime
+import io
+
+import pytest
+
+import synthetic
+from conftest import load_module
+
+N_PAGES = 200
+N_RECORDS = 2000
+
+
+@pytest.fixture(scope='module')
+def add_counts_to_csv():
+    return load_module('add_counts_to_csv')
+
+
+@pytest.fixture(scope='module')
+def records(add_counts_to_csv):
+    text = synthetic.identifier_history_csv(N_RECORDS, seed=7, n_pages=N_PAGES)
+    return [
+        add_counts_to_csv.parse_record(r)
+        for r in csv.reader(io.StringIO(text))
+    ]
+
+
+def make_views_counter(add_counts_to_csv):
+    return add_counts_to_csv.ViewsCounter(
+        synthetic.FakeFinder(),
+        start_period=synthetic.EPOCH,
+        end_period=synthetic.EPOCH + datetime.timedelta(days=4 * 365),
+    )
+
+
+def bench_interp_fn(benchmark, add_counts_to_csv, records):
+    pages = sorted({(r.project, r.page_title) for r in records})
+
+    def setup():
+        add_counts_to_csv.ViewsCounter.interp_fn.cache_clear()
+        return (make_views_counter(add_counts_to_csv),), {}
+
+    def run(views_counter):
+        for project, page in pages:
+            views_counter.interp_fn(project, page)
+
+    benchmark.pedantic(run, setup=setup, rounds=3)
+    benchmark.extra_info['pages'] = len(pages)
+
+
+def bench_interp_fn_shared(benchmark, add_counts_to_csv, records, tmp_path):
+    # interp_fn mapping the series another process already published to a
+    # shared series cache, instead of searching and building them
+    shared_series = load_module('shared_series')
+    pages = sorted({(r.project, r.page_title) for r in records})
+
+    cache = shared_series.SharedSeriesCache(tmp_path / 'series', 'bench')
+    add_counts_to_csv.ViewsCounter.interp_fn.cache_clear()
+    publisher = make_views_counter(add_counts_to_csv)
+    publisher.shared_series = cache
+    for project, page in pages:
+        publisher.interp_fn(project, page)
+
+    def setup():
+        add_counts_to_csv.ViewsCounter.interp_fn.cache_clear()
+        views_counter = make_views_counter(add_counts_to_csv)
+        views_counter.shared_series = cache
+        return (views_counter,), {}
+
+    def run(views_counter):
+        for project, page in pages:
+            views_counter.interp_fn(project, page)
+
+    benchmark.pedantic(run, setup=setup, rounds=3)
+    benchmark.extra_info['pages'] = len(pages)
+
+
+def bench_series_memory(benchmark, add_counts_to_csv, records):
+    # Builds the series interp_fn keeps per page and records their size,
+    # against the 16 bytes per sample (timestamp and cumulative views) of
+    # the legacy engine's dense interp1d grid
+    cumulative_views = load_module('cumulative_views')
+    finder = synthetic.FakeFinder()
+    granularity = datetime.timedelta(hours=1)
+    arrays = [
+        cumulative_views.search_result_arrays(finder.search(project, page))
+        for project, page in sorted({(r.project, r.page_title)
+                                     for r in records})
+    ]
+    arrays = [(ts, views) for ts, views in arrays if len(ts)]
+
+    def run():
+        return [
+            cumulative_views.from_arrays(ts, views, granularity)
+            for ts, views in arrays
+        ]
+
+    series = benchmark.pedantic(run, rounds=3)
+    samples = sum((s.last - s.base) // s.step + 1 for s in series)
+    nbytes = sum(s.nbytes() for s in series)
+    benchmark.extra_info['pages'] = len(series)
+    benchmark.extra_info['rollup_pages'] = sum(
+        isinstance(s, cumulative_views.RollupSeries) for s in series)
+    benchmark.extra_info['bytes_per_page'] = nbytes / len(series)
+    benchmark.extra_info['bytes_per_sample'] = nbytes / samples
+    benchmark.extra_info['legacy_bytes_per_sample'] = 16
+
+
+def bench_count_multiple_pages(benchmark, add_counts_to_csv, records):
+    # Group records by page, as get_redirects_for would return the same
+    # redirects for consecutive rows of the same page.
+    records = sorted(records, key=lambda r: (r.project, r.page_title))
+
+    def setup():
+        add_counts_to_csv.ViewsCounter.interp_fn.cache_clear()
+        add_counts_to_csv.ViewsCounter.interps_for_pages.cache_clear()
+        return (make_views_counter(add_counts_to_csv),), {}
+
+    def run(views_counter):
+        for r in records:
+            pages = [r.page_title, r.page_title + ' (redirect)']
+            views_counter.count_multiple_pages(
+                r.project, pages, r.start_date, r.end_date)
+
+    benchmark.pedantic(run, setup=setup, rounds=3)
+    benchmark.extra_info['records'] = len(records)
+
+
+def bench_count_batch(benchmark, add_counts_to_csv, records):
+    # The queries of bench_count_multiple_pages as one sort-merge join
+    queries = [
+        (r.project, [r.page_title, r.page_title + ' (redirect)'],
+         r.start_date, r.end_date)
+        for r in records
+    ]
+
+    def setup():
+        add_counts_to_csv.ViewsCounter.interp_fn.cache_clear()
+        return (make_views_counter(add_counts_to_csv),), {}
+
+    def run(views_counter):
+        views_counter.count_batch(queries)
+
+    benchmark.pedantic(run, setup=setup, rounds=3)
+    benchmark.extra_info['records'] = len(records)
+
+
+def bench_count_multiple_pages_cached(benchmark, add_counts_to_csv, records,
+                                      tmp_path):
+    # Same queries with a warm counts cache, as on a rerun over the same
+    # input
+    counts_cache = load_module('counts_cache')
+
+    cache = counts_cache.CountsCache(tmp_path / 'counts-cache.sqlite')
+    views_counter = make_views_counter(add_counts_to_csv)
+    views_counter.cache = cache
+    queries = [
+        (r.project, [r.page_title, r.page_title + ' (redirect)'],
+         r.start_date, r.end_date)
+        for r in records
+    ]
+    for query in queries:
+        views_counter.count_multiple_pages(*query)
+
+    def run():
+        for query in queries:
+            views_counter.count_multiple_pages(*query)
+
+    benchmark(run)
+    benchmark.extra_info.update(cache.summary())
+    cache.close()
+
+
+@pytest.mark.parametrize('engine', ['current', 'rollup', 'sparse'])
+def bench_engine_against_legacy(benchmark, add_counts_to_csv, engine):
+    # Candidate engines must give the legacy scipy engine's counts,
+    # including on the edge-case queries, see compare_engines.py.
+    pytest.importorskip('scipy')
+    import compare_engines
+
+    queries = list(compare_engines.synthetic_queries(200, seed=7))
+    pages = sorted({(q.project, add_counts_to_csv.wikify_title(q.page_title))
+                    for q in queries})
+    finder = compare_engines.RecordedFinder.record(
+        synthetic.FakeFinder(), pages)
+    queries += compare_engines.edge_queries(finder, pages, None, None)
+    engines = {
+        'legacy': compare_engines.LegacyViewsCounter,
+        engine: compare_engines.ENGINES[engine],
+    }
+
+    results = compare_engines.compare(engines, finder, queries,
+                                      trace_memory=False)
+    _, mismatches = results[engine]
+    assert mismatches == []
+
+    benchmark.pedantic(
+        compare_engines.run_engine,
+        args=(compare_engines.ENGINES[engine], finder, queries, None, None),
+        rounds=3,
+    )
+    benchmark.extra_info['queries'] = len(queries)
+    benchmark.extra_info['legacy_seconds'] = results['legacy'][0].seconds
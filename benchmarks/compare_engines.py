@@ -0,0 +1,630 @@
+# Differential harness for ViewsCounter engines: counts every record of
+# identifier-history samples with the legacy scipy interp1d engine and with
+# candidate engines, and reports the records whose counts differ, along
+# with each engine's throughput and peak memory.
+#
+#     python benchmarks/compare_engines.py --synthetic 2000
+#     python benchmarks/compare_engines.py history.csv.gz \
+#         --pagecounts DATASET --record searches.jsonl.gz
+#     python benchmarks/compare_engines.py history.csv.gz \
+#         --recorded searches.jsonl.gz --candidate mymodule:MyCounter
+#
+# Every engine answers from the same searches, loaded in memory before
+# the timed runs, so that throughput measures the engine rather than the
+# counts dataset. A candidate is a built-in name or a `module:attribute`
+# factory called like ViewsCounter(finder, start_period, end_period).
+import argparse
+import collections
+import contextlib
+import csv
+import datetime
+import functools
+import gzip
+import importlib
+import io
+import json
+import pathlib
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / 'benchmarks'))
+
+from wikidump import add_counts_to_csv  # noqa: E402
+from wikidump import cumulative_views  # noqa: E402
+from wikidump import pagecounts_store  # noqa: E402
+from wikidump import shared_series  # noqa: E402
+from wikidump import utils  # noqa: E402
+
+Query = collections.namedtuple(
+    'Query',
+    'project page_title start_date end_date origin',
+)
+
+Mismatch = collections.namedtuple(
+    'Mismatch',
+    'index query expected actual',
+)
+
+EngineRun = collections.namedtuple(
+    'EngineRun',
+    'counts seconds peak_bytes',
+)
+
+# Added to the edge-case dates so that they fall between hourly samples
+OFF_SAMPLE = datetime.timedelta(minutes=17, seconds=23)
+
+
+class LegacyViewsCounter:
+    # ViewsCounter as it was before cumulative_views: a dense hourly grid
+    # of cumulative views interpolated with scipy's interp1d. It is the
+    # reference the other engines are checked against.
+    def __init__(
+            self,
+            finder,
+            start_period=None,
+            end_period=None,
+            granularity=datetime.timedelta(hours=1)):
+        import scipy.interpolate
+        self.interp1d = scipy.interpolate.interp1d
+        self.finder = finder
+        self.granularity = granularity
+        self.period = add_counts_to_csv.TimeSpan(start_period, end_period)
+
+    @functools.lru_cache(50)
+    def interp_fn(self, project, page):
+        granularity = self.granularity
+        page = add_counts_to_csv.wikify_title(page)
+
+        result = self.finder.search(project, page)
+
+        if len(result) == 0:
+            return (lambda val: 0), 0, 0
+
+        views_list = [(ts, views) for ts, views, _ in result]
+
+        timestamps = [t for t, _ in views_list]
+
+        first, last = timestamps[0], timestamps[-1]
+        start = first - granularity
+        end = last + granularity
+
+        start_unix = int(start.timestamp())
+        end_unix = int(end.timestamp())
+        granularity_unix = int(granularity.total_seconds())
+
+        xs = list(range(start_unix, end_unix, granularity_unix))
+        ys = list(0 for _ in range(len(xs)))
+
+        for timestamp, views in views_list:
+            timestamp_unix = int(timestamp.timestamp())
+            index = xs.index(timestamp_unix)
+            ys[index] = views
+
+        ys_acc = numpy.cumsum(ys)
+
+        scipy_interp = self.interp1d(
+            xs,
+            ys_acc,
+            copy=False,
+            assume_sorted=True,
+        )
+
+        def interp(x):
+            if isinstance(x, datetime.datetime):
+                x = add_counts_to_csv.to_unix_timestamp(x)
+
+            if x < xs[0]:
+                return 0.0
+            if x > xs[-1]:
+                return ys_acc[-1]
+            else:
+                return scipy_interp(x)
+
+        return interp, ys_acc[0], ys_acc[-1]
+
+    @functools.lru_cache(1)
+    def interps_for_pages(self, project, pages):
+        sorted_pages = sorted(pages)
+        interps = {
+            page: self.interp_fn(project, page) for page in sorted_pages
+        }
+        return interps
+
+    def count_multiple_pages(self, project, pages, start_date, end_date):
+        if not add_counts_to_csv.timespan_intersects(
+                self.period,
+                add_counts_to_csv.TimeSpan(start_date, end_date),
+                ):
+            return 0
+
+        pages = frozenset(add_counts_to_csv.wikify_title(p) for p in pages)
+
+        interps = self.interps_for_pages(project, pages)
+
+        sum_ = 0
+        for page, (interp, min_, max_) in interps.items():
+            if end_date is None:
+                upper = max_
+            else:
+                upper = interp(end_date)
+
+            if start_date is None:
+                lower = min_
+            else:
+                lower = interp(start_date)
+            sum_ += upper - lower
+
+        return sum_
+
+
+def current_engine(finder, start_period, end_period):
+    return add_counts_to_csv.ViewsCounter(
+        finder, start_period=start_period, end_period=end_period)
+
+
+def rollup_engine(finder, start_period, end_period):
+    # Every page as a RollupSeries
+    return add_counts_to_csv.ViewsCounter(
+        finder, start_period=start_period, end_period=end_period,
+        sparse_fill_ratio=0)
+
+
+def sparse_engine(finder, start_period, end_period):
+    # Every page as a SparseSeries
+    return add_counts_to_csv.ViewsCounter(
+        finder, start_period=start_period, end_period=end_period,
+        sparse_fill_ratio=float('inf'))
+
+
+def shared_engine(finder, start_period, end_period):
+    # Series published to, and mapped from, a shared series cache in a
+    # private directory
+    directory = tempfile.TemporaryDirectory(prefix='shared-series-')
+    views_counter = add_counts_to_csv.ViewsCounter(
+        finder, start_period=start_period, end_period=end_period,
+        shared_series=shared_series.SharedSeriesCache(
+            directory.name, 'compare_engines'))
+    # Removed along with the engine
+    views_counter.shared_series.directory = directory
+    return views_counter
+
+
+ENGINES = collections.OrderedDict([
+    ('legacy', LegacyViewsCounter),
+    ('current', current_engine),
+    ('rollup', rollup_engine),
+    ('sparse', sparse_engine),
+    ('shared', shared_engine),
+])
+
+
+def load_engine(spec):
+    if spec in ENGINES:
+        return ENGINES[spec]
+    module_name, sep, attribute = spec.partition(':')
+    if not sep:
+        raise argparse.ArgumentTypeError(
+            'expected one of {} or MODULE:ATTRIBUTE, got {!r}'.format(
+                ', '.join(ENGINES), spec))
+    return getattr(importlib.import_module(module_name), attribute)
+
+
+class RecordedFinder:
+    # In-memory Finder over searches recorded from another one. Pages that
+    # were never recorded have no counts.
+    def __init__(self, searches=None):
+        self.searches = {}
+        for (project, page), result in (searches or {}).items():
+            self.add(project, page, result)
+
+    def add(self, project, page, result):
+        result = [(ts, views, bytes_) for ts, views, bytes_ in result]
+        self.searches[project, page] = (
+            result,
+            cumulative_views.search_result_arrays(result),
+        )
+
+    def search(self, project, page):
+        result, _ = self.searches.get((project, page), ([], None))
+        return result
+
+    def search_arrays(self, project, page):
+        entry = self.searches.get((project, page))
+        if entry is None:
+            empty = numpy.empty(0, dtype=numpy.int64)
+            return empty, empty
+        return entry[1]
+
+    @classmethod
+    def record(cls, finder, pages):
+        recorded = cls()
+        for project, page in pages:
+            recorded.add(project, page, finder.search(project, page))
+        return recorded
+
+    @classmethod
+    def load(cls, path):
+        recorded = cls()
+        with _open_text(path, 'r') as f:
+            for line in f:
+                entry = json.loads(line)
+                recorded.add(entry['project'], entry['page'], [
+                    (
+                        datetime.datetime.fromtimestamp(
+                            ts, datetime.timezone.utc),
+                        views,
+                        bytes_,
+                    )
+                    for ts, views, bytes_ in entry['result']
+                ])
+        return recorded
+
+    def save(self, path):
+        # One JSON object per line, with unix timestamps
+        with _open_text(path, 'w') as f:
+            for (project, page), (result, _) in sorted(self.searches.items()):
+                json.dump(dict(
+                    project=project,
+                    page=page,
+                    result=[
+                        (int(ts.timestamp()), views, bytes_)
+                        for ts, views, bytes_ in result
+                    ],
+                ), f)
+                f.write('\n')
+
+
+def _open_text(path, mode):
+    if pathlib.Path(path).suffix == '.gz':
+        return gzip.open(str(path), mode + 't', encoding='utf-8')
+    return open(str(path), mode, encoding='utf-8')
+
+
+def read_queries(input_paths, limit=None):
+    for input_path in input_paths:
+        with utils.open_compressed_file(input_path) as input_file:
+            for raw_record in csv.reader(input_file):
+                r = add_counts_to_csv.parse_record(raw_record)
+                yield Query(r.project, r.page_title, r.start_date,
+                            r.end_date, 'record')
+                if limit is not None:
+                    limit -= 1
+                    if limit == 0:
+                        return
+
+
+def synthetic_queries(n_records, seed=0):
+    import synthetic
+    text = synthetic.identifier_history_csv(
+        n_records, seed=seed, n_pages=max(1, n_records // 10))
+    for raw_record in csv.reader(io.StringIO(text)):
+        r = add_counts_to_csv.parse_record(raw_record)
+        yield Query(r.project, r.page_title, r.start_date, r.end_date,
+                    'record')
+
+
+def edge_queries(finder, pages, start_period, end_period):
+    # Queries on the edges of each page's counts and of the counts period:
+    # open bounds, dates before the first and after the last sample, dates
+    # between samples, and intervals outside the counts period.
+    for project, page in pages:
+        timestamps, _ = finder.search_arrays(project, page)
+        dates = []
+        if len(timestamps):
+            first, last = (
+                datetime.datetime.fromtimestamp(int(ts), datetime.timezone.utc)
+                for ts in (timestamps[0], timestamps[-1])
+            )
+            middle = first + (last - first) / 2
+            dates = [
+                first - datetime.timedelta(days=30),
+                first - OFF_SAMPLE,
+                first,
+                first + OFF_SAMPLE,
+                middle.replace(minute=0, second=0, microsecond=0) + OFF_SAMPLE,
+                last - OFF_SAMPLE,
+                last,
+                last + OFF_SAMPLE,
+                last + datetime.timedelta(days=30),
+            ]
+
+        bounds = [None] + dates
+        for start in bounds:
+            for end in bounds:
+                if start is None or end is None or start <= end:
+                    yield Query(project, page, start, end, 'edge')
+
+        day = datetime.timedelta(days=1)
+        if start_period is not None:
+            yield Query(project, page, start_period - 2 * day,
+                        start_period - day, 'edge')
+        if end_period is not None:
+            yield Query(project, page, end_period + day,
+                        end_period + 2 * day, 'edge')
+
+
+def clear_caches(engine):
+    # The engines memoize searches in lru_caches on their class
+    for name in ('interp_fn', 'interps_for_pages'):
+        method = getattr(type(engine), name, None)
+        if hasattr(method, 'cache_clear'):
+            method.cache_clear()
+
+
+def run_engine(factory, finder, queries, start_period, end_period,
+               trace_memory=False):
+    engine = factory(finder, start_period, end_period)
+    if trace_memory:
+        tracemalloc.start()
+    counts = []
+    try:
+        # Engines may log every search and partial sum
+        with contextlib.redirect_stdout(io.StringIO()) as log:
+            tic = time.perf_counter()
+            for q in queries:
+                counts.append(float(engine.count_multiple_pages(
+                    q.project, [q.page_title], q.start_date, q.end_date)))
+                log.seek(0)
+                log.truncate()
+            seconds = time.perf_counter() - tic
+        peak_bytes = None
+        if trace_memory:
+            _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+        clear_caches(engine)
+    return EngineRun(counts, seconds, peak_bytes)
+
+
+def find_mismatches(queries, expected, actual, abs_tolerance, rel_tolerance):
+    for i, (q, e, a) in enumerate(zip(queries, expected, actual)):
+        if abs(e - a) > abs_tolerance + rel_tolerance * abs(e):
+            yield Mismatch(i, q, e, a)
+
+
+def compare(engines, finder, queries, start_period=None, end_period=None,
+            abs_tolerance=1e-6, rel_tolerance=1e-9, trace_memory=True):
+    # engines: {name: factory}, the first one being the reference.
+    # Returns {name: (EngineRun, [Mismatch, ...])}.
+    results = collections.OrderedDict()
+    reference = None
+    for name, factory in engines.items():
+        run = run_engine(factory, finder, queries, start_period, end_period)
+        if trace_memory:
+            # A separate pass, as tracing slows allocations down
+            memory_run = run_engine(factory, finder, queries, start_period,
+                                    end_period, trace_memory=True)
+            run = run._replace(peak_bytes=memory_run.peak_bytes)
+        if reference is None:
+            reference = run.counts
+        mismatches = list(find_mismatches(
+            queries, reference, run.counts, abs_tolerance, rel_tolerance))
+        results[name] = (run, mismatches)
+    return results
+
+
+def format_date(date):
+    return '-' if date is None else date.isoformat()
+
+
+def print_report(results, n_queries, max_mismatches=20, file=sys.stdout):
+    print('{:<12} {:>10} {:>14} {:>12} {:>10}'.format(
+        'engine', 'seconds', 'queries/s', 'peak MiB', 'mismatches'),
+        file=file)
+    for name, (run, mismatches) in results.items():
+        peak = '-'
+        if run.peak_bytes is not None:
+            peak = '{:.1f}'.format(run.peak_bytes / 2**20)
+        print('{:<12} {:>10.3f} {:>14.0f} {:>12} {:>10}'.format(
+            name,
+            run.seconds,
+            n_queries / run.seconds if run.seconds else float('inf'),
+            peak,
+            len(mismatches),
+        ), file=file)
+
+    for name, (run, mismatches) in results.items():
+        if not mismatches:
+            continue
+        print(file=file)
+        print('Mismatches of', name, file=file)
+        for m in mismatches[:max_mismatches]:
+            q = m.query
+            print('  #{} {} {} {} {} [{}]: expected {!r}, got {!r}'.format(
+                m.index, q.project, q.page_title, format_date(q.start_date),
+                format_date(q.end_date), q.origin, m.expected, m.actual,
+            ), file=file)
+        if len(mismatches) > max_mismatches:
+            print('  ... and', len(mismatches) - max_mismatches, 'more',
+                  file=file)
+
+
+def write_mismatches(path, results):
+    with _open_text(path, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(('engine', 'index', 'origin', 'project', 'page_title',
+                         'start_date', 'end_date', 'expected', 'actual'))
+        for name, (_, mismatches) in results.items():
+            for m in mismatches:
+                q = m.query
+                writer.writerow((
+                    name, m.index, q.origin, q.project, q.page_title,
+                    format_date(q.start_date), format_date(q.end_date),
+                    repr(m.expected), repr(m.actual),
+                ))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Check candidate ViewsCounter engines against the '
+                    'legacy scipy interp1d engine, record by record, and '
+                    'compare their throughput and peak memory.',
+    )
+    parser.add_argument(
+        'input_files',
+        nargs='*',
+        type=pathlib.Path,
+        help='Identifier-history CSV files; see --synthetic otherwise',
+    )
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument(
+        '--pagecounts',
+        type=pathlib.Path,
+        help='pagecountssearch dataset or page-major store to search',
+    )
+    source.add_argument(
+        '--recorded',
+        type=pathlib.Path,
+        help='Searches saved with --record',
+    )
+    parser.add_argument(
+        '--record',
+        type=pathlib.Path,
+        help='Save the searches of this run (JSON lines, .gz to compress) '
+             'to replay them with --recorded',
+    )
+    parser.add_argument(
+        '--synthetic',
+        type=int,
+        default=None,
+        metavar='N_RECORDS',
+        help='Use synthetic identifier-history records, and synthetic '
+             'counts unless --pagecounts or --recorded is given',
+    )
+    parser.add_argument(
+        '--limit',
+        type=int,
+        default=None,
+        help='Only read the first LIMIT records of the input files',
+    )
+    parser.add_argument(
+        '--reference',
+        default='legacy',
+        help='Engine the others are checked against (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--candidate',
+        action='append',
+        help='Engine to check: one of {} or a MODULE:ATTRIBUTE factory; '
+             'repeat for more (default: current)'.format(', '.join(ENGINES)),
+    )
+    parser.add_argument(
+        '--no-edge-cases',
+        dest='edge_cases',
+        action='store_false',
+        help='Only count the input records, without the edge-case queries '
+             'added for each of their pages',
+    )
+    parser.add_argument(
+        '--counts-period-start',
+        type=add_counts_to_csv.parse_cmdline_date,
+        default=None,
+    )
+    parser.add_argument(
+        '--counts-period-end',
+        type=add_counts_to_csv.parse_cmdline_date,
+        default=None,
+    )
+    parser.add_argument(
+        '--abs-tolerance',
+        type=float,
+        default=1e-6,
+    )
+    parser.add_argument(
+        '--rel-tolerance',
+        type=float,
+        default=1e-9,
+    )
+    parser.add_argument(
+        '--no-memory',
+        dest='trace_memory',
+        action='store_false',
+        help='Skip the tracemalloc pass measuring peak memory',
+    )
+    parser.add_argument(
+        '--max-mismatches',
+        type=int,
+        default=20,
+        help='Mismatches printed per engine (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--mismatches',
+        type=pathlib.Path,
+        default=None,
+        help='Write every mismatch to this CSV file',
+    )
+    args = parser.parse_args(argv)
+    if not args.input_files and args.synthetic is None:
+        parser.error('give identifier-history files or --synthetic')
+    return args
+
+
+def open_finder(args, pages):
+    if args.recorded is not None:
+        return RecordedFinder.load(args.recorded)
+    if args.pagecounts is not None:
+        if pagecounts_store.is_store(args.pagecounts):
+            finder = pagecounts_store.PageMajorStore(args.pagecounts)
+        else:
+            import pagecountssearch
+            finder = pagecountssearch.Finder(args.pagecounts)
+    else:
+        import synthetic
+        finder = synthetic.FakeFinder()
+    return RecordedFinder.record(finder, pages)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.input_files:
+        queries = list(read_queries(args.input_files, args.limit))
+    else:
+        queries = list(synthetic_queries(args.synthetic))
+    pages = sorted({
+        (q.project, add_counts_to_csv.wikify_title(q.page_title))
+        for q in queries
+    })
+
+    finder = open_finder(args, pages)
+    if args.record is not None:
+        finder.save(args.record)
+
+    if args.edge_cases:
+        queries += edge_queries(
+            finder, pages, args.counts_period_start, args.counts_period_end)
+
+    engines = collections.OrderedDict()
+    engines[args.reference] = load_engine(args.reference)
+    for spec in args.candidate or ['current']:
+        engines[spec] = load_engine(spec)
+
+    print('Comparing', len(engines), 'engines on', len(queries), 'queries',
+          'over', len(pages), 'pages', file=sys.stderr)
+    results = compare(
+        engines,
+        finder,
+        queries,
+        args.counts_period_start,
+        args.counts_period_end,
+        args.abs_tolerance,
+        args.rel_tolerance,
+        args.trace_memory,
+    )
+    print_report(results, len(queries), args.max_mismatches)
+    if args.mismatches is not None:
+        write_mismatches(args.mismatches, results)
+
+    if any(mismatches for _, mismatches in results.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
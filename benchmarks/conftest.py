@@ -0,0 +1,48 @@
+import gzip
+import importlib
+import os
+import pathlib
+import sys
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / 'benchmarks'))
+
+
+def load_module(name):
+    # Import a wikidump module, skipping the benchmark when one of its
+    # dependencies is missing.
+    try:
+        return importlib.import_module('wikidump.' + name)
+    except ImportError as e:
+        pytest.skip('cannot import wikidump.{}: {}'.format(name, e))
+
+
+@pytest.fixture
+def write_input(tmp_path):
+    def write(name, text):
+        path = tmp_path / name
+        if path.suffix == '.gz':
+            with gzip.open(str(path), 'wt', encoding='utf-8') as f:
+                f.write(text)
+        else:
+            path.write_text(text, encoding='utf-8')
+        return path
+    return write
+
+
+@pytest.fixture
+def mysql_connection():
+    url = os.environ.get('WIKIDUMP_BENCH_MYSQL_URL')
+    if not url:
+        pytest.skip('WIKIDUMP_BENCH_MYSQL_URL is not set')
+    pymysql = pytest.importorskip('pymysql')
+    utils = load_module('utils')
+
+    connection = pymysql.connect(**utils.parse_mysql_url(url))
+    yield connection
+    connection.close()
@@ -0,0 +1,179 @@
+import csv
+import datetime
+import io
+import random
+import zlib
+from xml.sax.saxutils import escape
+
+MEDIAWIKI_NS = 'http://www.mediawiki.org/xml/export-0.10/'
+
+EPOCH = datetime.datetime(2012, 1, 1, tzinfo=datetime.timezone.utc)
+
+PROJECTS = ('en', 'de', 'fr', 'it')
+
+IDENTIFIER_TYPES = ('doi', 'pmid', 'isbn', 'arxiv')
+
+
+def random_title(rng, words=3):
+    return ' '.join(
+        ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz')
+                for _ in range(rng.randint(3, 10))).capitalize()
+        for _ in range(rng.randint(1, words))
+    )
+
+
+def php_serialize_params(target):
+    def s(value):
+        return 's:{}:"{}";'.format(len(value.encode('utf-8')), value)
+
+    return 'a:2:{{{}{}{}{}}}'.format(
+        s('4::target'), s(target),
+        s('5::noredir'), s('0'),
+    )
+
+
+def logging_xml(n_items, seed=0, move_ratio=0.5):
+    rng = random.Random(seed)
+    out = io.StringIO()
+    out.write('<mediawiki xmlns="{}" version="0.10" xml:lang="en">\n'.format(
+        MEDIAWIKI_NS))
+    for i in range(n_items):
+        timestamp = EPOCH + datetime.timedelta(seconds=rng.randint(0, 10**8))
+        is_move = rng.random() < move_ratio
+        if is_move:
+            type_ = 'move'
+            action = rng.choice(('move', 'move_redir'))
+        else:
+            type_ = action = rng.choice(('delete', 'protect', 'block'))
+        logtitle = random_title(rng)
+        out.write('  <logitem>\n')
+        out.write('    <id>{}</id>\n'.format(i))
+        out.write('    <timestamp>{}</timestamp>\n'.format(
+            timestamp.strftime('%Y-%m-%dT%H:%M:%SZ')))
+        out.write('    <contributor><username>User{}</username>'
+                  '<id>{}</id></contributor>\n'.format(i % 97, i % 97))
+        out.write('    <type>{}</type>\n'.format(type_))
+        out.write('    <action>{}</action>\n'.format(action))
+        out.write('    <logtitle>{}</logtitle>\n'.format(escape(logtitle)))
+        if is_move:
+            out.write('    <params xml:space="preserve">{}</params>\n'.format(
+                escape(php_serialize_params(random_title(rng)))))
+        out.write('  </logitem>\n')
+    out.write('</mediawiki>\n')
+    return out.getvalue()
+
+
+def moves_csv(n_rows, seed=0):
+    rng = random.Random(seed)
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(('timestamp', 'from', 'to'))
+    for _ in range(n_rows):
+        timestamp = EPOCH + datetime.timedelta(seconds=rng.randint(0, 10**8))
+        writer.writerow((
+            timestamp.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            random_title(rng),
+            random_title(rng),
+        ))
+    return out.getvalue()
+
+
+def format_date(rng, empty_ratio=0.2):
+    if rng.random() < empty_ratio:
+        return ''
+    timestamp = EPOCH + datetime.timedelta(hours=rng.randint(0, 4 * 365 * 24))
+    return timestamp.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def identifier_history_csv(n_rows, seed=0, n_pages=None):
+    rng = random.Random(seed)
+    n_pages = n_pages or max(1, n_rows // 4)
+    pages = [(rng.choice(PROJECTS), page_id, random_title(rng))
+             for page_id in range(1, n_pages + 1)]
+    out = io.StringIO()
+    writer = csv.writer(out)
+    for _ in range(n_rows):
+        project, page_id, page_title = rng.choice(pages)
+        start_date = format_date(rng)
+        end_date = format_date(rng)
+        if start_date and end_date and start_date > end_date:
+            start_date, end_date = end_date, start_date
+        writer.writerow((
+            project,
+            page_id,
+            page_title,
+            rng.choice(IDENTIFIER_TYPES),
+            '10.{}/{}'.format(rng.randint(1000, 9999), rng.randint(0, 10**6)),
+            start_date,
+            end_date,
+        ))
+    return out.getvalue()
+
+
+def mag_papers_tsv(n_rows, seed=0):
+    rng = random.Random(seed)
+    lines = []
+    for i in range(n_rows):
+        year = rng.randint(1950, 2016)
+        title = random_title(rng, words=8)
+        venue = random_title(rng, words=4)
+        has_date = rng.random() < 0.8
+        lines.append('\t'.join((
+            '{:08X}'.format(i),
+            title,
+            title.lower(),
+            str(year),
+            '{}/{:02d}/{:02d}'.format(
+                year, rng.randint(1, 12), rng.randint(1, 28),
+            ) if has_date else '',
+            '10.{}/{}'.format(rng.randint(1000, 9999), i) if has_date else '',
+            venue,
+            venue.lower(),
+            '{:08X}'.format(rng.randint(0, 10**6)),
+            '',
+            str(rng.randint(1, 30000)),
+        )))
+    return '\n'.join(lines) + '\n'
+
+
+def pageids_csv(n_rows, seed=0, with_project=True):
+    rng = random.Random(seed)
+    out = io.StringIO()
+    writer = csv.writer(out)
+    for page_id in range(1, n_rows + 1):
+        title = random_title(rng).replace(' ', '_')
+        if with_project:
+            writer.writerow((rng.choice(PROJECTS), page_id, title))
+        else:
+            writer.writerow((page_id, title))
+    return out.getvalue()
+
+
+class FakeFinder:
+    # Mimics pagecountssearch.Finder: search() returns the hourly
+    # (timestamp, views, bytes) observations of a page, deterministically
+    # derived from (project, page). Pages with a title hash divisible by
+    # `missing_every` have no counts at all, like most redirects.
+    def __init__(self, hours=24 * 365, fill_ratio=0.3, missing_every=3,
+                 start=EPOCH):
+        self.hours = hours
+        self.fill_ratio = fill_ratio
+        self.missing_every = missing_every
+        self.start = start
+
+    def search(self, project, page):
+        seed = zlib.crc32('{} {}'.format(project, page).encode('utf-8'))
+        if self.missing_every and seed % self.missing_every == 0:
+            return []
+
+        rng = random.Random(seed)
+        offset = rng.randint(0, self.hours // 4)
+        length = rng.randint(1, self.hours - offset)
+        result = []
+        for hour in range(offset, offset + length):
+            if rng.random() >= self.fill_ratio:
+                continue
+            views = rng.randint(1, 500)
+            timestamp = self.start + datetime.timedelta(hours=hour)
+            result.append((timestamp, views, views * 1000))
+        return result
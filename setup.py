@@ -0,0 +1,25 @@
+from setuptools import setup
+
+setup(
+    name='wikidump',
+    version='0.1.0',
+    description='Tools to extract page moves, identifier histories and '
+                'pagecounts views from Wikipedia dumps',
+    packages=['wikidump'],
+    python_requires='>=3.7',
+    install_requires=[
+        'python-dateutil',
+        'PyMySQL',
+        'phpserialize',
+        'pagecounts-search',
+        'numpy',
+    ],
+    extras_require={
+        'models': ['peewee'],
+    },
+    entry_points={
+        'console_scripts': [
+            'wikidump = wikidump.cli:main',
+        ],
+    },
+)
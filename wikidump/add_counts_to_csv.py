@@ -0,0 +1,1493 @@
+import argparse
+import collections
+import csv
+import datetime
+import functools
+import json
+import os
+import pathlib
+import sqlite3
+import urllib.parse
+from pprint import pprint
+
+import dateutil.parser
+import pymysql
+
+from . import counts_cache
+from . import counts_sink
+from . import cumulative_views
+from . import intervals
+from . import mysql_pool
+from . import pagecounts_availability
+from . import pagecounts_store
+from . import profiling
+from . import progress
+from . import shared_series
+from . import utils
+
+now = datetime.datetime.now
+
+InputRecord = collections.namedtuple(
+    'InputRecord',
+    [
+        'project',
+        'page_id',
+        'page_title',
+        'identifier_type',
+        'identifier_id',
+        'start_date',
+        'end_date',
+    ],
+)
+
+OutputRecord = collections.namedtuple(
+    'OutputRecord',
+    [
+        'project',
+        'page_id',
+        'page_title',
+        'identifier_type',
+        'identifier_id',
+        'start_date',
+        'end_date',
+        'views',
+    ],
+)
+
+PageMove = collections.namedtuple(
+    'PageMove',
+    'timestamp from_ to',
+)
+
+PagePeriod = collections.namedtuple(
+    'PagePeriod',
+    'page start end',
+)
+
+TimeSpan = collections.namedtuple(
+    'TimeSpan',
+    'start end',
+)
+
+
+@functools.lru_cache(10000)
+def parse_timestamp(timestamp: str):
+    return dateutil.parser.parse(timestamp)
+
+
+def parse_record(raw_record):
+    project, page_id, page_title, identifier_type, identifier_id, start_date, end_date = raw_record
+
+    page_id = int(page_id)
+    if not end_date:
+        end_date = None
+    else:
+        end_date = parse_timestamp(end_date)
+
+    if not start_date:
+        start_date = None
+    else:
+        start_date = start_date = parse_timestamp(start_date)
+
+    return InputRecord(
+        project,
+        page_id,
+        page_title,
+        identifier_type,
+        identifier_id,
+        start_date,
+        end_date,
+    )
+
+# def parse_move_record(record):
+#     timestamp, from_, to = record
+#
+#     to = to.rstrip('\n')
+#     timestamp = dateutil.parser.parse(timestamp)
+#
+#     return MoveRecord(timestamp, from_, to)
+
+class ViewsCounter:
+    def __init__(
+            self,
+            finder,
+            start_period=None,
+            end_period=None,
+            granularity=datetime.timedelta(hours=1),
+            availability=None,
+            sparse_fill_ratio=cumulative_views.SPARSE_FILL_RATIO,
+            cache=None,
+            shared_series=None):
+        self.finder = finder
+        self.granularity = granularity
+        self.sparse_fill_ratio = sparse_fill_ratio
+        self.period = TimeSpan(start_period, end_period)
+        self.availability = availability
+        self.cache = cache
+        # Optional shared_series.SharedSeriesCache
+        self.shared_series = shared_series
+
+    def page_availability(self, project, page):
+        if self.availability is None:
+            return None
+        return self.availability.get(project, page)
+
+    # Adjust the lru_cache with respect to the average number of redirect.
+    # According to the 20150901 dump, there average number of in-redirect
+    # per page is 2,78 and standard deviation is is 8,31.
+    # You can check it with the following query:
+    # select avg(res.rd_sum), variance(res.rd_sum)
+    # from (
+    # 	select rd_title, count(rd_from) as rd_sum
+    #     from redirect
+    #     where rd_namespace = 0
+    #     group by rd_namespace, rd_title
+    # ) as res
+    def search_arrays(self, project, page):
+        # A page-major store returns arrays directly, a Finder a list of
+        # (timestamp, views, bytes) tuples.
+        if hasattr(self.finder, 'search_arrays'):
+            return self.finder.search_arrays(project, page)
+        return cumulative_views.search_result_arrays(
+            self.finder.search(project, page))
+
+    @functools.lru_cache(50)
+    def interp_fn(self, project, page):
+        page = wikify_title(page)
+
+        availability = self.page_availability(project, page)
+        if availability is not None and not availability.present:
+            return (lambda val: 0), 0, 0
+
+        if self.shared_series is None:
+            series = self.build_series(project, page, availability)
+        else:
+            series = self.shared_series.get_or_build(
+                project,
+                page,
+                lambda: self.build_series(project, page, availability),
+            )
+        if series is None:
+            return (lambda val: 0), 0, 0
+
+        def interp(x):
+            if isinstance(x, datetime.datetime):
+                x = to_unix_timestamp(x)
+            return series(x)
+
+        return interp, series.first_value, series.total
+
+    def build_series(self, project, page, availability=None):
+        # Cumulative views of the page, None if it has none
+        tic = now()
+        print('Searching for ', project, page)
+        timestamps, views = self.search_arrays(project, page)
+        toc = now()
+        print('Search took:', toc - tic)
+
+        if availability is None and self.availability is not None:
+            self.availability.record_observations(project, page, timestamps)
+
+        if len(timestamps) == 0:
+            print("Warning: stats not found")
+            return None
+
+        print('Computing interpolation function for ', project, page)
+        tic = now()
+        series = cumulative_views.from_arrays(
+            timestamps, views, self.granularity, self.sparse_fill_ratio)
+        toc = now()
+        print('Interp took:', toc - tic)
+        return series
+
+    def count(self, project, page, start_date, end_date):
+        # Avoid useless computation and I/O
+        page = wikify_title(page)
+        if not timespan_intersects(
+                self.period,
+                TimeSpan(start_date, end_date),
+                ):
+            return 0
+
+        if not pagecounts_availability.may_have_views(
+                self.page_availability(project, page),
+                start_date,
+                end_date,
+                self.granularity):
+            return 0
+
+        interp, min_, max_ = self.interp_fn(project, page)
+
+        if end_date is None:
+            upper = max_
+        else:
+            upper = interp(end_date)
+
+        if start_date is None:
+            lower = min_
+        else:
+            lower = interp(start_date)
+
+        return upper - lower
+
+    @functools.lru_cache(1)
+    def interps_for_pages(self, project, pages):
+        sorted_pages = sorted(pages)
+        interps = {
+            page: self.interp_fn(project, page) for page in sorted_pages
+        }
+        return interps
+
+    def count_multiple_pages(self, project, pages, start_date, end_date,
+                             memo=None):
+        # memo: optional dict of the cumulative views already computed for
+        # (page, date), shared by calls over intervals with common bounds.
+        # Avoid useless computation and I/O
+        if not timespan_intersects(
+                self.period,
+                TimeSpan(start_date, end_date),
+                ):
+            return 0
+
+        pages = frozenset(wikify_title(p) for p in pages)
+
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache.make_key(
+                project, pages, start_date, end_date, self.period)
+            sum_ = self.cache.get(cache_key)
+            if sum_ is not None:
+                return sum_
+
+        # Skip pages known to have no data within the interval
+        pages = frozenset(
+            p for p in pages
+            if pagecounts_availability.may_have_views(
+                self.page_availability(project, p),
+                start_date,
+                end_date,
+                self.granularity,
+            )
+        )
+
+        interps = self.interps_for_pages(project, pages)
+
+        if memo is None:
+            memo = {}
+
+        def cumulative(page, interp, date):
+            value = memo.get((page, date))
+            if value is None:
+                value = memo[page, date] = interp(date)
+            return value
+
+        sum_ = 0
+        for page, (interp, min_, max_) in interps.items():
+            if end_date is None:
+                upper = max_
+            else:
+                upper = cumulative(page, interp, end_date)
+
+            if start_date is None:
+                lower = min_
+            else:
+                lower = cumulative(page, interp, start_date)
+            this_sum = upper - lower
+
+            print('Partial sum for', project, page, start_date, end_date,
+                  'is', this_sum)
+            sum_ += this_sum
+
+        if cache_key is not None:
+            self.cache.put(cache_key, sum_)
+        return sum_
+
+    def dataset_end(self):
+        # Time of the last hour of the counts dataset, None if unknown
+        last_hour = getattr(self.finder, 'last_hour', None)
+        if last_hour is None:
+            return None
+        return datetime.datetime.fromtimestamp(
+            last_hour * pagecounts_store.SECONDS_PER_HOUR,
+            datetime.timezone.utc,
+        )
+
+    def search_order(self, project, page):
+        # Sort key of the pages in the order the counts dataset stores them
+        if hasattr(self.finder, 'key_order'):
+            return self.finder.key_order(project, page)
+        return project, page
+
+    def count_batch(self, queries):
+        # count_multiple_pages for a list of (project, pages, start_date,
+        # end_date) queries, as a sort-merge join: the (project, page) of
+        # every query are sorted in the counts dataset's order and each
+        # page is searched once, its cumulative views being applied to
+        # all of its intervals. Partial sums are added in the same order
+        # as count_multiple_pages, so the results are identical.
+        counts = [0] * len(queries)
+        cache_keys = {}
+        by_page = collections.defaultdict(list)
+        for i, (project, pages, start_date, end_date) in enumerate(queries):
+            if not timespan_intersects(
+                    self.period,
+                    TimeSpan(start_date, end_date),
+                    ):
+                continue
+
+            pages = frozenset(wikify_title(p) for p in pages)
+
+            if self.cache is not None:
+                cache_key = self.cache.make_key(
+                    project, pages, start_date, end_date, self.period)
+                sum_ = self.cache.get(cache_key)
+                if sum_ is not None:
+                    counts[i] = sum_
+                    continue
+                cache_keys[i] = cache_key
+
+            for page in pages:
+                if pagecounts_availability.may_have_views(
+                        self.page_availability(project, page),
+                        start_date,
+                        end_date,
+                        self.granularity):
+                    by_page[project, page].append(i)
+
+        partial_sums = collections.defaultdict(list)
+        for project, page in sorted(
+                by_page, key=lambda p: self.search_order(*p)):
+            interp, min_, max_ = self.interp_fn(project, page)
+            memo = {}
+            for i in by_page.pop((project, page)):
+                _, _, start_date, end_date = queries[i]
+                if end_date is None:
+                    upper = max_
+                else:
+                    upper = memo.get(end_date)
+                    if upper is None:
+                        upper = memo[end_date] = interp(end_date)
+
+                if start_date is None:
+                    lower = min_
+                else:
+                    lower = memo.get(start_date)
+                    if lower is None:
+                        lower = memo[start_date] = interp(start_date)
+                partial_sums[i].append((page, upper - lower))
+
+        for i, partials in partial_sums.items():
+            sum_ = 0
+            for _, this_sum in sorted(partials, key=lambda p: p[0]):
+                sum_ += this_sum
+            counts[i] = sum_
+
+        for i, cache_key in cache_keys.items():
+            self.cache.put(cache_key, counts[i])
+        return counts
+
+    def count_intervals(self, project, pages, intervals):
+        # count_multiple_pages over several (start, end) intervals of the
+        # same pages. The interval bounds split the timeline into
+        # elementary segments, and each page's cumulative views are
+        # computed once per segment boundary: an interval's count is the
+        # difference of the values at its bounds, which is exactly what
+        # count_multiple_pages would return for it alone.
+        memo = {}
+        return [
+            self.count_multiple_pages(project, pages, start, end, memo)
+            for start, end in intervals
+        ]
+
+
+def to_unix_timestamp(datetime):
+    return int(datetime.timestamp())
+
+
+def timespan_intersects(*timespans):
+    start, end = float('-infinity'), float('+infinity')
+    for timespan in timespans:
+        if timespan.start is not None:
+            start = max(
+                start,
+                to_unix_timestamp(timespan.start),
+            )
+        if timespan.end is not None:
+            end = min(
+                end,
+                to_unix_timestamp(timespan.end),
+            )
+
+        if start > end:
+            return False
+
+    return True
+
+
+def timestamp_max(*ts):
+    without_nones = filter(lambda x: x is not None, ts)
+    return max(without_nones, default=None)
+
+
+def timestamp_min(*ts):
+    without_nones = filter(lambda x: x is not None, ts)
+    return min(without_nones, default=None)
+
+
+def test_timespan_intersects():
+    forever = TimeSpan(None, None)
+    from_2011 = TimeSpan(
+        None,
+        parse_timestamp('20110101'),
+    )
+    from_2011_to_2012 = TimeSpan(
+        parse_timestamp('20110101'),
+        parse_timestamp('20120101'),
+    )
+    from_2013_to_2015 = TimeSpan(
+        parse_timestamp('20130101'),
+        parse_timestamp('20150101'),
+    )
+    from_2014_to_2016 = TimeSpan(
+        parse_timestamp('20140101'),
+        parse_timestamp('20160101'),
+    )
+    assert timespan_intersects(forever, from_2013_to_2015)
+    assert timespan_intersects(from_2013_to_2015, from_2014_to_2016)
+    assert not timespan_intersects(from_2011_to_2012, from_2014_to_2016)
+
+    assert timespan_intersects(from_2011, from_2011_to_2012)
+    assert timespan_intersects(forever, from_2011)
+
+    assert timespan_intersects(from_2013_to_2015, from_2013_to_2015)
+    assert timespan_intersects(from_2011, from_2011)
+    assert timespan_intersects(forever, forever)
+
+# def test_extract_views():
+#     utc = datetime.timezone.utc
+#     print(extract_views(
+#         [TimeSpan(
+#             start=datetime.datetime(2014, 1, 1, 0, tzinfo=utc),
+#             end=datetime.datetime(2014, 1, 1, 3, 30, tzinfo=utc),
+#         )],
+#         [
+#             (datetime.datetime(2014, 1, 1, 0, tzinfo=utc), 10),
+#             (datetime.datetime(2014, 1, 1, 1, tzinfo=utc), 20),
+#             (datetime.datetime(2014, 1, 1, 2, tzinfo=utc), 5),
+#             (datetime.datetime(2014, 1, 1, 4, tzinfo=utc), 15),
+#         ])
+#     )
+
+
+# def periods_from_moves(current_page_title, moves):
+#     descending_moves = sorted(moves, key=lambda m: m.timestamp, reverse=True)
+#
+#     page_periods = [
+#         PagePeriod(current_page_title, None, None),
+#     ]
+#
+#     for timestamp, from_, to in descending_moves:
+#         last = page_periods[-1]
+#
+#         page_periods[-1] = PagePeriod(last.page, timestamp, last.end)
+#
+#         page_periods.append(
+#             PagePeriod(from_, None, timestamp)
+#         )
+#     return page_periods
+
+# def test_periods_from_moves():
+#     moves = [
+#         PageMove(
+#             parse_timestamp('2014-11-26 15:28:23+00:00'),
+#             'Spanish conquest of Chiapas',
+#             'Spanish arrival to Chiapas',
+#         ),
+#         PageMove(
+#             parse_timestamp('2014-11-26 15:35:21+00:00'),
+#             'Spanish arrival to Chiapas',
+#             'Spanish conquest of Chiapas',
+#         ),
+#         PageMove(
+#             parse_timestamp('2014-11-26 15:40:59+00:00'),
+#             'Spanish conquest of Chiapas',
+#             'Spanish arrival to Chiapas',
+#         ),
+#         PageMove(
+#             parse_timestamp('2014-11-26 16:31:13+00:00'),
+#             'Spanish arrival to Chiapas',
+#             'Spanish conquest of Chiapas',
+#         ),
+#     ]
+#
+#     assert periods_from_moves('Spanish conquest of Chiapas', moves) == [
+#         PagePeriod(
+#             'Spanish conquest of Chiapas',
+#             parse_timestamp('2014-11-26 16:31:13+00:00'),
+#             None,
+#         ),
+#         PagePeriod(
+#             'Spanish arrival to Chiapas',
+#             parse_timestamp('2014-11-26 15:40:59+00:00'),
+#             parse_timestamp('2014-11-26 16:31:13+00:00'),
+#         ),
+#         PagePeriod(
+#             'Spanish conquest of Chiapas',
+#             parse_timestamp('2014-11-26 15:35:21+00:00'),
+#             parse_timestamp('2014-11-26 15:40:59+00:00'),
+#         ),
+#         PagePeriod(
+#             'Spanish arrival to Chiapas',
+#             parse_timestamp('2014-11-26 15:28:23+00:00'),
+#             parse_timestamp('2014-11-26 15:35:21+00:00'),
+#         ),
+#         PagePeriod(
+#             'Spanish conquest of Chiapas',
+#             None,
+#             parse_timestamp('2014-11-26 15:28:23+00:00'),
+#         ),
+#     ]
+#
+#     assert periods_from_moves('Spanish conquest of Chiapas', []) == [
+#         PagePeriod('Spanish conquest of Chiapas', None, None),
+#     ]
+
+# @functools.lru_cache(1000)
+# def get_page_periods(conn, project, page_title):
+#     moves = list(get_moves(conn, project, page_title))
+#     moves.sort(key=lambda r: r.timestamp)
+#
+#     print('Moves:')
+#     pprint(moves)
+#
+#     periods = list(periods_from_moves(page_title, moves))
+#     print('Page periods:')
+#     pprint(periods)
+#     return periods
+
+def get_redirects_ids_for(cursor, page_title):
+    page_title = wikify_title(page_title)
+    with cursor:
+        cursor.execute('''
+            select rd_from
+            from redirect
+            where rd_namespace = 0 and rd_title = %s
+            ''', (page_title,))
+        rows = cursor.fetchall()
+        ids = [row[0] for row in rows]
+        return ids
+
+
+def get_page_title(cursor, page_id):
+    with cursor:
+        cursor.execute('''
+            select page_title
+            from page
+            where page_id = %s
+            ''', (page_id,))
+        row = cursor.fetchone()
+        title = row[0]
+        if not isinstance(title, str):
+            title = title.decode('utf-8', errors='replace')
+        return title
+
+
+@functools.lru_cache(1)
+def get_redirects_for(connection, page_title):
+    redirects_ids = get_redirects_ids_for(
+        connection.cursor(),
+        page_title=page_title,
+    )
+    redirects_titles = [
+        get_page_title(connection.cursor(), page_id)
+        for page_id in redirects_ids
+    ]
+    print('Redirects found for', page_title, ':', redirects_titles)
+    return redirects_titles
+
+
+def counts_for_page(
+        connection: sqlite3.Connection,
+        views_counter: ViewsCounter,
+        project: str,
+        page_id: int,
+        page_title: str,
+        start_date: datetime.datetime,
+        end_date: datetime.datetime,
+        redirects_titles=None):
+
+    print('Looking for counts for', project, page_title, start_date, end_date)
+
+    if redirects_titles is None:
+        redirects_titles = get_redirects_for(connection, page_title)
+    else:
+        print('Redirects found for', page_title, ':', redirects_titles)
+
+    # sum_ = sum(
+    #     views_counter.count(project, page, start_date, end_date)
+    #     for page in redirects_titles + [page_title]
+    # )
+    pages = redirects_titles + [page_title]
+    sum_ = views_counter.count_multiple_pages(
+        project, pages, start_date, end_date)
+    print('Sum:', sum_)
+
+    return sum_
+
+
+def coalesce_records(records):
+    # One record per union of overlapping or adjacent intervals of records
+    # of the same page and identifier
+    first = records[0]
+    return [
+        first._replace(start_date=start, end_date=end)
+        for start, end in intervals.coalesce(
+            (r.start_date, r.end_date) for r in records)
+    ]
+
+
+def counts_for_group(
+        views_counter: ViewsCounter,
+        records,
+        redirects_titles,
+        split=True):
+    # Records of the same page and identifier (see intervals.iter_groups).
+    # Without split, their overlapping and adjacent intervals are merged
+    # and one record is output per merged interval.
+    first = records[0]
+    print('Looking for counts for', first.project, first.page_title,
+          len(records), 'intervals')
+    print('Redirects found for', first.page_title, ':', redirects_titles)
+
+    if not split:
+        records = coalesce_records(records)
+    spans = [(r.start_date, r.end_date) for r in records]
+
+    pages = redirects_titles + [first.page_title]
+    counts = views_counter.count_intervals(first.project, pages, spans)
+    return [OutputRecord(*r, views) for r, views in zip(records, counts)]
+
+
+def wikify_title(page_title):
+    return page_title.replace(' ', '_')
+
+
+def add_utc_if_naive(timestamp: datetime.datetime):
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+
+    return timestamp
+
+
+def parse_cmdline_date(timestamp: str):
+    return add_utc_if_naive(
+        dateutil.parser.parse(timestamp)
+    )
+
+
+def add_counting_arguments(parser):
+    # Options of the counting itself, shared with the distributed workers
+    # (see counts_shards.py)
+    parser.add_argument(
+        'counts_dataset_dir',
+        type=pathlib.Path,
+        help='pagecountssearch dataset, or page-major store built with '
+             'pagecounts_store.py',
+    )
+    parser.add_argument(
+        '--counts-period-start',
+        required=True,
+        type=parse_cmdline_date,
+    )
+    parser.add_argument(
+        '--counts-period-end',
+        required=True,
+        type=parse_cmdline_date,
+    )
+    parser.add_argument(
+        'db_url',
+        type=urllib.parse.urlparse,
+        help='Database connection URL',
+    )
+    parser.add_argument(
+        '--availability-index',
+        type=pathlib.Path,
+        default=None,
+        help='Page availability index (see pagecounts_availability.py), '
+             'used to skip searches for pages without counts. It is '
+             'created if missing and updated with every new search',
+    )
+    parser.add_argument(
+        '--counts-cache',
+        type=pathlib.Path,
+        default=None,
+        help='Sqlite file memoizing the counts of (pages, interval) queries '
+             'across runs over the same counts dataset. Repeated queries '
+             'within a run are always memoized in memory',
+    )
+    parser.add_argument(
+        '--shared-series-cache',
+        type=pathlib.Path,
+        default=None,
+        help='Directory, preferably on a tmpfs such as /dev/shm, where the '
+             'cumulative views of the pages are shared with the other '
+             'processes counting over the same counts dataset on this host. '
+             'Each page is searched and held in memory once',
+    )
+    parser.add_argument(
+        '--shared-series-cache-size',
+        type=int,
+        default=1024,
+        help='Size in MiB above which the least recently used pages are '
+             'evicted from --shared-series-cache (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--coalesce',
+        choices=['none', 'split', 'merge'],
+        default='none',
+        help='Count consecutive records of the same page and identifier '
+             'together: "split" outputs every record with the bounds of all '
+             'its intervals computed once, "merge" outputs one record per '
+             'union of overlapping or adjacent intervals',
+    )
+    parser.add_argument(
+        '--join',
+        choices=['lookup', 'sort-merge'],
+        default='lookup',
+        help='"lookup" searches the counts of each record\'s pages as '
+             'records arrive. "sort-merge" reads a whole input file first, '
+             'then searches every distinct page once, in the order of the '
+             'counts dataset, which turns random reads into a sequential '
+             'pass over a page-major store (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--db-pool-size',
+        type=int,
+        default=4,
+        help='Number of MySQL connections (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--redirect-workers',
+        type=int,
+        default=8,
+        help='Threads looking up redirects concurrently '
+             '(default: %(default)s)',
+    )
+    parser.add_argument(
+        '--redirect-lookahead',
+        type=int,
+        default=64,
+        help='Maximum number of input records whose redirects are looked '
+             'up ahead of the counting (default: %(default)s)',
+    )
+    profiling.add_profile_arguments(parser)
+    progress.add_progress_arguments(parser)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'input_files',
+        nargs='+',
+        type=pathlib.Path,
+    )
+    add_counting_arguments(parser)
+    parser.add_argument(
+        'output_dir',
+        type=pathlib.Path,
+    )
+    parser.add_argument(
+        '--output-compression',
+        choices=utils.OUTPUT_COMPRESSIONS,
+        default='none',
+        help='Compress the output files, replacing the compression suffix '
+             'of the input name (which is dropped with none). Compression '
+             'runs on a background thread or a parallel external compressor '
+             '(pigz, lbzip2, zstd)',
+    )
+    parser.add_argument(
+        '--db-sink',
+        type=utils.parse_mysql_url,
+        default=None,
+        metavar='MYSQL_URL',
+        help='Also upsert the counts into the identifiershistory_counts '
+             'table of this MySQL database, which is created if missing. '
+             'Rows are keyed by page id, identifier and interval, so re-runs '
+             'replace their views. Not available with --coalesce merge',
+    )
+    parser.add_argument(
+        '--db-sink-batch-size',
+        type=int,
+        default=10000,
+        help='Rows per transaction of --db-sink (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--previous-output-dir',
+        type=pathlib.Path,
+        default=None,
+        help='Output directory of a prior run over the same counts period '
+             'start and an earlier end, on a page-major store that has '
+             'since been extended. Its totals are extended with the views '
+             'after the last hour of the prior store: records ending by '
+             'then are copied as they are, and records that are new or '
+             'changed since the prior run are counted in full',
+    )
+    args = parser.parse_args(argv)
+
+    if args.previous_output_dir is not None and \
+            args.previous_output_dir.resolve() == args.output_dir.resolve():
+        parser.error('--previous-output-dir must differ from output_dir')
+    if args.db_sink is not None and args.coalesce == 'merge':
+        parser.error(
+            '--db-sink keys rows by identifier history entry, which '
+            '--coalesce merge replaces with merged intervals')
+    return args
+
+
+# def get_moves(connection, project, page_title):
+#     c = connection
+#     query = '''
+#     select distinct * from moves where project = ? and page_title_to = ?
+#     '''
+#
+#     to_search = {page_title}
+#     done = set()
+#     result = []
+#     with c:
+#         while to_search - done:
+#             curr_title = to_search.pop()
+#
+#             rows = c.execute(query, (project, curr_title)).fetchall()
+#
+#             for row in rows:
+#                 print('row:', tuple(row))
+#                 result.append(PageMove(
+#                     timestamp=row['timestamp'],
+#                     from_=row['page_title_from'],
+#                     to=row['page_title_to'],
+#                 ))
+#                 to_search.add(row['page_title_from'])
+#             done.add(curr_title)
+#
+#     result.sort(key=lambda r: r.timestamp)
+#     return result
+
+# def get_moves(connection, project, page_title):
+#     return get_moves_rec(connection, project, page_title, up_to=None, delete_shield=(page_title, ))
+#
+# def get_moves_rec(connection, project, page_title, up_to=None, delete_shield=None):
+#     c = connection
+#     query_moves = '''
+#     select distinct * from moves where project = ? and page_title_to = ?
+#     '''
+#
+#     query_deletions = '''
+#     select distinct * from deletions where project = ? and page_title = ?
+#     '''
+#     result = set()
+#     if up_to is not None:
+#         rows = c.execute('''
+#             select distinct *
+#             from moves
+#             where project = ? and page_title_to = ? and timestamp <= ?
+#             ''', (project, page_title, up_to)).fetchall()
+#     else:
+#         rows = c.execute('''
+#             select distinct *
+#             from moves
+#             where project = ? and page_title_to = ?
+#             ''', (project, page_title)).fetchall()
+#
+#     if not rows:
+#         return []
+#
+#     for row in rows:
+#         if row['page_title_from'] in delete_shield:
+#             is_deleted = False
+#         else:
+#             is_deleted = len(c.execute('''
+#                 select distinct *
+#                 from deletions
+#                 where project = ? and page_title = ?
+#                 ''', (project, row['page_title_from'])).fetchall()) >= 1
+#
+#         submoves = get_moves_rec(
+#             connection,
+#             project,
+#             row['page_title_from'],
+#             row['timestamp'],
+#             delete_shield=delete_shield,
+#         )
+#         if not submoves and is_deleted:
+#             print('Page ', row['page_title_from'], 'has been deleted. skip')
+#             continue
+#
+#         result.add(PageMove(
+#             timestamp=row['timestamp'],
+#             from_=row['page_title_from'],
+#             to=row['page_title_to'],
+#         ))
+#
+#         result.update(submoves)
+#     return result
+
+def open_counting(args):
+    # Views counter and redirect resolver configured from the options of
+    # add_counting_arguments
+    db_url = args.db_url
+    db_vars = dict(
+        host=db_url.hostname,
+        port=db_url.port or 3306,
+        user=db_url.username,
+        password=db_url.password or '',
+        database=db_url.path.rpartition('/')[-1],
+        charset='utf8',
+    )
+    print(db_vars)
+    db_pool = mysql_pool.ConnectionPool(db_vars, size=args.db_pool_size)
+    redirect_resolver = mysql_pool.RedirectResolver(
+        db_pool,
+        max_workers=args.redirect_workers,
+        max_in_flight=args.redirect_lookahead,
+    )
+
+    if pagecounts_store.is_store(args.counts_dataset_dir):
+        counts_finder = pagecounts_store.PageMajorStore(
+            args.counts_dataset_dir)
+    else:
+        import pagecountssearch
+        counts_finder = pagecountssearch.Finder(args.counts_dataset_dir)
+    availability = None
+    if args.availability_index is not None:
+        availability = pagecounts_availability.AvailabilityIndex(
+            args.availability_index,
+            pagecounts_availability.dataset_namespace(
+                args.counts_dataset_dir),
+        )
+    granularity = datetime.timedelta(hours=1)
+    namespace = shared_series.dataset_namespace(
+        args.counts_dataset_dir,
+        granularity,
+        cumulative_views.SPARSE_FILL_RATIO,
+    )
+    cache = counts_cache.CountsCache(args.counts_cache, namespace=namespace)
+    series_cache = None
+    if args.shared_series_cache is not None:
+        series_cache = shared_series.SharedSeriesCache(
+            args.shared_series_cache,
+            namespace,
+            max_bytes=args.shared_series_cache_size * 1024 * 1024,
+        )
+    views_counter = ViewsCounter(
+        counts_finder,
+        start_period=args.counts_period_start,
+        end_period=args.counts_period_end,
+        granularity=granularity,
+        availability=availability,
+        cache=cache,
+        shared_series=series_cache,
+    )
+    return views_counter, redirect_resolver
+
+
+def close_counting(views_counter, redirect_resolver):
+    if views_counter.availability is not None:
+        views_counter.availability.close()
+    views_counter.cache.close()
+    print('Counts cache:', views_counter.cache.summary())
+    if views_counter.shared_series is not None:
+        print('Shared series cache:', views_counter.shared_series.summary())
+    redirect_resolver.pool.close()
+    print('Redirect queries:', redirect_resolver.pool.stats.summary())
+
+
+def count_records(input_records, views_counter, redirect_resolver,
+                  coalesce='none', profiler=profiling.NULL_PROFILER,
+                  join='lookup'):
+    # Output records of a stream of input records, in the same order.
+    # Unless coalesce is 'merge', there is one output per input.
+    if join == 'sort-merge':
+        return count_records_batch(
+            input_records, views_counter, redirect_resolver, coalesce,
+            profiler)
+
+    if coalesce == 'none':
+        resolved_records = profiler.wrap_iter(
+            'redirects',
+            redirect_resolver.map(input_records),
+        )
+
+        return profiler.wrap_iter('transform', (
+            OutputRecord(
+                *r,
+                counts_for_page(
+                    None,
+                    views_counter,
+                    r.project,
+                    r.page_id,
+                    r.page_title,
+                    r.start_date,
+                    r.end_date,
+                    redirects_titles=redirects,
+                ),
+            )
+            for r, redirects in resolved_records
+        ))
+
+    resolved_groups = profiler.wrap_iter(
+        'redirects',
+        redirect_resolver.map(
+            intervals.iter_groups(input_records),
+            title=lambda group: group[0].page_title,
+        ),
+    )
+
+    return profiler.wrap_iter('transform', (
+        output_record
+        for group, redirects in resolved_groups
+        for output_record in counts_for_group(
+            views_counter,
+            group,
+            redirects,
+            split=coalesce == 'split',
+        )
+    ))
+
+
+def count_records_batch(input_records, views_counter, redirect_resolver,
+                        coalesce='none', profiler=profiling.NULL_PROFILER):
+    # count_records as a sort-merge join between all the records and the
+    # counts dataset (see ViewsCounter.count_batch). Records are held in
+    # memory until every count is known.
+    records = list(input_records)
+    if coalesce == 'merge':
+        records = [
+            merged
+            for group in intervals.iter_groups(records)
+            for merged in coalesce_records(group)
+        ]
+
+    titles = sorted({r.page_title for r in records})
+    redirects = dict(profiler.wrap_iter(
+        'redirects',
+        redirect_resolver.map(titles, title=lambda title: title),
+    ))
+
+    queries = [
+        (r.project, redirects[r.page_title] + [r.page_title],
+         r.start_date, r.end_date)
+        for r in records
+    ]
+    with profiler.stage('transform'):
+        counts = views_counter.count_batch(queries)
+
+    for r, views in zip(records, counts):
+        yield OutputRecord(*r, views)
+
+
+def open_sink(args):
+    if args.db_sink is None:
+        return None
+    connection = pymysql.connect(**args.db_sink)
+    counts_sink.create_tables(connection)
+    return counts_sink.CountsSink(
+        connection,
+        args.counts_period_start,
+        args.counts_period_end,
+        batch_size=args.db_sink_batch_size,
+    )
+
+
+META_SUFFIX = '.meta.json'
+
+RecountStats = collections.namedtuple(
+    'RecountStats',
+    'copied extended counted dropped',
+)
+
+
+def meta_path(output_file_path):
+    # Sidecar recording how an output file was counted
+    return output_file_path.with_name(output_file_path.name + META_SUFFIX)
+
+
+def write_meta(output_file_path, args, dataset_end):
+    path = meta_path(output_file_path)
+    tmp_path = path.with_suffix('.tmp')
+    with tmp_path.open('w') as f:
+        json.dump(dict(
+            counts_period_start=args.counts_period_start.isoformat(),
+            counts_period_end=args.counts_period_end.isoformat(),
+            counts_dataset_end=(
+                dataset_end.isoformat() if dataset_end is not None else None),
+            coalesce=args.coalesce,
+        ), f, indent=2, sort_keys=True)
+    os.replace(str(tmp_path), str(path))
+
+
+def find_previous_output(previous_output_dir, input_file_path, args):
+    # Prior output of an input file, whatever its compression, the end of
+    # its counts period and the last hour of its counts dataset. None if
+    # there is none that can be extended.
+    for compression in utils.OUTPUT_COMPRESSIONS:
+        path = utils.output_file_path(
+            previous_output_dir, input_file_path, compression)
+        if not meta_path(path).exists() or not path.exists():
+            continue
+        with meta_path(path).open() as f:
+            meta = json.load(f)
+
+        period_start = parse_cmdline_date(meta['counts_period_start'])
+        period_end = parse_cmdline_date(meta['counts_period_end'])
+        dataset_end = meta.get('counts_dataset_end')
+        if dataset_end is None:
+            print('Warning: {} does not record the last hour of its counts '
+                  'dataset'.format(path))
+        elif meta['coalesce'] != args.coalesce:
+            print('Warning: {} was counted with --coalesce {}'.format(
+                path, meta['coalesce']))
+        elif period_start != args.counts_period_start:
+            print('Warning: {} has another counts period start'.format(path))
+        elif period_end > args.counts_period_end:
+            print('Warning: {} has a later counts period end'.format(path))
+        else:
+            return path, period_end, parse_cmdline_date(dataset_end)
+        return None
+    return None
+
+
+def parse_views(views):
+    try:
+        return int(views)
+    except ValueError:
+        return float(views)
+
+
+def read_previous_output(output_file):
+    for raw_record in csv.reader(output_file):
+        yield parse_record(raw_record[:-1]), parse_views(raw_record[-1])
+
+
+class PriorCounts:
+    # Views of a prior output, matched to the records of the new run.
+    # Records come in the same order as in the prior run, so the prior
+    # rows skipped when a record is found are those of removed inputs, and
+    # a record without a match within `lookahead` prior rows is new.
+    def __init__(self, rows, lookahead=10000):
+        self.rows = iter(rows)
+        self.lookahead = lookahead
+        self.dropped = 0
+        self._pending = collections.deque()
+        self._pending_keys = collections.Counter()
+
+    def pop(self, record):
+        while not self._pending_keys[record] and \
+                len(self._pending) < self.lookahead:
+            row = next(self.rows, None)
+            if row is None:
+                break
+            self._pending.append(row)
+            self._pending_keys[row[0]] += 1
+
+        if not self._pending_keys[record]:
+            del self._pending_keys[record]
+            return None
+
+        while True:
+            prior_record, views = self._pending.popleft()
+            self._pending_keys[prior_record] -= 1
+            if prior_record == record:
+                return views
+            self.dropped += 1
+
+    def close(self):
+        # Prior rows left are those of removed inputs
+        self.dropped += len(self._pending) + sum(1 for _ in self.rows)
+        self._pending.clear()
+
+
+def test_prior_counts():
+    prior = PriorCounts(
+        [('a', 1), ('b', 2), ('c', 3), ('c', 4), ('d', 5)],
+        lookahead=3,
+    )
+    assert prior.pop('a') == 1
+    assert prior.pop('new') is None
+    assert prior.pop('c') == 3
+    assert prior.pop('c') == 4
+    assert prior.pop('d') == 5
+    prior.close()
+    assert prior.dropped == 1
+
+
+def test_recount_records_across_month_boundary():
+    import numpy
+
+    utc = datetime.timezone.utc
+    hour = 60 * 60
+    first = int(datetime.datetime(2012, 1, 30, tzinfo=utc).timestamp())
+    # The prior store ends with the 23:00 file of January, its counts
+    # period at the next midnight
+    prior_dataset_end = datetime.datetime(2012, 1, 31, 23, tzinfo=utc)
+    prior_period_end = datetime.datetime(2012, 2, 1, tzinfo=utc)
+    period_start = datetime.datetime(2012, 1, 1, tzinfo=utc)
+    period_end = datetime.datetime(2012, 2, 3, tzinfo=utc)
+
+    rng = numpy.random.RandomState(3)
+    timestamps = first + hour * numpy.arange(96, dtype=numpy.int64)
+    pages = {
+        page: (timestamps, rng.randint(0, 50, len(timestamps)))
+        for page in ('A', 'B')
+    }
+    # A page first seen in February
+    pages['C'] = (timestamps[60:], rng.randint(1, 50, 36))
+
+    class Finder:
+        def __init__(self, end):
+            self.end = int(end.timestamp())
+
+        def search_arrays(self, project, page):
+            timestamps, views = pages[page]
+            keep = timestamps <= self.end
+            return timestamps[keep], views[keep]
+
+    class Resolver:
+        def map(self, records, title=lambda r: r.page_title):
+            return ((r, []) for r in records)
+
+    def date(day, hour_=0, minute=0):
+        month, day = divmod(day, 100)
+        return datetime.datetime(2012, month or 1, day, hour_, minute,
+                                 tzinfo=utc)
+
+    records = [
+        InputRecord('en', 1, page, 'doi', str(i), start, end)
+        for i, (page, start, end) in enumerate([
+            ('A', None, None),
+            ('A', date(30, 5), None),
+            ('A', date(30, 5), date(31, 10)),
+            ('A', date(31, 12, 30), date(202, 4, 15)),
+            ('A', date(31, 23), date(201, 0)),
+            ('B', date(31, 23, 30), date(201, 3)),
+            ('B', date(201), None),
+            ('B', date(201, 1, 30), date(202, 1)),
+            ('C', None, date(202)),
+            ('C', date(30), date(31, 23)),
+        ])
+    ]
+
+    def counter(end, period_end):
+        return ViewsCounter(Finder(end), period_start, period_end)
+
+    prior = list(count_records(
+        records, counter(prior_dataset_end, prior_period_end), Resolver()))
+    full = list(count_records(
+        records, counter(period_end, period_end), Resolver()))
+    extended = list(recount_records(
+        records,
+        PriorCounts((r[:7], r.views) for r in prior),
+        prior_period_end,
+        prior_dataset_end,
+        counter(period_end, period_end),
+        Resolver(),
+    ))
+    assert [r.views for r in extended] == [r.views for r in full]
+    assert any(p.views != f.views for p, f in zip(prior, full))
+
+
+def recount_records(input_records, prior_counts, prior_period_end,
+                    prior_dataset_end, views_counter, redirect_resolver,
+                    coalesce='none', profiler=profiling.NULL_PROFILER,
+                    join='lookup', stats=None):
+    # count_records extending the totals of a prior run whose counts
+    # period ended at prior_period_end, over a dataset whose last hour was
+    # prior_dataset_end. Cumulative views are the same in the prior and
+    # the new dataset up to that hour, and counts are differences of
+    # cumulative views, so a record's new total is its prior total plus
+    # its count from prior_dataset_end on. Records ending by then keep
+    # their total. Records missing from the prior output, or starting
+    # after the prior period (which were not counted), are counted in
+    # full. stats: optional dict of RecountStats fields, updated as records
+    # are output.
+    if stats is None:
+        stats = {}
+    for field in RecountStats._fields:
+        stats.setdefault(field, 0)
+
+    records = input_records
+    if coalesce == 'merge':
+        records = (
+            merged
+            for group in intervals.iter_groups(records)
+            for merged in coalesce_records(group)
+        )
+
+    # Dates are compared like timespan_intersects does
+    prior_end = to_unix_timestamp(prior_period_end)
+    dataset_end = to_unix_timestamp(prior_dataset_end)
+
+    # (record, prior views or None, whether it is counted), in input order
+    pending = collections.deque()
+
+    def queries():
+        for record in records:
+            views = prior_counts.pop(record)
+            if views is not None and record.start_date is not None and \
+                    to_unix_timestamp(record.start_date) > prior_end:
+                views = None
+            if views is None:
+                pending.append((record, None, True))
+                yield record
+            elif record.end_date is not None and \
+                    to_unix_timestamp(record.end_date) <= dataset_end:
+                pending.append((record, views, False))
+            else:
+                pending.append((record, views, True))
+                start_date = record.start_date
+                if start_date is None or \
+                        to_unix_timestamp(start_date) < dataset_end:
+                    start_date = prior_dataset_end
+                yield record._replace(start_date=start_date)
+
+    # Merged records are counted as they are
+    counted = count_records(
+        queries(),
+        views_counter,
+        redirect_resolver,
+        'none' if coalesce == 'none' else 'split',
+        profiler,
+        join,
+    )
+
+    def take(counted_record):
+        while pending:
+            record, views, is_counted = pending.popleft()
+            if not is_counted:
+                stats['copied'] += 1
+                yield OutputRecord(*record, views)
+                continue
+            if views is None:
+                stats['counted'] += 1
+                views = 0
+            else:
+                stats['extended'] += 1
+            yield OutputRecord(*record, views + counted_record.views)
+            return
+
+    for counted_record in counted:
+        yield from take(counted_record)
+    yield from take(None)
+    prior_counts.close()
+    stats['dropped'] += prior_counts.dropped
+
+
+def add_counts_to_file(input_file_path, args, views_counter,
+                       redirect_resolver, sink=None,
+                       profiler=profiling.NULL_PROFILER):
+    input_file = utils.open_compressed_file(input_file_path)
+    reporter = progress.from_args(args, input_file_path, input_file)
+    output_file_path = utils.output_file_path(
+        args.output_dir,
+        input_file_path,
+        args.output_compression,
+    )
+    previous = None
+    if args.previous_output_dir is not None:
+        previous = find_previous_output(
+            args.previous_output_dir, input_file_path, args)
+        if previous is None:
+            print('No prior output to extend, counting', input_file_path)
+
+    output_file = utils.open_output_file(output_file_path)
+    with input_file, output_file:
+        raw_records = csv.reader(
+            profiler.wrap_iter('decompress', input_file))
+
+        input_records = profiler.wrap_iter(
+            'parse',
+            (parse_record(r) for r in raw_records),
+        )
+        if previous is None:
+            previous_file = None
+            output_records = count_records(
+                input_records,
+                views_counter,
+                redirect_resolver,
+                args.coalesce,
+                profiler,
+                args.join,
+            )
+        else:
+            previous_path, previous_period_end, previous_dataset_end = previous
+            previous_file = utils.open_compressed_file(previous_path)
+            recount_stats = {}
+            output_records = recount_records(
+                input_records,
+                PriorCounts(read_previous_output(previous_file)),
+                previous_period_end,
+                previous_dataset_end,
+                views_counter,
+                redirect_resolver,
+                args.coalesce,
+                profiler,
+                args.join,
+                recount_stats,
+            )
+
+        writer = csv.writer(output_file)
+
+        with profiler.stage('write'):
+            for output_record in reporter.wrap_iter(output_records):
+                writer.writerow(output_record)
+                if sink is not None:
+                    sink.write(output_record)
+
+        if previous_file is not None:
+            previous_file.close()
+            print('Extended', previous_path, ':', recount_stats)
+    write_meta(output_file_path, args, views_counter.dataset_end())
+    reporter.close()
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    print(args)
+    profiler = profiling.from_args(args)
+
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+
+    # sqlite_conn = sqlite3.connect(
+    #     str(args.moves_sqlite),
+    #     detect_types=sqlite3.PARSE_DECLTYPES,
+    # )
+    # sqlite_conn.row_factory = sqlite3.Row
+    # ipdb.set_trace()  ######### Break Point ###########
+    #
+    # r=get_page_periods(moves_conn, 'en', '\'Abd al-Rahman I')
+    # periods = get_page_periods(moves_conn, 'en', 'Spanish conquest of Chiapas')
+    views_counter, redirect_resolver = open_counting(args)
+    sink = open_sink(args)
+
+    # The sink is closed whatever happens, so that the rows counted so far
+    # are written and its thread and connection do not outlive the run
+    try:
+        for input_file_path in args.input_files:
+            add_counts_to_file(
+                input_file_path,
+                args,
+                views_counter,
+                redirect_resolver,
+                sink,
+                profiler,
+            )
+    finally:
+        try:
+            if sink is not None:
+                with profiler.stage('write'):
+                    sink.close()
+                print('Database sink:', sink.stats()._asdict())
+        finally:
+            close_counting(views_counter, redirect_resolver)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+import argparse
+import importlib
+import sys
+
+# Subcommand -> (module, help). Modules are only imported once their
+# subcommand is chosen, so that `wikidump <command>` does not pay for the
+# dependencies (numpy, pymysql, pagecountssearch, ...) of the others.
+COMMANDS = {
+    'extract-moves': (
+        'extract_moves',
+        'Extract page moves from logging XML dumps to CSV',
+    ),
+    'load-moves': (
+        'moves_csv_to_sqlite',
+        'Load extracted page moves into sqlite',
+    ),
+    'extract-load-moves': (
+        'moves_pipeline',
+        'Extract page moves from logging XML dumps straight into sqlite',
+    ),
+    'load-moves-sharded': (
+        'moves_shards',
+        'Load page moves into per-project/title-hash sqlite shards',
+    ),
+    'load-pageids': (
+        'pageids_to_db',
+        'Load page ids into sqlite',
+    ),
+    'load-identifiers': (
+        'identifiershistory_to_db',
+        'Load identifier histories into MySQL',
+    ),
+    'load-mag': (
+        'mag_papers_to_db',
+        'Load Microsoft Academic Graph papers into MySQL',
+    ),
+    'add-counts': (
+        'add_counts_to_csv',
+        'Add pagecounts views to identifier histories',
+    ),
+    'add-counts-sharded': (
+        'counts_shards',
+        'Add pagecounts views with workers sharing a work directory',
+    ),
+    'serve-lookup': (
+        'lookup',
+        'Serve page id, title and moves lookups over HTTP',
+    ),
+    'build-store': (
+        'pagecounts_store',
+        'Build or extend a page-major pagecounts store',
+    ),
+    'build-availability': (
+        'pagecounts_availability',
+        'Precompute which pages have pagecounts',
+    ),
+}
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog='wikidump',
+        description='Run "wikidump <command> --help" for the options of a '
+                    'command.',
+    )
+    subparsers = parser.add_subparsers(dest='command', metavar='command')
+    subparsers.required = True
+    for name, (_, help) in COMMANDS.items():
+        subparsers.add_parser(name, help=help, add_help=False)
+    return parser
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    parser = build_parser()
+    args = parser.parse_args(argv[:1])
+
+    module_name, _ = COMMANDS[args.command]
+    module = importlib.import_module('.' + module_name, __package__)
+
+    # Usage messages and default profile names of the command
+    sys.argv[0] = '{} {}'.format(parser.prog, args.command)
+    return module.main(argv[1:])
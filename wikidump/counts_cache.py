@@ -0,0 +1,105 @@
+import collections
+import hashlib
+import json
+import sqlite3
+
+
+class CountsCache:
+    # Memoized results of ViewsCounter.count_multiple_pages, keyed by
+    # (namespace, project, pages, start, end, counts period). The namespace
+    # identifies the counts dataset (see shared_series.dataset_namespace):
+    # counts of open-ended intervals change when a dataset is extended.
+    # Entries live in an in-memory LRU and, when a path is given, in a
+    # sqlite file so that reruns over overlapping inputs reuse them.
+    def __init__(self, path=None, max_entries=100000, commit_every=1000,
+                 namespace=''):
+        self.path = path
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.commit_every = commit_every
+        self.hits = 0
+        self.stored_hits = 0
+        self.misses = 0
+        self._memory = collections.OrderedDict()
+        self._pending = 0
+        self.connection = None
+        if path is not None:
+            self.connection = sqlite3.connect(str(path))
+            self.connection.execute('PRAGMA synchronous = OFF')
+            # Without type affinity, views stay integers or floats as
+            # computed
+            self.connection.executescript('''
+CREATE TABLE IF NOT EXISTS cached_counts (
+    key BLOB PRIMARY KEY,
+    views NOT NULL
+) WITHOUT ROWID;
+            ''')
+
+    def make_key(self, project, pages, start_date, end_date, period):
+        fields = [
+            self.namespace,
+            project,
+            sorted(pages),
+            start_date.isoformat() if start_date is not None else None,
+            end_date.isoformat() if end_date is not None else None,
+            [d.isoformat() if d is not None else None for d in period],
+        ]
+        encoded = json.dumps(fields, ensure_ascii=False).encode('utf-8')
+        return hashlib.blake2b(encoded, digest_size=16).digest()
+
+    def get(self, key):
+        views = self._memory.get(key)
+        if views is not None:
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return views
+
+        if self.connection is not None:
+            row = self.connection.execute(
+                'SELECT views FROM cached_counts WHERE key = ?',
+                (key,),
+            ).fetchone()
+            if row is not None:
+                self.stored_hits += 1
+                self._remember(key, row[0])
+                return row[0]
+
+        self.misses += 1
+        return None
+
+    def put(self, key, views):
+        self._remember(key, views)
+        if self.connection is not None:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO cached_counts VALUES (?, ?)',
+                (key, views),
+            )
+            self._pending += 1
+            if self._pending >= self.commit_every:
+                self.commit()
+
+    def _remember(self, key, views):
+        self._memory[key] = views
+        if len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def summary(self):
+        lookups = self.hits + self.stored_hits + self.misses
+        return dict(
+            lookups=lookups,
+            memory_hits=self.hits,
+            stored_hits=self.stored_hits,
+            misses=self.misses,
+            hit_rate=(
+                (self.hits + self.stored_hits) / lookups if lookups else None),
+        )
+
+    def commit(self):
+        if self.connection is not None:
+            self.connection.commit()
+        self._pending = 0
+
+    def close(self):
+        if self.connection is not None:
+            self.commit()
+            self.connection.close()
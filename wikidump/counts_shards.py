@@ -0,0 +1,717 @@
+import argparse
+import collections
+import concurrent.futures
+import csv
+import gzip
+import heapq
+import json
+import os
+import pathlib
+import socket
+import sys
+import threading
+import time
+import traceback
+import uuid
+import zlib
+
+from . import add_counts_to_csv
+from . import profiling
+from . import progress
+from . import utils
+
+# A distributed add_counts_to_csv run lives in a work directory on storage
+# shared by every node:
+#
+#     manifest.json               {"inputs": [...], "rows": [...], "shards": N}
+#     shards/shard-0007.csv.gz    input records of shard 7
+#     claims/shard-0007           worker counting shard 7
+#     failed/shard-0007           traceback of a failed attempt
+#     outputs/shard-0007.csv.gz   counted records of shard 7
+#
+# `plan` splits the input files into shards by hash of (project,
+# page_title), so that every page is counted by a single worker, in a
+# work directory that is empty or new. Shard records are prefixed with
+# their input file index and row number, which `merge` uses to
+# reassemble the output files in input order once every shard has its
+# output. In between, any number of `work` invocations, on
+# any node and each with its own counts dataset, claim shards by creating
+# their claim file exclusively and count them like add_counts_to_csv.
+# A shard is done once its output exists, which is written under a
+# temporary name and renamed.
+MANIFEST = 'manifest.json'
+
+# Seconds between two refreshes of a claim's mtime by its worker
+HEARTBEAT_INTERVAL = 60
+
+
+def shard_of(project, page_title, n_shards):
+    key = '{}\0{}'.format(project, page_title).encode('utf-8')
+    return zlib.crc32(key) % n_shards
+
+
+def shard_name(shard):
+    return 'shard-{:04d}'.format(shard)
+
+
+class WorkDir:
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.shards_dir = self.path / 'shards'
+        self.claims_dir = self.path / 'claims'
+        self.failed_dir = self.path / 'failed'
+        self.outputs_dir = self.path / 'outputs'
+
+    def read_manifest(self):
+        with (self.path / MANIFEST).open(encoding='utf-8') as f:
+            return json.load(f)
+
+    def write_manifest(self, manifest):
+        path = self.path / MANIFEST
+        tmp_path = path.with_suffix('.tmp')
+        with tmp_path.open('w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(str(tmp_path), str(path))
+
+    def shard_path(self, shard):
+        return self.shards_dir / (shard_name(shard) + '.csv.gz')
+
+    def claim_path(self, shard):
+        return self.claims_dir / shard_name(shard)
+
+    def failed_path(self, shard):
+        return self.failed_dir / shard_name(shard)
+
+    def output_path(self, shard):
+        return self.outputs_dir / (shard_name(shard) + '.csv.gz')
+
+    def is_empty(self):
+        # Whether no run was planned here, even partially
+        if (self.path / MANIFEST).exists():
+            return False
+        return not any(
+            path.is_dir() and any(path.iterdir())
+            for path in (self.shards_dir, self.claims_dir, self.failed_dir,
+                         self.outputs_dir)
+        )
+
+    def state(self, shard):
+        if self.output_path(shard).exists():
+            return 'done'
+        if self.claim_path(shard).exists():
+            return 'claimed'
+        if self.failed_path(shard).exists():
+            return 'failed'
+        return 'pending'
+
+
+def worker_id():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def plan(work_dir, input_paths, n_shards):
+    work_dir = WorkDir(work_dir)
+    # Claims, failures and outputs are those of the planned shards: those
+    # of another plan would be merged into this one
+    if not work_dir.is_empty():
+        raise ValueError('{} already holds a planned run'.format(
+            work_dir.path))
+    for path in (work_dir.shards_dir, work_dir.claims_dir,
+                 work_dir.failed_dir, work_dir.outputs_dir):
+        path.mkdir(parents=True, exist_ok=True)
+
+    # Plain gzip: one external compressor or writer thread per shard
+    # would not scale to thousands of shards.
+    shard_files = [
+        gzip.open(str(work_dir.shard_path(shard)), 'wt', encoding='utf-8',
+                  newline='')
+        for shard in range(n_shards)
+    ]
+    writers = [csv.writer(f) for f in shard_files]
+
+    rows = []
+    try:
+        for file_index, input_path in enumerate(input_paths):
+            with utils.open_compressed_file(input_path) as input_file:
+                row_index = -1
+                for row_index, row in enumerate(csv.reader(input_file)):
+                    project, _, page_title = row[:3]
+                    shard = shard_of(project, page_title, n_shards)
+                    writers[shard].writerow([file_index, row_index] + row)
+            rows.append(row_index + 1)
+            print('Planned', input_path, 'with', row_index + 1, 'records')
+    finally:
+        for f in shard_files:
+            f.close()
+
+    manifest = dict(
+        inputs=[str(p) for p in input_paths],
+        rows=rows,
+        shards=n_shards,
+    )
+    work_dir.write_manifest(manifest)
+    return manifest
+
+
+def claim(work_dir, shard, stale_after=None, retry_failed=False):
+    # Token of the claim when this process claimed the shard, otherwise
+    # None
+    state = work_dir.state(shard)
+    if state == 'done' or (state == 'failed' and not retry_failed):
+        return None
+
+    claim_path = work_dir.claim_path(shard)
+    if stale_after is not None and state == 'claimed':
+        try:
+            age = time.time() - claim_path.stat().st_mtime
+        except FileNotFoundError:
+            age = 0
+        if age > stale_after:
+            # Only one worker can rename the stale claim away
+            stale_path = claim_path.with_name(
+                '{}.stale-{}'.format(claim_path.name, worker_id()))
+            try:
+                os.rename(str(claim_path), str(stale_path))
+            except FileNotFoundError:
+                return None
+            stale_path.unlink()
+            print('Reclaiming', shard_name(shard), 'after', int(age),
+                  'seconds without heartbeat')
+
+    try:
+        fd = os.open(str(claim_path), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return None
+    token = uuid.uuid4().hex
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(dict(worker=worker_id(), token=token, time=time.time()), f)
+
+    # Another worker may have finished it since the state was checked
+    if work_dir.output_path(shard).exists():
+        release_claim(work_dir, shard, token)
+        return None
+    return token
+
+
+def release_claim(work_dir, shard, token):
+    # Removes the claim of the shard if it still holds this token: once
+    # reclaimed through --stale-after, it belongs to another worker. The
+    # claim is renamed away before it is read, so that it cannot change in
+    # between, and another worker's claim is linked back unless a newer
+    # one was created meanwhile. Returns whether the claim was removed.
+    claim_path = work_dir.claim_path(shard)
+    held_path = claim_path.with_name(
+        '{}.release-{}'.format(claim_path.name, token))
+    try:
+        os.rename(str(claim_path), str(held_path))
+    except FileNotFoundError:
+        return False
+
+    try:
+        with held_path.open(encoding='utf-8') as f:
+            held = json.load(f).get('token') == token
+    except ValueError:
+        # Still being written by the worker that created it
+        held = False
+    if not held:
+        try:
+            os.link(str(held_path), str(claim_path))
+        except FileExistsError:
+            pass
+    held_path.unlink()
+    return held
+
+
+class Heartbeat:
+    # Refreshes the mtime of a claim every `interval` seconds from a
+    # background thread, for as long as the shard is counted: counting may
+    # not output anything for long, e.g. --join sort-merge counts the whole
+    # shard before its first output.
+    def __init__(self, claim_path, interval=HEARTBEAT_INTERVAL):
+        self.claim_path = claim_path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                os.utime(str(self.claim_path))
+            except FileNotFoundError:
+                pass
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+
+def count_shard(work_dir, shard, views_counter, redirect_resolver,
+                coalesce='none', profiler=profiling.NULL_PROFILER,
+                progress_args=None, join='lookup'):
+    shard_path = work_dir.shard_path(shard)
+    output_path = work_dir.output_path(shard)
+    tmp_path = output_path.with_name(
+        '{}.tmp-{}'.format(output_path.name, worker_id()))
+    claim_path = work_dir.claim_path(shard)
+
+    # Tags of the records handed over to count_records, whose outputs come
+    # back one per input and in order
+    tags = collections.deque()
+
+    def input_records(raw_records):
+        for row in raw_records:
+            tags.append(row[:2])
+            yield add_counts_to_csv.parse_record(row[2:])
+
+    input_file = utils.open_compressed_file(shard_path)
+    reporter = progress.NULL_REPORTER
+    if progress_args is not None:
+        reporter = progress.from_args(progress_args, shard_path, input_file)
+    output_file = gzip.open(str(tmp_path), 'wt', encoding='utf-8',
+                            newline='')
+    rows = 0
+    try:
+        with input_file, output_file, Heartbeat(claim_path):
+            raw_records = csv.reader(
+                profiler.wrap_iter('decompress', input_file))
+            output_records = add_counts_to_csv.count_records(
+                profiler.wrap_iter('parse', input_records(raw_records)),
+                views_counter,
+                redirect_resolver,
+                coalesce,
+                profiler,
+                join,
+            )
+
+            writer = csv.writer(output_file)
+            with profiler.stage('write'):
+                for output_record in reporter.wrap_iter(output_records):
+                    writer.writerow(tags.popleft() + list(output_record))
+                    rows += 1
+    except BaseException:
+        tmp_path.unlink()
+        raise
+    reporter.close()
+
+    os.replace(str(tmp_path), str(output_path))
+    return rows
+
+
+def work(args):
+    # Claims and counts shards until none is left to claim. A shard that
+    # fails is recorded as such and skipped. Returns the numbers of the
+    # shards counted and of those that failed.
+    work_dir = WorkDir(args.work_dir)
+    manifest = work_dir.read_manifest()
+    profiler = profiling.from_args(args)
+    views_counter, redirect_resolver = add_counts_to_csv.open_counting(args)
+
+    counted = []
+    failed = []
+    try:
+        for shard in range(manifest['shards']):
+            if (args.max_shards is not None
+                    and len(counted) + len(failed) >= args.max_shards):
+                break
+            token = claim(work_dir, shard, args.stale_after,
+                          args.retry_failed)
+            if token is None:
+                continue
+
+            print(worker_id(), 'counting', shard_name(shard))
+            try:
+                rows = count_shard(
+                    work_dir,
+                    shard,
+                    views_counter,
+                    redirect_resolver,
+                    args.coalesce,
+                    profiler,
+                    args,
+                    args.join,
+                )
+            except Exception:
+                error = traceback.format_exc()
+                print(worker_id(), 'failed to count', shard_name(shard))
+                print(error)
+                work_dir.failed_path(shard).write_text(
+                    '{}\n{}'.format(worker_id(), error),
+                    encoding='utf-8',
+                )
+                failed.append(shard)
+                continue
+            finally:
+                release_claim(work_dir, shard, token)
+
+            failed_path = work_dir.failed_path(shard)
+            if failed_path.exists():
+                failed_path.unlink()
+            print(worker_id(), 'counted', shard_name(shard), 'with', rows,
+                  'records')
+            counted.append(shard)
+    finally:
+        add_counts_to_csv.close_counting(views_counter, redirect_resolver)
+    return counted, failed
+
+
+def status(work_dir):
+    work_dir = WorkDir(work_dir)
+    manifest = work_dir.read_manifest()
+    states = collections.OrderedDict()
+    for shard in range(manifest['shards']):
+        states.setdefault(work_dir.state(shard), []).append(shard)
+    return states
+
+
+def reset(work_dir, shards=None):
+    # Releases the claims and failures of shards that are not done, e.g.
+    # after a worker was killed, so that they can be counted again
+    work_dir = WorkDir(work_dir)
+    manifest = work_dir.read_manifest()
+    if shards is None:
+        shards = range(manifest['shards'])
+    released = []
+    for shard in shards:
+        if work_dir.state(shard) == 'done':
+            continue
+        for path in (work_dir.claim_path(shard), work_dir.failed_path(shard)):
+            if path.exists():
+                path.unlink()
+                released.append(shard)
+    return sorted(set(released))
+
+
+def iter_tagged_rows(path):
+    with utils.open_compressed_file(path) as f:
+        for row in csv.reader(f):
+            yield int(row[0]), int(row[1]), row[2:]
+
+
+def merge(work_dir, output_dir, compression='none'):
+    work_dir = WorkDir(work_dir)
+    manifest = work_dir.read_manifest()
+    n_shards = manifest['shards']
+
+    missing = [
+        shard_name(shard)
+        for shard in range(n_shards)
+        if work_dir.state(shard) != 'done'
+    ]
+    if missing:
+        raise ValueError('{} shards are not done: {}'.format(
+            len(missing), ', '.join(missing)))
+
+    output_dir = pathlib.Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    # Every shard output is sorted by (file index, row number)
+    rows = heapq.merge(*(
+        iter_tagged_rows(work_dir.output_path(shard))
+        for shard in range(n_shards)
+    ))
+
+    counts = [0] * len(manifest['inputs'])
+    output_file = None
+    current = None
+    try:
+        for file_index, _, row in rows:
+            if file_index != current:
+                if output_file is not None:
+                    output_file.close()
+                current = file_index
+                output_file = utils.open_output_file(utils.output_file_path(
+                    output_dir,
+                    manifest['inputs'][file_index],
+                    compression,
+                ))
+                writer = csv.writer(output_file)
+            writer.writerow(row)
+            counts[file_index] += 1
+    finally:
+        if output_file is not None:
+            output_file.close()
+
+    # Inputs without any record still get their (empty) output
+    for file_index, input_path in enumerate(manifest['inputs']):
+        path = utils.output_file_path(output_dir, input_path, compression)
+        if counts[file_index] == 0 and not path.exists():
+            utils.open_output_file(path).close()
+
+    for input_path, expected, actual in zip(
+            manifest['inputs'], manifest['rows'], counts):
+        if expected != actual:
+            raise ValueError('{} has {} records, but {} were merged'.format(
+                input_path, expected, actual))
+    return counts
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run add_counts_to_csv.py over several processes or '
+                    'nodes sharing a work directory: plan the shards, run '
+                    'workers until every shard is counted, then merge the '
+                    'outputs.',
+    )
+    subparsers = parser.add_subparsers(dest='action', metavar='action')
+    subparsers.required = True
+
+    plan_parser = subparsers.add_parser(
+        'plan',
+        help='Split input files into shards by page',
+    )
+    plan_parser.add_argument('work_dir', type=pathlib.Path)
+    plan_parser.add_argument('input_files', nargs='+', type=pathlib.Path)
+    plan_parser.add_argument(
+        '--shards',
+        type=int,
+        default=64,
+        help='Number of shards (default: %(default)s)',
+    )
+
+    work_parser = subparsers.add_parser(
+        'work',
+        help='Count shards until none is left',
+    )
+    work_parser.add_argument('work_dir', type=pathlib.Path)
+    add_counts_to_csv.add_counting_arguments(work_parser)
+    work_parser.add_argument(
+        '--processes', '-j',
+        type=int,
+        default=1,
+        help='Worker processes on this node (default: %(default)s)',
+    )
+    work_parser.add_argument(
+        '--max-shards',
+        type=int,
+        default=None,
+        help='Stop after counting this many shards (per process)',
+    )
+    work_parser.add_argument(
+        '--stale-after',
+        type=float,
+        default=None,
+        help='Reclaim shards whose worker has not shown signs of life for '
+             'this many seconds (it refreshes its claim every {} seconds)'
+             .format(HEARTBEAT_INTERVAL),
+    )
+    work_parser.add_argument(
+        '--retry-failed',
+        action='store_true',
+        help='Also claim shards whose last attempt failed',
+    )
+
+    status_parser = subparsers.add_parser(
+        'status',
+        help='Show the state of every shard',
+    )
+    status_parser.add_argument('work_dir', type=pathlib.Path)
+
+    reset_parser = subparsers.add_parser(
+        'reset',
+        help='Release claimed or failed shards, e.g. after a crash',
+    )
+    reset_parser.add_argument('work_dir', type=pathlib.Path)
+    reset_parser.add_argument(
+        'shards',
+        nargs='*',
+        type=int,
+        help='Shard numbers (default: every shard not done)',
+    )
+
+    merge_parser = subparsers.add_parser(
+        'merge',
+        help='Reassemble the outputs of every input file',
+    )
+    merge_parser.add_argument('work_dir', type=pathlib.Path)
+    merge_parser.add_argument('output_dir', type=pathlib.Path)
+    merge_parser.add_argument(
+        '--output-compression',
+        choices=utils.OUTPUT_COMPRESSIONS,
+        default='none',
+    )
+
+    args = parser.parse_args(argv)
+    if args.action == 'work' and args.coalesce == 'merge':
+        work_parser.error(
+            '--coalesce merge changes the number of records and cannot be '
+            'merged back in input order')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.action == 'plan':
+        manifest = plan(args.work_dir, args.input_files, args.shards)
+        print('Planned', sum(manifest['rows']), 'records in',
+              manifest['shards'], 'shards')
+
+    elif args.action == 'work':
+        if args.processes == 1:
+            counted, failed = work(args)
+        else:
+            counted, failed = [], []
+            executor = concurrent.futures.ProcessPoolExecutor(args.processes)
+            with executor:
+                futures = [
+                    executor.submit(work, args)
+                    for _ in range(args.processes)
+                ]
+                for future in futures:
+                    c, f = future.result()
+                    counted += c
+                    failed += f
+        print('Counted', len(counted), 'shards')
+        if failed:
+            print('Failed shards:', ' '.join(str(s) for s in sorted(failed)))
+            sys.exit(1)
+
+    elif args.action == 'status':
+        for state, shards in status(args.work_dir).items():
+            print('{}: {}'.format(state, len(shards)))
+            if state != 'done':
+                print('   ', ' '.join(str(s) for s in shards))
+
+    elif args.action == 'reset':
+        released = reset(args.work_dir, args.shards or None)
+        print('Released', len(released), 'shards:',
+              ' '.join(str(s) for s in released))
+
+    elif args.action == 'merge':
+        counts = merge(args.work_dir, args.output_dir,
+                       args.output_compression)
+        print('Merged', sum(counts), 'records into', len(counts), 'files')
+
+
+
+def test_release_claim_held_by_another_token(tmp_path):
+    work_dir = WorkDir(tmp_path / 'work')
+    input_path = tmp_path / 'in.csv'
+    input_path.write_text('en,1,Page,doi,10.1/1,,\n', encoding='utf-8')
+    plan(work_dir.path, [input_path], 1)
+
+    token = claim(work_dir, 0)
+    assert token is not None
+    assert claim(work_dir, 0) is None
+    assert not release_claim(work_dir, 0, 'another token')
+    assert work_dir.state(0) == 'claimed'
+    assert release_claim(work_dir, 0, token)
+    assert work_dir.state(0) == 'pending'
+    assert not release_claim(work_dir, 0, token)
+
+
+def test_stale_claim_is_reclaimed(tmp_path):
+    work_dir = WorkDir(tmp_path / 'work')
+    input_path = tmp_path / 'in.csv'
+    input_path.write_text('en,1,Page,doi,10.1/1,,\n', encoding='utf-8')
+    plan(work_dir.path, [input_path], 1)
+
+    stale_token = claim(work_dir, 0)
+    claim_path = work_dir.claim_path(0)
+    with Heartbeat(claim_path, interval=0.01):
+        last_seen = time.time() - 120
+        os.utime(str(claim_path), (last_seen, last_seen))
+        time.sleep(0.2)
+    assert claim_path.stat().st_mtime > last_seen + 60
+    assert claim(work_dir, 0, stale_after=60) is None
+
+    os.utime(str(claim_path), (last_seen, last_seen))
+    token = claim(work_dir, 0, stale_after=60)
+    assert token not in (None, stale_token)
+    # The dead worker coming back does not release the new claim
+    assert not release_claim(work_dir, 0, stale_token)
+    assert work_dir.state(0) == 'claimed'
+
+    work_dir.failed_path(0).write_text('error', encoding='utf-8')
+    assert reset(work_dir.path) == [0]
+    assert work_dir.state(0) == 'pending'
+
+
+def test_sharded_run_matches_single_run(tmp_path, monkeypatch):
+    # Plans two input files into shards, counts them with two worker
+    # processes (forked, so that they inherit the stub connection pool)
+    # and checks the merged outputs against a single add_counts_to_csv run
+    import random
+
+    from . import mysql_pool
+    from . import pagecounts_store
+
+    class Pool:
+        # Titles of odd length have a redirect
+        def __init__(self, db_vars, size=None):
+            self.stats = mysql_pool.LatencyStats()
+
+        def fetchall(self, query, params):
+            title = params[0]
+            return [(title + '_(redirect)',)] if len(title) % 2 else []
+
+        def close(self):
+            pass
+
+    monkeypatch.setattr(mysql_pool, 'ConnectionPool', Pool)
+
+    rng = random.Random(7)
+    titles = ['Page {}'.format(i) for i in range(40)]
+    hourly_dir = tmp_path / 'hourly'
+    hourly_dir.mkdir()
+    for hour in range(48):
+        name = 'pagecounts-201201{:02d}-{:02d}0000.gz'.format(
+            1 + hour // 24, hour % 24)
+        with gzip.open(str(hourly_dir / name), 'wt', encoding='utf-8') as f:
+            for title in titles:
+                for page in (title, title + ' (redirect)'):
+                    if rng.random() < 0.5:
+                        f.write('en {} {} 0\n'.format(
+                            page.replace(' ', '_'), rng.randint(1, 100)))
+    store_dir = tmp_path / 'store'
+    pagecounts_store.main([str(store_dir), str(hourly_dir), '--buckets', '4'])
+
+    def date(hour):
+        if hour is None:
+            return ''
+        return '2012-01-{:02d} {:02d}:30:00'.format(1 + hour // 24, hour % 24)
+
+    input_paths = []
+    for i in range(2):
+        input_path = tmp_path / 'in-{}.csv'.format(i)
+        with input_path.open('w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            for j in range(60):
+                start = rng.choice([None, rng.randrange(48)])
+                end = rng.choice([None, rng.randrange(start or 0, 48)])
+                writer.writerow([
+                    'en', rng.randrange(1000), rng.choice(titles), 'doi',
+                    '10.{}/{}'.format(i, j), date(start), date(end),
+                ])
+        input_paths.append(input_path)
+
+    inputs = [str(p) for p in input_paths]
+    dataset = [str(store_dir), 'mysql://user@localhost/db']
+    period = [
+        '--counts-period-start', '2012-01-01',
+        '--counts-period-end', '2012-01-02T23:00',
+    ]
+    single_dir = tmp_path / 'single'
+    add_counts_to_csv.main(inputs + dataset + [str(single_dir)] + period)
+
+    work_dir = tmp_path / 'work'
+    main(['plan', str(work_dir)] + inputs + ['--shards', '5'])
+    main(['work', str(work_dir)] + dataset + period + ['-j', '2'])
+    assert set(status(work_dir)) == {'done'}
+    merged_dir = tmp_path / 'merged'
+    main(['merge', str(work_dir), str(merged_dir)])
+
+    for input_path in input_paths:
+        single = (single_dir / input_path.name).read_text(encoding='utf-8')
+        merged = (merged_dir / input_path.name).read_text(encoding='utf-8')
+        assert len(single.splitlines()) == 60
+        assert any(float(row[-1]) for row in csv.reader(single.splitlines()))
+        assert merged == single
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,270 @@
+import collections
+import datetime
+import hashlib
+import queue
+import threading
+import time
+
+create_table = '''
+CREATE TABLE IF NOT EXISTS `identifiershistory_counts` (
+  `history_key` BINARY(16) NOT NULL,
+  `project` VARCHAR(50) NOT NULL,
+  `page_id` INT NOT NULL,
+  `page_title` VARCHAR(255) NOT NULL,
+  `identifier_type` VARCHAR(20) NOT NULL,
+  `identifier_id` VARBINARY(255) NOT NULL,
+  `start_date` DATETIME NULL,
+  `end_date` DATETIME NULL,
+  `views` DOUBLE NOT NULL,
+  `counts_period_start` DATETIME NOT NULL,
+  `counts_period_end` DATETIME NOT NULL,
+  PRIMARY KEY (`history_key`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+'''
+
+# Re-running over the same records replaces their views and counts period
+upsert_tpl = '''
+INSERT INTO `identifiershistory_counts` (
+    `history_key`,
+    `project`,
+    `page_id`,
+    `page_title`,
+    `identifier_type`,
+    `identifier_id`,
+    `start_date`,
+    `end_date`,
+    `views`,
+    `counts_period_start`,
+    `counts_period_end`
+) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+ON DUPLICATE KEY UPDATE
+    `page_title` = VALUES(`page_title`),
+    `views` = VALUES(`views`),
+    `counts_period_start` = VALUES(`counts_period_start`),
+    `counts_period_end` = VALUES(`counts_period_end`)
+'''
+
+SinkStats = collections.namedtuple(
+    'SinkStats',
+    'rows batches affected write_seconds',
+)
+
+
+def to_utc_naive(timestamp):
+    # DATETIME columns have no time zone; dates are stored in UTC
+    if timestamp is None or timestamp.tzinfo is None:
+        return timestamp
+    return timestamp.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def history_key(record):
+    # Digest of what identifies an identifier history entry (the unique
+    # index of models.IdentifiersHistory): the page, by project and id,
+    # the identifier and the interval. Titles change with page moves and
+    # are left out.
+    start_date = to_utc_naive(record.start_date)
+    end_date = to_utc_naive(record.end_date)
+    fields = (
+        record.project,
+        str(record.page_id),
+        record.identifier_type,
+        record.identifier_id,
+        start_date.isoformat() if start_date is not None else '',
+        end_date.isoformat() if end_date is not None else '',
+    )
+    return hashlib.md5('\x1f'.join(fields).encode('utf-8')).digest()
+
+
+def sink_row(record, period_start, period_end):
+    return (
+        history_key(record),
+        record.project,
+        record.page_id,
+        record.page_title[:255],
+        record.identifier_type[:20],
+        record.identifier_id[:255],
+        to_utc_naive(record.start_date),
+        to_utc_naive(record.end_date),
+        record.views,
+        period_start,
+        period_end,
+    )
+
+
+def create_tables(connection):
+    with connection.cursor() as cursor:
+        cursor.execute(create_table)
+    connection.commit()
+
+
+class CountsSink:
+    # Upserts output records into `identifiershistory_counts`. Rows are
+    # gathered in batches of `batch_size` that a background thread writes,
+    # one transaction each, so that the database round trips overlap with
+    # the counting. The bounded queue applies backpressure when the
+    # database is slower.
+    def __init__(self, connection, period_start, period_end,
+                 batch_size=10000, max_pending=4):
+        self.connection = connection
+        self.period_start = to_utc_naive(period_start)
+        self.period_end = to_utc_naive(period_end)
+        self.batch_size = batch_size
+        self._batch = []
+        self._queue = queue.Queue(max_pending)
+        self._error = None
+        self._closed = False
+        self._rows = self._batches = self._affected = 0
+        self._write_seconds = 0.0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                break
+            if self._error is not None:
+                continue
+            tic = time.perf_counter()
+            try:
+                with self.connection.cursor() as cursor:
+                    affected = cursor.executemany(upsert_tpl, batch)
+                self.connection.commit()
+            except BaseException as e:
+                self._error = e
+                continue
+            self._write_seconds += time.perf_counter() - tic
+            self._rows += len(batch)
+            self._batches += 1
+            self._affected += affected or 0
+
+    def write(self, record):
+        self._batch.append(
+            sink_row(record, self.period_start, self.period_end))
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self._error is not None:
+            raise self._error
+        if self._batch:
+            self._queue.put(self._batch)
+            self._batch = []
+
+    def close(self):
+        # Writes the last batch and waits for all of them to be committed
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self.flush()
+        finally:
+            self._queue.put(None)
+            self._thread.join()
+            self.connection.close()
+        if self._error is not None:
+            raise self._error
+
+    def stats(self):
+        return SinkStats(
+            self._rows, self._batches, self._affected, self._write_seconds)
+
+
+def test_history_key():
+    Record = collections.namedtuple(
+        'Record',
+        'project page_id page_title identifier_type identifier_id '
+        'start_date end_date',
+    )
+    utc = datetime.timezone.utc
+    record = Record(
+        'en', 12, 'Title', 'doi', '10.1000/1',
+        datetime.datetime(2015, 1, 1, tzinfo=utc), None,
+    )
+    assert history_key(record) == history_key(
+        record._replace(page_title='Moved title'))
+    assert history_key(record) == history_key(record._replace(
+        start_date=datetime.datetime(
+            2015, 1, 1, 1,
+            tzinfo=datetime.timezone(datetime.timedelta(hours=1)))))
+    assert history_key(record) != history_key(
+        record._replace(end_date=datetime.datetime(2016, 1, 1)))
+    assert history_key(record) != history_key(record._replace(page_id=13))
+
+
+def test_counts_sink():
+    class Cursor:
+        def __init__(self, connection):
+            self.connection = connection
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            pass
+
+        def executemany(self, query, rows):
+            if len(self.connection.batches) == self.connection.fail_at:
+                raise RuntimeError('write failed')
+            self.connection.batches.append(rows)
+            return len(rows)
+
+    class Connection:
+        def __init__(self, fail_at=None):
+            self.fail_at = fail_at
+            self.batches = []
+            self.commits = 0
+            self.closed = False
+
+        def cursor(self):
+            return Cursor(self)
+
+        def commit(self):
+            self.commits += 1
+
+        def close(self):
+            self.closed = True
+
+    Record = collections.namedtuple(
+        'Record',
+        'project page_id page_title identifier_type identifier_id '
+        'start_date end_date views',
+    )
+    records = [
+        Record('en', i, 'Title', 'doi', '10.1000/{}'.format(i), None, None, i)
+        for i in range(5)
+    ]
+    period_start = datetime.datetime(2015, 1, 1)
+    period_end = datetime.datetime(2016, 1, 1)
+
+    connection = Connection()
+    sink = CountsSink(connection, period_start, period_end, batch_size=2)
+    for record in records:
+        sink.write(record)
+    sink.close()
+    sink.close()
+    assert [len(b) for b in connection.batches] == [2, 2, 1]
+    assert [row[8] for b in connection.batches for row in b] == \
+        list(range(5))
+    assert connection.commits == 3 and connection.closed
+    assert sink.stats() == SinkStats(5, 3, 5, sink.stats().write_seconds)
+    assert not sink._thread.is_alive()
+
+    connection = Connection(fail_at=1)
+    sink = CountsSink(connection, period_start, period_end, batch_size=2)
+    try:
+        for record in records:
+            sink.write(record)
+        sink.close()
+    except RuntimeError as e:
+        assert str(e) == 'write failed'
+    else:
+        assert False, 'the write error was not raised'
+    # An error raised by write() leaves closing to the caller
+    try:
+        sink.close()
+    except RuntimeError:
+        pass
+    assert connection.closed
+    assert not sink._thread.is_alive()
+    assert [len(b) for b in connection.batches] == [2]
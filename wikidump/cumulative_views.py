@@ -0,0 +1,197 @@
+import numpy
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+# Below this ratio of non-zero samples a page is stored sparsely: a sparse
+# sample costs 12 bytes, a dense one about 4.
+SPARSE_FILL_RATIO = 0.25
+
+
+class Series:
+    # Subclasses provide base, step, last, total, cumulative(i) and
+    # sample_views(i). A series is entirely defined by its SCALARS and
+    # ARRAYS attributes, see parts and from_parts.
+    SCALARS = ('base', 'step', 'last', 'first_value', 'total')
+    ARRAYS = ()
+
+    def parts(self):
+        return (
+            {name: getattr(self, name) for name in self.SCALARS},
+            {name: getattr(self, name) for name in self.ARRAYS},
+        )
+
+    @classmethod
+    def from_parts(cls, scalars, arrays):
+        # Rebuilds a series around existing arrays, without copying them
+        series = cls.__new__(cls)
+        series.__dict__.update(scalars)
+        series.__dict__.update(arrays)
+        return series
+
+    def __call__(self, x):
+        # Cumulative views at unix time x, linearly interpolated between
+        # samples.
+        if x < self.base:
+            return 0.0
+        if x >= self.last:
+            return self.total
+
+        i, offset = divmod(x - self.base, self.step)
+        value = self.cumulative(i)
+        if offset:
+            value += self.sample_views(i + 1) * offset / self.step
+        return float(value)
+
+
+class RollupSeries(Series):
+    # Cumulative views of a page sampled every `step` seconds from `base`:
+    # the value at sample i is the sum of the views of samples 0..i.
+    # Instead of one cumulative value per sample, it keeps the per-sample
+    # views plus daily totals and monthly cumulative totals (UTC), so any
+    # sample's cumulative value costs a month of daily adds and a day of
+    # per-sample adds at most, while staying exact at the sample.
+    #
+    # The per-sample views are kept in full: interpolating within a sample
+    # needs its views, and queries fall anywhere. They are stored in the
+    # narrowest integer type that holds them, 2 bytes per sample for most
+    # pages against 16 for the timestamps and cumulative views of a dense
+    # interp1d grid. The rollups add half a byte per hourly sample.
+    KIND = 'rollup'
+    ARRAYS = ('views', 'day_starts', 'daily', 'month_starts', 'monthly_acc')
+
+    def __init__(self, base, step, views):
+        self.base = base
+        self.step = step
+        self.views = views
+        self.last = base + (len(views) - 1) * step
+
+        times = base + numpy.arange(len(views), dtype=numpy.int64) * step
+        days = times // SECONDS_PER_DAY
+        self.day_starts = numpy.concatenate((
+            [0],
+            numpy.flatnonzero(numpy.diff(days)) + 1,
+        )).astype(numpy.int32)
+        self.daily = numpy.add.reduceat(
+            views, self.day_starts, dtype=numpy.int64)
+
+        months = (
+            times[self.day_starts]
+            .astype('datetime64[s]')
+            .astype('datetime64[M]')
+            .astype(numpy.int64)
+        )
+        self.month_starts = numpy.concatenate((
+            [0],
+            numpy.flatnonzero(numpy.diff(months)) + 1,
+        )).astype(numpy.int32)
+        self.monthly_acc = numpy.cumsum(
+            numpy.add.reduceat(self.daily, self.month_starts))
+
+        self.first_value = int(views[0])
+        self.total = int(self.monthly_acc[-1])
+
+    def cumulative(self, i):
+        day = int(numpy.searchsorted(self.day_starts, i, 'right')) - 1
+        month = int(numpy.searchsorted(self.month_starts, day, 'right')) - 1
+
+        acc = int(self.monthly_acc[month - 1]) if month > 0 else 0
+        acc += int(self.daily[self.month_starts[month]:day].sum())
+        acc += int(self.views[self.day_starts[day]:i + 1].sum())
+        return acc
+
+    def sample_views(self, i):
+        return int(self.views[i])
+
+    def nbytes(self):
+        return sum(a.nbytes for a in (
+            self.views,
+            self.day_starts,
+            self.daily,
+            self.month_starts,
+            self.monthly_acc,
+        ))
+
+
+class SparseSeries(Series):
+    # Only the non-zero samples of a page, as sorted sample indices and the
+    # cumulative views up to each of them. Lookups are binary searches.
+    KIND = 'sparse'
+    ARRAYS = ('indices', 'acc')
+
+    def __init__(self, base, step, indices, views):
+        self.base = base
+        self.step = step
+        self.indices = indices
+        self.acc = numpy.cumsum(views, dtype=numpy.int64)
+        self.last = base + int(indices[-1]) * step
+
+        self.first_value = int(self.acc[0]) if indices[0] == 0 else 0
+        self.total = int(self.acc[-1])
+
+    def cumulative(self, i):
+        j = int(numpy.searchsorted(self.indices, i, 'right')) - 1
+        return int(self.acc[j]) if j >= 0 else 0
+
+    def sample_views(self, i):
+        j = int(numpy.searchsorted(self.indices, i))
+        if j == len(self.indices) or self.indices[j] != i:
+            return 0
+        if j == 0:
+            return int(self.acc[0])
+        return int(self.acc[j] - self.acc[j - 1])
+
+    def nbytes(self):
+        return self.indices.nbytes + self.acc.nbytes
+
+
+SERIES_KINDS = {cls.KIND: cls for cls in (RollupSeries, SparseSeries)}
+
+
+def search_result_arrays(result):
+    # pagecountssearch.Finder results as int64 arrays of unix timestamps
+    # and views
+    timestamps = numpy.fromiter(
+        (int(ts.timestamp()) for ts, _, _ in result),
+        numpy.int64,
+        len(result),
+    )
+    views = numpy.fromiter(
+        (v for _, v, _ in result),
+        numpy.int64,
+        len(result),
+    )
+    return timestamps, views
+
+
+def from_search_result(result, granularity,
+                       sparse_fill_ratio=SPARSE_FILL_RATIO):
+    timestamps, views = search_result_arrays(result)
+    return from_arrays(timestamps, views, granularity, sparse_fill_ratio)
+
+
+def from_arrays(timestamps, views, granularity,
+                sparse_fill_ratio=SPARSE_FILL_RATIO):
+    step = int(granularity.total_seconds())
+
+    # One empty sample before the first observation, like the grid
+    # the counts are interpolated on.
+    base = int(timestamps[0]) - step
+    indices = (timestamps - base) // step
+    n_samples = int(indices[-1]) + 1
+
+    # The last observation of a sample wins
+    keep = numpy.append(indices[1:] != indices[:-1], True)
+    indices = indices[keep]
+    views = views[keep]
+
+    if len(indices) < sparse_fill_ratio * n_samples:
+        return SparseSeries(
+            base, step, indices.astype(numpy.int32), views)
+
+    max_views = int(views.max())
+    for dtype in (numpy.uint16, numpy.int32, numpy.int64):
+        if max_views <= numpy.iinfo(dtype).max:
+            break
+    samples = numpy.zeros(n_samples, dtype=dtype)
+    samples[indices] = views
+    return RollupSeries(base, step, samples)
@@ -0,0 +1,103 @@
+import xml.etree.ElementTree
+import csv
+import argparse
+import pathlib
+
+import phpserialize
+
+from . import profiling
+from . import progress
+from . import utils
+
+
+# http://stackoverflow.com/questions/324214/what-is-the-fastest-way-to-parse-large-xml-docs-in-python/326541#326541
+def iter_elems(fileobj, tag):
+    it = xml.etree.ElementTree.iterparse(fileobj, events=('start', 'end'))
+    context = iter(it)
+    event, root = next(context)
+
+    for event, elem in context:
+        if event == 'start':
+            continue
+
+        if elem.tag == tag:
+            yield elem
+
+        root.clear()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'input_file',
+        type=pathlib.Path,
+        help='XML file containing page logs',
+    )
+    parser.add_argument(
+        '--output', '-o',
+        default='-',
+        help='Output CSV file, compressed according to its suffix '
+             '(.gz, .bz2, .zst). Default: stdout',
+    )
+    profiling.add_profile_arguments(parser)
+    progress.add_progress_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def get_redirect(params: str):
+    try:
+        params = phpserialize.loads(params.encode('utf-8'))
+        redirect = params[b'4::target'].decode('utf-8')
+        return redirect
+    except ValueError:
+        return params
+
+
+MEDIAWIKI_NS = '{http://www.mediawiki.org/xml/export-0.10/}'
+
+MOVE_ACTIONS = frozenset(['move', 'move_redir'])
+
+
+def iter_moves(input_file):
+    logitems = iter_elems(
+        input_file,
+        tag=MEDIAWIKI_NS + 'logitem',
+    )
+    for logitem in logitems:
+        action = logitem.find(MEDIAWIKI_NS + 'action')
+
+        if action.text not in MOVE_ACTIONS:
+            continue
+
+        params = logitem.find(MEDIAWIKI_NS + 'params')
+        logtitle = logitem.find(MEDIAWIKI_NS + 'logtitle')
+
+        if params is None or logtitle is None:
+            continue
+
+        redirect = get_redirect(params.text)
+        timestamp = logitem.find(MEDIAWIKI_NS + 'timestamp')
+
+        yield timestamp.text, logtitle.text, redirect
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    profiler = profiling.from_args(args)
+
+    input_file = utils.open_compressed_file(args.input_file)
+    reporter = progress.from_args(args, args.input_file, input_file)
+    input_file = profiler.wrap_file('decompress', input_file)
+    output_file = utils.open_output_file(args.output)
+
+    with input_file, output_file:
+        writer = csv.writer(output_file)
+        writer.writerow(('timestamp', 'from', 'to'))
+
+        moves = profiler.wrap_iter('parse', iter_moves(input_file))
+        with profiler.stage('write'):
+            for move in reporter.wrap_iter(moves):
+                writer.writerow(move)
+    reporter.close()
+
+if __name__ == '__main__':
+    main()
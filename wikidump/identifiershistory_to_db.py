@@ -4,14 +4,28 @@ import pathlib
 import functools
 import dateutil.parser
 import pymysql
-import ipdb
 
-import utils
+from . import profiling
+from . import progress
+from . import utils
 
 
 timestamp_parser_cached = functools.lru_cache(100000)(dateutil.parser.parse)
 
-def parse_args():
+insert_tpl = '''
+INSERT INTO `identifiershistory` (
+    `project`,
+    `page_id`,
+    `page_title`,
+    `identifier_type`,
+    `identifier_id`,
+    `start_date`,
+    `end_date`
+) VALUES (%s, %s, %s, %s, %s, %s, %s)
+'''
+
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument(
         'input_files',
@@ -29,7 +43,9 @@ def parse_args():
         default=False,
         required=False,
     )
-    return parser.parse_args()
+    profiling.add_profile_arguments(parser)
+    progress.add_progress_arguments(parser)
+    return parser.parse_args(argv)
 
 
 def create_tables_and_indexes(cursor):
@@ -48,22 +64,40 @@ CREATE TABLE IF NOT EXISTS `identifiershistory` (
     ''')
 
 
-def main():
-    args = parse_args()
+def insert_records(cursor, input_file, profiler=profiling.NULL_PROFILER,
+                   reporter=progress.NULL_REPORTER):
+    csvreader = csv.reader(profiler.wrap_iter('decompress', input_file))
+    records = profiler.wrap_iter(
+        'parse',
+        (utils.parse_identifier_history_record(r) for r in csvreader),
+    )
 
-    db_conn = pymysql.connect(**args.mysql_url)
+    records_truncated = (
+        (
+            r.project,
+            r.page_id,
+            r.page_title[:255],
+            r.identifier_type[:20],
+            r.identifier_id[:255],
+            r.start_date,
+            r.end_date,
+        )
+        for r in records
+    )
 
-    insert_tpl = '''
-    INSERT INTO `identifiershistory` (
-        `project`,
-        `page_id`,
-        `page_title`,
-        `identifier_type`,
-        `identifier_id`,
-        `start_date`,
-        `end_date`
-    ) VALUES (%s, %s, %s, %s, %s, %s, %s)
-    '''
+    with profiler.stage('write'):
+        cursor.executemany(
+            insert_tpl,
+            reporter.wrap_iter(
+                profiler.wrap_iter('transform', records_truncated)),
+        )
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    profiler = profiling.from_args(args)
+
+    db_conn = pymysql.connect(**args.mysql_url)
 
     if args.create_tables:
         print('Creating tables and indexes')
@@ -73,28 +107,11 @@ def main():
     for file_path in args.input_files:
         print('Reading', file_path, '...')
         input_file = utils.open_compressed_file(file_path)
+        reporter = progress.from_args(args, file_path, input_file)
         cursor = db_conn.cursor()
         with input_file, cursor:
-            csvreader = csv.reader(input_file)
-            records = (
-                utils.parse_identifier_history_record(r)
-                for r in csvreader
-            )
-
-            records_truncated = (
-                (
-                    r.project,
-                    r.page_id,
-                    r.page_title[:255],
-                    r.identifier_type[:20],
-                    r.identifier_id[:255],
-                    r.start_date,
-                    r.end_date,
-                )
-                for r in records
-            )
-
-            cursor.executemany(insert_tpl, records_truncated)
+            insert_records(cursor, input_file, profiler, reporter)
+        reporter.close()
     db_conn.commit()
 
 if __name__ == '__main__':
@@ -0,0 +1,74 @@
+import datetime
+import itertools
+
+
+def record_key(record):
+    # Records of the same identifier on the same page
+    return (
+        record.project,
+        record.page_id,
+        record.page_title,
+        record.identifier_type,
+        record.identifier_id,
+    )
+
+
+def iter_groups(records, key=record_key):
+    # Lists of consecutive records with the same key. Identifier-history
+    # files list a page's identifiers together, so this finds the
+    # mergeable intervals without holding the whole input in memory.
+    for _, group in itertools.groupby(records, key):
+        yield list(group)
+
+
+def _start_key(interval):
+    start, _ = interval
+    return (start is not None, start)
+
+
+def coalesce(intervals):
+    # Merge overlapping and adjacent (start, end) intervals; None is an
+    # open bound. Returns the merged intervals sorted by start.
+    merged = []
+    for start, end in sorted(intervals, key=_start_key):
+        if merged:
+            last_start, last_end = merged[-1]
+            if last_end is None:
+                continue
+            if start is None or start <= last_end:
+                if end is None or end > last_end:
+                    merged[-1] = (last_start, end)
+                continue
+        merged.append((start, end))
+    return merged
+
+
+def test_coalesce():
+    def day(d):
+        return datetime.datetime(2015, 1, d)
+
+    assert coalesce([]) == []
+    assert coalesce([(day(1), day(2))]) == [(day(1), day(2))]
+
+    # overlapping, adjacent and disjoint, in any order
+    assert coalesce([
+        (day(5), day(7)),
+        (day(1), day(3)),
+        (day(2), day(4)),
+        (day(4), day(5)),
+        (day(10), day(11)),
+    ]) == [(day(1), day(7)), (day(10), day(11))]
+
+    # contained
+    assert coalesce([(day(1), day(9)), (day(2), day(3))]) == [
+        (day(1), day(9)),
+    ]
+
+    # open bounds
+    assert coalesce([(None, day(2)), (day(1), day(3))]) == [(None, day(3))]
+    assert coalesce([(day(1), None), (day(5), day(6))]) == [(day(1), None)]
+    assert coalesce([(day(1), day(2)), (None, None)]) == [(None, None)]
+    assert coalesce([(None, day(1)), (day(2), None)]) == [
+        (None, day(1)),
+        (day(2), None),
+    ]
@@ -0,0 +1,426 @@
+import argparse
+import collections
+import http.server
+import json
+import os
+import pathlib
+import socket
+import socketserver
+import sqlite3
+import threading
+import urllib.parse
+
+from . import moves_shards
+
+# Keys per query of the batch lookups; older sqlite versions allow at most
+# 999 bound parameters per statement.
+BATCH_CHUNK = 500
+
+_MISSING = object()
+
+# Without ANALYZE statistics sqlite prefers scanning the covering primary
+# key (project, id, title) over the (project, title) index of pageids_to_db
+# for title lookups, so the index is named explicitly when it exists.
+TITLE_INDEX = 'title_asc'
+
+page_id_query = '''
+    SELECT id FROM Page{indexed_by} WHERE project = ? AND title = ?
+'''
+page_ids_query = '''
+    SELECT title, id FROM Page{indexed_by}
+    WHERE project = ? AND title IN ({placeholders})
+'''
+page_titles_query = '''
+    SELECT id, title FROM Page WHERE project = ? AND id IN ({placeholders})
+'''
+page_title_query = 'SELECT title FROM Page WHERE project = ? AND id = ?'
+moves_to_query = '''
+    SELECT timestamp, page_title_from, page_title_to FROM moves
+    WHERE project = ? AND page_title_to = ?
+    ORDER BY timestamp
+'''
+
+
+def connect_read_only(path, mmap_size):
+    connection = sqlite3.connect(
+        '{}?mode=ro'.format(pathlib.Path(path).resolve().as_uri()),
+        uri=True,
+        # Statements are prepared once per connection and reused from
+        # this cache
+        cached_statements=256,
+    )
+    connection.execute('PRAGMA query_only = ON')
+    connection.execute('PRAGMA mmap_size = {:d}'.format(mmap_size))
+    return connection
+
+
+def chunks(items, size=BATCH_CHUNK):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class LRUCache:
+    # Thread-safe; unlike functools.lru_cache it can be probed without
+    # computing the missing values, which the batch lookups need.
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key, _MISSING)
+            if value is _MISSING:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def info(self):
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            entries=len(self._entries),
+            max_entries=self.max_entries,
+        )
+
+
+class Lookup:
+    # Read-only lookups over the Page database (pageids_to_db) and the
+    # moves database (moves_csv_to_sqlite, or a moves_shards directory).
+    # Each thread gets its own connections; page id and title lookups,
+    # misses included, go through shared LRU caches.
+    def __init__(self, pages_db=None, moves_db=None, cache_size=100000,
+                 mmap_size=256 << 20):
+        self.pages_db = pages_db
+        self.moves_db = moves_db
+        self.mmap_size = mmap_size
+        self.page_id_cache = LRUCache(cache_size)
+        self.page_title_cache = LRUCache(cache_size)
+        self._local = threading.local()
+
+    def _pages(self):
+        connection = getattr(self._local, 'pages', None)
+        if connection is None:
+            if self.pages_db is None:
+                raise ValueError('no pages database')
+            connection = self._local.pages = connect_read_only(
+                self.pages_db, self.mmap_size)
+            has_title_index = connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?",
+                (TITLE_INDEX,),
+            ).fetchone()
+            self._local.indexed_by = (
+                ' INDEXED BY ' + TITLE_INDEX if has_title_index else '')
+        return connection
+
+    def _moves(self):
+        moves = getattr(self._local, 'moves', None)
+        if moves is None:
+            if self.moves_db is None:
+                raise ValueError('no moves database')
+            if moves_shards.read_manifest(self.moves_db) is not None:
+                moves = moves_shards.ShardedMoves(self.moves_db)
+            else:
+                moves = connect_read_only(self.moves_db, self.mmap_size)
+            self._local.moves = moves
+        return moves
+
+    def page_id(self, project, title):
+        page_id = self.page_id_cache.get((project, title))
+        if page_id is _MISSING:
+            pages = self._pages()
+            row = pages.execute(
+                page_id_query.format(indexed_by=self._local.indexed_by),
+                (project, title),
+            ).fetchone()
+            page_id = row[0] if row is not None else None
+            self.page_id_cache.put((project, title), page_id)
+        return page_id
+
+    def page_title(self, project, page_id):
+        page_id = int(page_id)
+        title = self.page_title_cache.get((project, page_id))
+        if title is _MISSING:
+            row = self._pages().execute(
+                page_title_query, (project, page_id)).fetchone()
+            title = row[0] if row is not None else None
+            self.page_title_cache.put((project, page_id), title)
+        return title
+
+    def _batch(self, cache, query, project, keys):
+        # Answer what the cache knows, fetch the rest with a few IN queries
+        pages = self._pages()
+        result = {}
+        missing = []
+        for key in dict.fromkeys(keys):
+            value = cache.get((project, key))
+            if value is _MISSING:
+                missing.append(key)
+            else:
+                result[key] = value
+
+        for chunk in chunks(missing):
+            found = dict.fromkeys(chunk)
+            found.update(pages.execute(
+                query.format(
+                    indexed_by=self._local.indexed_by,
+                    placeholders=', '.join('?' * len(chunk)),
+                ),
+                [project] + chunk,
+            ))
+            for key, value in found.items():
+                cache.put((project, key), value)
+            result.update(found)
+        return result
+
+    def page_ids(self, project, titles):
+        # {title: page id, or None if unknown}
+        return self._batch(
+            self.page_id_cache,
+            page_ids_query,
+            project,
+            titles,
+        )
+
+    def page_titles(self, project, page_ids):
+        # {page id: title, or None if unknown}
+        return self._batch(
+            self.page_title_cache,
+            page_titles_query,
+            project,
+            [int(i) for i in page_ids],
+        )
+
+    def moves_to(self, project, title):
+        # Moves whose destination is `title`, as (timestamp, from, to)
+        moves = self._moves()
+        if isinstance(moves, moves_shards.ShardedMoves):
+            return [
+                (timestamp, from_, to)
+                for timestamp, _, from_, to in moves.moves_to(project, title)
+            ]
+        return moves.execute(moves_to_query, (project, title)).fetchall()
+
+    def moves_to_many(self, project, titles):
+        return {title: self.moves_to(project, title) for title in titles}
+
+    def stats(self):
+        return dict(
+            page_id_cache=self.page_id_cache.info(),
+            page_title_cache=self.page_title_cache.info(),
+        )
+
+
+class LookupHandler(http.server.BaseHTTPRequestHandler):
+    # GET  /page_id?project=&title=       -> {"page_id": ...}
+    # GET  /page_title?project=&page_id=  -> {"title": ...}
+    # GET  /moves?project=&title=         -> {"moves": [[ts, from, to]]}
+    # POST /page_ids    {"project", "titles": [...]}   -> {"page_ids": {}}
+    # POST /page_titles {"project", "page_ids": [...]} -> {"titles": {}}
+    # POST /moves       {"project", "titles": [...]}   -> {"moves": {}}
+    # GET  /stats
+    protocol_version = 'HTTP/1.1'
+    lookup = None
+    quiet = True
+
+    def setup(self):
+        super().setup()
+        # Headers and body are separate writes: without TCP_NODELAY,
+        # Nagle's algorithm and delayed ACKs add ~40ms per request.
+        if self.connection.family in (socket.AF_INET, socket.AF_INET6):
+            self.connection.setsockopt(
+                socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _dispatch(self, handler, *args):
+        try:
+            body = handler(*args)
+        except KeyError as e:
+            self._send(400, dict(error='missing {}'.format(e.args[0])))
+            return
+        except (TypeError, ValueError) as e:
+            self._send(400, dict(error=str(e)))
+            return
+        except sqlite3.Error as e:
+            self._send(500, dict(error='database error: {}'.format(e)))
+            return
+        if body is None:
+            self._send(404, dict(error='unknown endpoint'))
+        else:
+            self._send(200, body)
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        self._dispatch(self.get, url.path, params)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        url = urllib.parse.urlsplit(self.path)
+        try:
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+        except ValueError:
+            self._send(400, dict(error='invalid JSON'))
+            return
+        self._dispatch(self.post, url.path, request)
+
+    def get(self, path, params):
+        lookup = self.lookup
+        if path == '/page_id':
+            return dict(page_id=lookup.page_id(
+                params['project'], params['title']))
+        if path == '/page_title':
+            return dict(title=lookup.page_title(
+                params['project'], params['page_id']))
+        if path == '/moves':
+            return dict(moves=lookup.moves_to(
+                params['project'], params['title']))
+        if path == '/stats':
+            return lookup.stats()
+        return None
+
+    def post(self, path, request):
+        lookup = self.lookup
+        if path == '/page_ids':
+            return dict(page_ids=lookup.page_ids(
+                request['project'], request['titles']))
+        if path == '/page_titles':
+            titles = lookup.page_titles(
+                request['project'], request['page_ids'])
+            return dict(titles={str(k): v for k, v in titles.items()})
+        if path == '/moves':
+            return dict(moves=lookup.moves_to_many(
+                request['project'], request['titles']))
+        return None
+
+    def address_string(self):
+        # Unix socket peers have no address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+    def log_message(self, format, *args):
+        if not self.quiet:
+            super().log_message(format, *args)
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn,
+                              socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(lookup, host='127.0.0.1', port=8080, unix_socket=None,
+                quiet=True):
+    handler = type('Handler', (LookupHandler,), dict(
+        lookup=lookup,
+        quiet=quiet,
+    ))
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.unlink(unix_socket)
+        return ThreadingUnixHTTPServer(unix_socket, handler)
+    return http.server.ThreadingHTTPServer((host, port), handler)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Serve read-only page id, title and moves lookups over '
+                    'HTTP, on a TCP port or a unix socket.',
+    )
+    parser.add_argument(
+        '--pages-db',
+        type=pathlib.Path,
+        default=None,
+        help='Page sqlite database (see pageids_to_db.py)',
+    )
+    parser.add_argument(
+        '--moves-db',
+        type=pathlib.Path,
+        default=None,
+        help='Moves sqlite database (see moves_csv_to_sqlite.py), or a '
+             'sharded moves directory (see moves_shards.py)',
+    )
+    parser.add_argument(
+        '--host',
+        default='127.0.0.1',
+    )
+    parser.add_argument(
+        '--port',
+        type=int,
+        default=8080,
+    )
+    parser.add_argument(
+        '--unix-socket',
+        default=None,
+        help='Listen on this unix socket instead of a TCP port',
+    )
+    parser.add_argument(
+        '--cache-size',
+        type=int,
+        default=100000,
+        help='Entries of each of the page id and title caches '
+             '(default: %(default)s)',
+    )
+    parser.add_argument(
+        '--mmap-size',
+        type=int,
+        default=256,
+        help='sqlite mmap size per connection, in MiB (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--verbose', '-v',
+        action='store_true',
+        help='Log every request',
+    )
+    args = parser.parse_args(argv)
+    if args.pages_db is None and args.moves_db is None:
+        parser.error('at least one of --pages-db and --moves-db is required')
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    lookup = Lookup(
+        pages_db=args.pages_db,
+        moves_db=args.moves_db,
+        cache_size=args.cache_size,
+        mmap_size=args.mmap_size << 20,
+    )
+    server = make_server(
+        lookup,
+        host=args.host,
+        port=args.port,
+        unix_socket=args.unix_socket,
+        quiet=not args.verbose,
+    )
+    print('Serving on', args.unix_socket or '{}:{}'.format(
+        *server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
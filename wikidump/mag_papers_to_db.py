@@ -0,0 +1,474 @@
+import csv
+import argparse
+import pathlib
+import functools
+import dateutil.parser
+import pymysql
+import collections
+import concurrent.futures
+import datetime
+import itertools
+import mmap
+
+from . import profiling
+from . import progress
+from . import utils
+
+PapersRecord = collections.namedtuple(
+    'PapersRecord',
+    (
+        'paper_id',
+        'original_paper_title',
+        'normalized_paper_title',
+        'paper_publish_year',
+        'paper_publish_date',
+        'paper_doi',
+        'original_venue_name',
+        'normalized_venue_name',
+        'journal_id_mapped_to_venue_name',
+        'converence_series_id_mapped_to_venue_name',
+        'paper_rank',
+    ),
+)
+
+UpsertStats = collections.namedtuple(
+    'UpsertStats',
+    'read duplicates inserted updated unchanged',
+)
+
+PAPERS_COLUMNS = (
+    'paper_id',
+    'original_paper_title',
+    'normalized_paper_title',
+    'paper_publish_year',
+    'paper_publish_date',
+    'paper_doi',
+    'original_venue_name',
+    'normalized_venue_name',
+    'journal_id_mapped_to_venue_name',
+    'conference_series_id_mapped_to_venue_name',
+    'paper_rank',
+)
+
+
+@functools.lru_cache(1000)
+def parse_date(date):
+    values = date.split('/')
+
+    if len(values) < 3:
+        return None
+
+    try:
+        return datetime.date(*map(int, values))
+    except ValueError as e:
+        print('Warning: parse_date ', date, 'error', e)
+        return None
+
+
+def parse_papers_record(raw_record):
+    (
+        paper_id,
+        original_paper_title,
+        normalized_paper_title,
+        paper_publish_year,
+        paper_publish_date,
+        paper_doi,
+        original_venue_name,
+        normalized_venue_name,
+        journal_id_mapped_to_venue_name,
+        converence_series_id_mapped_to_venue_name,
+        paper_rank,
+    ) = raw_record
+
+    if not paper_publish_year:
+        paper_publish_year = None
+    else:
+        paper_publish_year = int(paper_publish_year)
+
+    if not paper_publish_date:
+        paper_publish_date = None
+    else:
+        paper_publish_date = parse_date(paper_publish_date)
+
+    return PapersRecord(
+        paper_id,
+        original_paper_title,
+        normalized_paper_title,
+        paper_publish_year,
+        paper_publish_date,
+        paper_doi,
+        original_venue_name,
+        normalized_venue_name,
+        journal_id_mapped_to_venue_name,
+        converence_series_id_mapped_to_venue_name,
+        paper_rank,
+    )
+
+
+def truncate_papers_record(r):
+    return (
+        r.paper_id[:50],
+        r.original_paper_title[:255],
+        r.normalized_paper_title[:255],
+        r.paper_publish_year,
+        r.paper_publish_date,
+        r.paper_doi[:255],
+        r.original_venue_name[:255],
+        r.normalized_venue_name[:255],
+        r.journal_id_mapped_to_venue_name[:255],
+        r.converence_series_id_mapped_to_venue_name[:255],
+        r.paper_rank,
+    )
+
+
+def split_chunks(buffer, chunk_size):
+    # Yield (start, end) offsets of chunks of about chunk_size bytes,
+    # each ending right after a newline (or at the end of the buffer).
+    size = len(buffer)
+    start = 0
+    while start < size:
+        end = start + chunk_size
+        if end >= size:
+            end = size
+        else:
+            newline = buffer.find(b'\n', end - 1)
+            end = size if newline == -1 else newline + 1
+        yield start, end
+        start = end
+
+
+_worker_mmap = None
+
+
+def _init_chunk_worker(file_path):
+    global _worker_mmap
+    with open(file_path, 'rb') as f:
+        _worker_mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def parse_chunk(chunk):
+    start, end = chunk
+    text = _worker_mmap[start:end].decode('utf-8')
+    lines = text.split('\n')
+    if not lines[-1]:
+        lines.pop()
+    return [
+        truncate_papers_record(
+            parse_papers_record(line.rstrip('\r').split('\t'))
+        )
+        for line in lines
+    ]
+
+
+insert_tpl = '''
+INSERT INTO `mag_papers` (
+    `paper_id`,
+    `original_paper_title`,
+    `normalized_paper_title`,
+    `paper_publish_year`,
+    `paper_publish_date`,
+    `paper_doi`,
+    `original_venue_name`,
+    `normalized_venue_name`,
+    `journal_id_mapped_to_venue_name`,
+    `conference_series_id_mapped_to_venue_name`,
+    `paper_rank`
+) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+'''
+
+staging_insert_tpl = insert_tpl.replace('`mag_papers`', '`mag_papers_staging`')
+
+# Only touch rows whose content differs from the staged one.
+staging_update_tpl = '''
+UPDATE `mag_papers` AS p JOIN `mag_papers_staging` AS s USING (`paper_id`)
+SET {assignments}
+WHERE NOT ({unchanged})
+'''.format(
+    assignments=', '.join(
+        'p.`{0}` = s.`{0}`'.format(c) for c in PAPERS_COLUMNS[1:]),
+    unchanged=' AND '.join(
+        'p.`{0}` <=> s.`{0}`'.format(c) for c in PAPERS_COLUMNS[1:]),
+)
+
+staging_insert_new_tpl = '''
+INSERT INTO `mag_papers`
+SELECT s.* FROM `mag_papers_staging` AS s
+LEFT JOIN `mag_papers` AS p USING (`paper_id`)
+WHERE p.`paper_id` IS NULL
+'''
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'input_csv',
+        type=pathlib.Path,
+    )
+    parser.add_argument(
+        'mysql_url',
+        type=utils.parse_mysql_url,
+        help='MYSQL Database URL',
+    )
+    parser.add_argument(
+        '--create-tables', '-c',
+        action='store_true',
+        default=False,
+        required=False,
+    )
+    parser.add_argument(
+        '--expected-records',
+        type=int,
+        required=False,
+        default=None,
+        # Progress is now measured on the input size; kept so that
+        # existing invocations still parse.
+        help=argparse.SUPPRESS,
+    )
+    parser.add_argument(
+        '--workers', '-j',
+        type=int,
+        default=1,
+        help='Parse the input in this many processes. '
+             'Requires an uncompressed input file, which is memory-mapped',
+    )
+    parser.add_argument(
+        '--chunk-size',
+        type=int,
+        default=16,
+        help='Size in MiB of the chunks parsed by each worker '
+             '(default: %(default)s)',
+    )
+    parser.add_argument(
+        '--upsert',
+        action='store_true',
+        default=False,
+        help='Insert new papers and update changed ones instead of failing '
+             'on existing ids. Duplicated ids in the input are skipped',
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=50000,
+        help='Rows merged per transaction in --upsert mode '
+             '(default: %(default)s)',
+    )
+    profiling.add_profile_arguments(parser)
+    progress.add_progress_arguments(parser)
+    args = parser.parse_args(argv)
+
+    if args.workers > 1 and args.input_csv.suffix in utils.COMPRESSED_SUFFIXES:
+        parser.error('--workers requires an uncompressed input file')
+    return args
+
+
+def create_tables_and_indexes(cursor):
+    with cursor:
+        cursor.execute('''
+CREATE TABLE IF NOT EXISTS `mag_papers` (
+  `paper_id` varchar(50) NOT NULL,
+  `original_paper_title` varchar(255) DEFAULT NULL,
+  `normalized_paper_title` TEXT DEFAULT NULL,
+  `paper_publish_year` int(4) DEFAULT NULL,
+  `paper_publish_date` datetime DEFAULT NULL,
+  `paper_doi` varchar(255) DEFAULT NULL,
+  `original_venue_name` TEXT DEFAULT NULL,
+  `normalized_venue_name` TEXT DEFAULT NULL,
+  `journal_id_mapped_to_venue_name` varchar(255) DEFAULT NULL,
+  `conference_series_id_mapped_to_venue_name` varchar(255) DEFAULT NULL,
+  `paper_rank` int(11) DEFAULT NULL,
+  PRIMARY KEY (`paper_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+    ''')
+
+
+def iter_papers(input_file, profiler=profiling.NULL_PROFILER):
+    csvreader = csv.reader(
+        profiler.wrap_iter('decompress', input_file),
+        delimiter='\t',
+        quoting=csv.QUOTE_NONE,
+    )
+    records = profiler.wrap_iter(
+        'parse',
+        (parse_papers_record(r) for r in csvreader),
+    )
+
+    records_truncated = (truncate_papers_record(r) for r in records)
+
+    return profiler.wrap_iter('transform', records_truncated)
+
+
+def insert_papers(cursor, input_file, profiler=profiling.NULL_PROFILER,
+                  reporter=progress.NULL_REPORTER):
+    records = reporter.wrap_iter(iter_papers(input_file, profiler))
+    with profiler.stage('write'):
+        cursor.executemany(insert_tpl, records)
+
+
+def iter_parsed_chunks(file_path, workers, chunk_size,
+                       reporter=progress.NULL_REPORTER):
+    if pathlib.Path(file_path).stat().st_size == 0:
+        return
+
+    with open(str(file_path), 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        chunks = list(split_chunks(buffer, chunk_size))
+
+    executor = concurrent.futures.ProcessPoolExecutor(
+        workers,
+        initializer=_init_chunk_worker,
+        initargs=(str(file_path),),
+    )
+    # Keep a bounded number of parsed chunks in flight, so that a slow
+    # database applies backpressure instead of filling up memory.
+    max_pending = 2 * workers
+    with executor:
+        pending = collections.deque()
+        chunks = iter(chunks)
+        while True:
+            while len(pending) < max_pending:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                pending.append((chunk, executor.submit(parse_chunk, chunk)))
+
+            if not pending:
+                break
+            (_, end), future = pending.popleft()
+            batch = future.result()
+            reporter.update(len(batch), position=end)
+            yield batch
+
+
+def insert_papers_parallel(cursor, file_path, workers, chunk_size,
+                           profiler=profiling.NULL_PROFILER,
+                           reporter=progress.NULL_REPORTER):
+    batches = profiler.wrap_iter(
+        'parse',
+        iter_parsed_chunks(file_path, workers, chunk_size, reporter),
+    )
+    for batch in batches:
+        with profiler.stage('write'):
+            cursor.executemany(insert_tpl, batch)
+        profiler.add_rows('write', len(batch))
+
+
+def iter_batches(iterable, batch_size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def merge_staged_batch(connection, rows):
+    with connection.cursor() as cursor:
+        cursor.execute('DELETE FROM `mag_papers_staging`')
+        cursor.executemany(staging_insert_tpl, rows)
+        updated = cursor.execute(staging_update_tpl)
+        inserted = cursor.execute(staging_insert_new_tpl)
+    connection.commit()
+    return inserted, updated
+
+
+def upsert_papers(connection, batches, profiler=profiling.NULL_PROFILER):
+    with connection.cursor() as cursor:
+        cursor.execute('''
+        CREATE TEMPORARY TABLE IF NOT EXISTS `mag_papers_staging`
+        LIKE `mag_papers`
+        ''')
+
+    seen_ids = utils.SeenKeys()
+    read = duplicates = inserted = updated = 0
+    for batch in batches:
+        rows = []
+        for row in batch:
+            if seen_ids.add(row[0]):
+                rows.append(row)
+            else:
+                duplicates += 1
+        read += len(batch)
+
+        if rows:
+            with profiler.stage('write'):
+                batch_inserted, batch_updated = merge_staged_batch(
+                    connection, rows)
+            profiler.add_rows('write', len(rows))
+            inserted += batch_inserted
+            updated += batch_updated
+
+    unchanged = read - duplicates - inserted - updated
+    return UpsertStats(read, duplicates, inserted, updated, unchanged)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    profiler = profiling.from_args(args)
+
+    db_conn = pymysql.connect(**args.mysql_url)
+
+    if args.create_tables:
+        print('Creating tables and indexes')
+        create_tables_and_indexes(db_conn.cursor())
+        db_conn.commit()
+
+    print('Reading', args.input_csv, '...')
+    if args.upsert:
+        if args.workers > 1:
+            reporter = progress.from_args(args, args.input_csv)
+            chunks = profiler.wrap_iter(
+                'parse',
+                iter_parsed_chunks(
+                    args.input_csv,
+                    args.workers,
+                    args.chunk_size * 1024 * 1024,
+                    reporter,
+                ),
+            )
+            # Chunks are sized in bytes: merge the rows in --batch-size
+            # transactions all the same
+            batches = iter_batches(
+                itertools.chain.from_iterable(chunks), args.batch_size)
+            stats = upsert_papers(db_conn, batches, profiler)
+        else:
+            input_file = utils.open_compressed_file(args.input_csv)
+            reporter = progress.from_args(args, args.input_csv, input_file)
+            with input_file:
+                records = reporter.wrap_iter(iter_papers(input_file, profiler))
+                batches = iter_batches(records, args.batch_size)
+                stats = upsert_papers(db_conn, batches, profiler)
+        reporter.close()
+
+        print('Rows read:', stats.read)
+        print('Duplicated ids skipped:', stats.duplicates)
+        print('Rows inserted:', stats.inserted)
+        print('Rows updated:', stats.updated)
+        print('Rows unchanged:', stats.unchanged)
+        print('Rows written:', stats.inserted + stats.updated)
+        return
+
+    if args.workers > 1:
+        reporter = progress.from_args(args, args.input_csv)
+        with db_conn.cursor() as cursor:
+            insert_papers_parallel(
+                cursor,
+                args.input_csv,
+                args.workers,
+                args.chunk_size * 1024 * 1024,
+                profiler,
+                reporter,
+            )
+        db_conn.commit()
+        reporter.close()
+        return
+
+    input_file = utils.open_compressed_file(args.input_csv)
+    reporter = progress.from_args(args, args.input_csv, input_file)
+    cursor = db_conn.cursor()
+    with input_file, cursor:
+        insert_papers(cursor, input_file, profiler, reporter)
+    db_conn.commit()
+    reporter.close()
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,3 @@
-import ipdb
 import argparse
 import collections
 import sqlite3
@@ -7,7 +6,9 @@ import functools
 import dateutil.parser
 import csv
 
-import utils
+from . import profiling
+from . import progress
+from . import utils
 
 Record = collections.namedtuple(
     'Record',
@@ -28,7 +29,7 @@ def parse_record(record):
 
     return Record(timestamp, from_, to)
 
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument(
         'input_file',
@@ -48,7 +49,9 @@ def parse_args():
         action='store_true',
         help='''Create indexes for fast access. This will cause the file to grow. Like a lot.''',
     )
-    return parser.parse_args()
+    profiling.add_profile_arguments(parser)
+    progress.add_progress_arguments(parser)
+    return parser.parse_args(argv)
 
 def create_tables(connection):
     with connection:
@@ -68,16 +71,41 @@ def create_indexes(connection):
         connection.executescript('''
 CREATE INDEX IF NOT EXISTS timestamp_asc ON moves (timestamp ASC);
 
-CREATE INDEX IF NOT EXISTS project_page_title_to ON move (
+CREATE INDEX IF NOT EXISTS project_page_title_to ON moves (
     project ASC,
     page_title_to ASC
 );
 ''')
 
-def main():
-    args = parse_args()
+def insert_moves(connection, project, input_file,
+                 profiler=profiling.NULL_PROFILER,
+                 reporter=progress.NULL_REPORTER):
+    reader = csv.reader(profiler.wrap_iter('decompress', input_file))
+    assert next(reader) == ['timestamp', 'from', 'to']
+    records = profiler.wrap_iter(
+        'parse',
+        (parse_record(r) for r in reader),
+    )
+
+    db_records = profiler.wrap_iter(
+        'transform',
+        ((r.timestamp, project, r.from_, r.to) for r in records),
+    )
+    db_records = reporter.wrap_iter(db_records)
+
+    with profiler.stage('write'):
+        connection.executemany(
+            'INSERT INTO moves VALUES (?, ?, ?, ?)',
+            db_records,
+        )
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    profiler = profiling.from_args(args)
 
     input_file = utils.open_compressed_file(args.input_file)
+    reporter = progress.from_args(args, args.input_file, input_file)
     conn = sqlite3.connect(str(args.sqlite_file))
 
     create_tables(conn)
@@ -86,23 +114,12 @@ def main():
 
     print('Inserting data...')
     with input_file, conn:
-        reader = csv.reader(input_file)
-        assert next(reader) == ['timestamp', 'from', 'to']
-        records = (parse_record(r) for r in reader)
-
-        db_records = (
-            (r.timestamp, args.project, r.from_, r.to)
-            for r in records
-        )
-
-        conn.executemany(
-            'INSERT INTO moves VALUES (?, ?, ?, ?)',
-            db_records,
-        )
+        insert_moves(conn, args.project, input_file, profiler, reporter)
+    reporter.close()
 
-    print('Creating indexes...')
     if args.create_indexes:
-        create_indexes()
+        print('Creating indexes...')
+        create_indexes(conn)
 
 
 if __name__ == '__main__':
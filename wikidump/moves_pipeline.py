@@ -0,0 +1,181 @@
+import argparse
+import datetime
+import itertools
+import pathlib
+import queue
+import sqlite3
+import threading
+
+from . import extract_moves
+from . import moves_csv_to_sqlite
+from . import profiling
+from . import progress
+from . import utils
+
+MEDIAWIKI_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+_DONE = object()
+
+
+def parse_timestamp(timestamp: str):
+    # Dump timestamps are always UTC in MediaWiki's format; the result is
+    # equal to what moves_csv_to_sqlite gets from dateutil, and is stored
+    # identically by sqlite3.
+    try:
+        return datetime.datetime.strptime(
+            timestamp, MEDIAWIKI_TIMESTAMP_FORMAT,
+        ).replace(tzinfo=datetime.timezone.utc)
+    except ValueError:
+        return moves_csv_to_sqlite.parse_timestamp(timestamp)
+
+
+def iter_move_rows(input_file, project):
+    for timestamp, from_, to in extract_moves.iter_moves(input_file):
+        yield parse_timestamp(timestamp), project, from_, to
+
+
+class BatchProducer(threading.Thread):
+    # Runs `iterable` on its own thread and hands its items over in
+    # batches through a bounded queue: when the consumer falls behind the
+    # producer blocks instead of buffering the whole input.
+    def __init__(self, iterable, batch_size=10000, max_batches=8):
+        super().__init__(daemon=True)
+        self.iterable = iterable
+        self.batch_size = batch_size
+        self.queue = queue.Queue(max_batches)
+        self.error = None
+        self._stopped = threading.Event()
+
+    def run(self):
+        try:
+            iterator = iter(self.iterable)
+            while not self._stopped.is_set():
+                batch = list(itertools.islice(iterator, self.batch_size))
+                if not batch:
+                    break
+                self.queue.put(batch)
+        except BaseException as e:
+            self.error = e
+        finally:
+            self.queue.put(_DONE)
+
+    def stop(self):
+        # Unblock the producer if the consumer gives up early
+        self._stopped.set()
+        while self.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    def iter_batches(self, profiler=profiling.NULL_PROFILER):
+        self.start()
+        try:
+            while True:
+                with profiler.stage('wait'):
+                    batch = self.queue.get()
+                if batch is _DONE:
+                    break
+                yield batch
+        finally:
+            self.stop()
+        if self.error is not None:
+            raise self.error
+
+
+def load_moves(connection, project, input_file, batch_size=10000,
+               max_batches=8, profiler=profiling.NULL_PROFILER,
+               reporter=progress.NULL_REPORTER):
+    producer = BatchProducer(
+        iter_move_rows(input_file, project),
+        batch_size=batch_size,
+        max_batches=max_batches,
+    )
+    rows = 0
+    for batch in producer.iter_batches(profiler):
+        with profiler.stage('write'):
+            connection.executemany(
+                'INSERT INTO moves VALUES (?, ?, ?, ?)', batch)
+        profiler.add_rows('write', len(batch))
+        reporter.update(len(batch))
+        rows += len(batch)
+    return rows
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Extract page moves from a logging XML dump straight '
+                    'into a moves sqlite database, without the intermediate '
+                    'CSV file. The dump is parsed on a separate thread.',
+    )
+    parser.add_argument(
+        'input_file',
+        type=pathlib.Path,
+        help='XML file containing page logs',
+    )
+    parser.add_argument(
+        '--project',
+        required=True,
+        help='Project name',
+    )
+    parser.add_argument(
+        'sqlite_file',
+        help='Output sqlite file name',
+    )
+    parser.add_argument(
+        '--create-indexes',
+        action='store_true',
+        help='''Create indexes for fast access. This will cause the file to grow. Like a lot.''',
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=10000,
+        help='Moves per batch handed from the parser to the writer '
+             '(default: %(default)s)',
+    )
+    parser.add_argument(
+        '--queue-size',
+        type=int,
+        default=8,
+        help='Maximum number of parsed batches waiting to be written '
+             '(default: %(default)s)',
+    )
+    profiling.add_profile_arguments(parser)
+    progress.add_progress_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    profiler = profiling.from_args(args)
+
+    input_file = utils.open_compressed_file(args.input_file)
+    reporter = progress.from_args(args, args.input_file, input_file)
+    conn = sqlite3.connect(str(args.sqlite_file))
+
+    moves_csv_to_sqlite.create_tables(conn)
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.execute('PRAGMA journal_mode = MEMORY')
+
+    print('Inserting data...')
+    with input_file, conn:
+        rows = load_moves(
+            conn,
+            args.project,
+            input_file,
+            args.batch_size,
+            args.queue_size,
+            profiler,
+            reporter,
+        )
+    reporter.close()
+    print('Moves inserted:', rows)
+
+    if args.create_indexes:
+        print('Creating indexes...')
+        moves_csv_to_sqlite.create_indexes(conn)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,341 @@
+import argparse
+import collections
+import concurrent.futures
+import copy
+import csv
+import json
+import os
+import pathlib
+import sqlite3
+import tempfile
+import zlib
+
+from . import moves_csv_to_sqlite
+from . import profiling
+from . import progress
+from . import utils
+
+# A sharded moves database is a directory of sqlite files with the schema
+# of moves_csv_to_sqlite, one per project and title-hash bucket of
+# page_title_to, plus a manifest:
+#
+#     shards.json  {"buckets": N, "projects": {project: [file, ...]}}
+#
+# Every shard has a single writer, so shards load in parallel, and each
+# shard's index covers only a slice of the titles.
+MANIFEST = 'shards.json'
+
+# SQLite's default SQLITE_MAX_ATTACHED
+MAX_ATTACHED = 10
+
+
+def title_bucket(title, n_buckets):
+    if n_buckets == 1:
+        return 0
+    return zlib.crc32(title.encode('utf-8')) % n_buckets
+
+
+def shard_name(project, bucket, n_buckets):
+    if n_buckets == 1:
+        return 'moves-{}.sqlite'.format(project)
+    return 'moves-{}-{:04d}.sqlite'.format(project, bucket)
+
+
+def read_manifest(shard_dir):
+    path = pathlib.Path(shard_dir) / MANIFEST
+    if not path.exists():
+        return None
+    with path.open(encoding='utf-8') as f:
+        return json.load(f)
+
+
+def write_manifest(shard_dir, manifest):
+    path = pathlib.Path(shard_dir) / MANIFEST
+    tmp_path = path.with_suffix('.tmp')
+    with tmp_path.open('w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(str(tmp_path), str(path))
+
+
+def task_profiler(args, name):
+    # Profiler of one task of a pool process, dumped by the task itself:
+    # a process runs several tasks and exits without atexit handlers
+    if args is None or not getattr(args, 'profile', None):
+        return profiling.NULL_PROFILER
+    args = copy.copy(args)
+    prefix = args.profile_output or 'profile-moves-shards'
+    args.profile_output = pathlib.Path('{}-{}'.format(prefix, name))
+    return profiling.from_args(args)
+
+
+def partition_moves(tmp_dir, project, input_paths, n_buckets, args=None):
+    # Reader process: splits the inputs of a project into one moves CSV
+    # file per title bucket, in a single pass over them. args: options of
+    # parse_args, for profiling and progress.
+    profiler = task_profiler(args, 'partition-{}'.format(project))
+    paths = [
+        pathlib.Path(tmp_dir) / '{}-{:04d}.csv'.format(project, bucket)
+        for bucket in range(n_buckets)
+    ]
+    outputs = [path.open('w', encoding='utf-8', newline='') for path in paths]
+    try:
+        writers = [csv.writer(f) for f in outputs]
+        for writer in writers:
+            writer.writerow(['timestamp', 'from', 'to'])
+        for input_path in input_paths:
+            input_file = utils.open_compressed_file(input_path)
+            reporter = progress.NULL_REPORTER
+            if args is not None:
+                reporter = progress.from_args(args, input_path, input_file)
+            with input_file:
+                reader = csv.reader(
+                    profiler.wrap_iter('decompress', input_file))
+                assert next(reader) == ['timestamp', 'from', 'to']
+                with profiler.stage('partition'):
+                    for r in reporter.wrap_iter(reader):
+                        writers[title_bucket(r[2].rstrip('\n'), n_buckets)] \
+                            .writerow(r)
+            reporter.close()
+    finally:
+        for f in outputs:
+            f.close()
+    profiler.dump()
+    return [str(path) for path in paths]
+
+
+def load_shard(shard_path, project, input_paths, create_indexes=False,
+               args=None):
+    # Writer process: loads every move of the inputs into the shard.
+    # args: options of parse_args, for profiling and progress.
+    shard_path = pathlib.Path(shard_path)
+    profiler = task_profiler(args, shard_path.stem)
+    tmp_path = shard_path.with_suffix('.tmp')
+    if tmp_path.exists():
+        tmp_path.unlink()
+
+    conn = sqlite3.connect(str(tmp_path))
+    moves_csv_to_sqlite.create_tables(conn)
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.execute('PRAGMA journal_mode = MEMORY')
+
+    for input_path in input_paths:
+        input_file = utils.open_compressed_file(input_path)
+        reporter = progress.NULL_REPORTER
+        if args is not None:
+            reporter = progress.from_args(args, input_path, input_file)
+        with input_file, conn:
+            moves_csv_to_sqlite.insert_moves(
+                conn, project, input_file, profiler, reporter)
+        reporter.close()
+
+    rows = conn.execute('SELECT count(*) FROM moves').fetchone()[0]
+    if create_indexes:
+        with profiler.stage('index'):
+            moves_csv_to_sqlite.create_indexes(conn)
+    conn.close()
+    os.replace(str(tmp_path), str(shard_path))
+    profiler.dump()
+    return shard_path.name, rows
+
+
+def load_shards(shard_dir, inputs, n_buckets, workers=None,
+                create_indexes=False, args=None):
+    # inputs: {project: [input path, ...]}. Reloading a project replaces
+    # its shards. With several buckets, the inputs of each project are
+    # first partitioned by bucket, so that they are read once.
+    shard_dir = pathlib.Path(shard_dir)
+    shard_dir.mkdir(parents=True, exist_ok=True)
+
+    manifest = read_manifest(shard_dir) or dict(buckets=n_buckets, projects={})
+    if manifest['buckets'] != n_buckets:
+        raise ValueError(
+            '{} has {} buckets per project, not {}'.format(
+                shard_dir, manifest['buckets'], n_buckets))
+
+    executor = concurrent.futures.ProcessPoolExecutor(workers)
+    tmp_dir = tempfile.TemporaryDirectory(dir=str(shard_dir))
+    with executor, tmp_dir:
+        if n_buckets == 1:
+            bucket_inputs = {
+                project: [[str(p) for p in input_paths]]
+                for project, input_paths in inputs.items()
+            }
+        else:
+            futures = {
+                executor.submit(
+                    partition_moves,
+                    tmp_dir.name,
+                    project,
+                    [str(p) for p in input_paths],
+                    n_buckets,
+                    args,
+                ): project
+                for project, input_paths in inputs.items()
+            }
+            bucket_inputs = {
+                futures[future]: [[path] for path in future.result()]
+                for future in concurrent.futures.as_completed(futures)
+            }
+
+        futures = [
+            executor.submit(
+                load_shard,
+                shard_dir / shard_name(project, bucket, n_buckets),
+                project,
+                input_paths,
+                create_indexes,
+                args,
+            )
+            for project in inputs
+            for bucket, input_paths in enumerate(bucket_inputs[project])
+        ]
+        for future in concurrent.futures.as_completed(futures):
+            name, rows = future.result()
+            print('Wrote', name, 'with', rows, 'moves')
+
+    for project in inputs:
+        manifest['projects'][project] = [
+            shard_name(project, bucket, n_buckets)
+            for bucket in range(n_buckets)
+        ]
+    write_manifest(shard_dir, manifest)
+    return manifest
+
+
+class ShardedMoves:
+    # Read-only query facade: shards are ATTACHed to a single connection
+    # on first use, and lookups by (project, page_title_to) are routed to
+    # the shard holding that title. At most `max_attached` shards stay
+    # attached; the least recently used one is detached to make room.
+    def __init__(self, shard_dir, max_attached=MAX_ATTACHED):
+        self.shard_dir = pathlib.Path(shard_dir)
+        manifest = read_manifest(self.shard_dir)
+        if manifest is None:
+            raise ValueError(
+                '{} is not a sharded moves directory'.format(shard_dir))
+        self.n_buckets = manifest['buckets']
+        self.projects = manifest['projects']
+        self.max_attached = max_attached
+        # URI filenames, so that shards can be attached read-only
+        self.connection = sqlite3.connect('file::memory:', uri=True)
+        self._attached = collections.OrderedDict()
+        self._next_schema = 0
+
+    def shard_path(self, project, page_title):
+        names = self.projects.get(project)
+        if names is None:
+            return None
+        return self.shard_dir / names[title_bucket(page_title, self.n_buckets)]
+
+    def _schema(self, path):
+        schema = self._attached.get(path)
+        if schema is not None:
+            self._attached.move_to_end(path)
+            return schema
+
+        if len(self._attached) >= self.max_attached:
+            _, old_schema = self._attached.popitem(last=False)
+            self.connection.execute('DETACH DATABASE ' + old_schema)
+
+        schema = 'shard{}'.format(self._next_schema)
+        self._next_schema += 1
+        uri = '{}?mode=ro'.format(path.resolve().as_uri())
+        self.connection.execute(
+            'ATTACH DATABASE ? AS ' + schema, (uri,))
+        self._attached[path] = schema
+        return schema
+
+    def moves_to(self, project, page_title):
+        # Moves whose destination is page_title, as
+        # (timestamp, project, page_title_from, page_title_to) rows
+        path = self.shard_path(project, page_title)
+        if path is None:
+            return []
+        schema = self._schema(path)
+        return self.connection.execute(
+            'SELECT * FROM {}.moves '
+            'WHERE project = ? AND page_title_to = ? '
+            'ORDER BY timestamp'.format(schema),
+            (project, page_title),
+        ).fetchall()
+
+    def iter_shards(self, project=None):
+        # Schemas of every shard (of a project), for queries that cannot
+        # be routed by title. A schema may be detached once the next one
+        # is yielded, so query it before moving on.
+        projects = [project] if project is not None else sorted(self.projects)
+        for p in projects:
+            for name in self.projects.get(p, []):
+                yield self._schema(self.shard_dir / name)
+
+    def close(self):
+        self.connection.close()
+
+
+def parse_input(value):
+    project, sep, path = value.partition('=')
+    if not sep or not project:
+        raise argparse.ArgumentTypeError(
+            'expected PROJECT=PATH, got {!r}'.format(value))
+    return project, pathlib.Path(path)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Load moves CSV files (see extract_moves.py) into a '
+                    'directory of sqlite shards, one per project and '
+                    'title-hash bucket, written by parallel processes.',
+    )
+    parser.add_argument(
+        'shard_dir',
+        type=pathlib.Path,
+    )
+    parser.add_argument(
+        'inputs',
+        nargs='+',
+        type=parse_input,
+        metavar='PROJECT=PATH',
+        help='Moves CSV file of a project; repeat for more files or projects',
+    )
+    parser.add_argument(
+        '--buckets',
+        type=int,
+        default=1,
+        help='Title-hash buckets per project; 1 means one shard per '
+             'project (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--workers', '-j',
+        type=int,
+        default=None,
+        help='Writer processes (default: one per CPU)',
+    )
+    parser.add_argument(
+        '--create-indexes',
+        action='store_true',
+        help='Create indexes on each shard',
+    )
+    profiling.add_profile_arguments(parser)
+    progress.add_progress_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    inputs = collections.OrderedDict()
+    for project, path in args.inputs:
+        inputs.setdefault(project, []).append(path)
+
+    load_shards(
+        args.shard_dir,
+        inputs,
+        args.buckets,
+        workers=args.workers,
+        create_indexes=args.create_indexes,
+        args=args,
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+import collections
+import concurrent.futures
+import contextlib
+import queue
+import random
+import threading
+import time
+
+import pymysql
+
+
+class LatencyStats:
+    # Query latencies, with percentiles estimated from a fixed-size
+    # reservoir sample so that memory stays bounded on long runs.
+    def __init__(self, reservoir_size=10000):
+        self.reservoir_size = reservoir_size
+        self.count = 0
+        self.total = 0.0
+        self.errors = 0
+        self.reconnects = 0
+        self._samples = []
+        self._lock = threading.Lock()
+
+    def add(self, latency):
+        with self._lock:
+            self.count += 1
+            self.total += latency
+            if len(self._samples) < self.reservoir_size:
+                self._samples.append(latency)
+            else:
+                i = random.randrange(self.count)
+                if i < self.reservoir_size:
+                    self._samples[i] = latency
+
+    def add_error(self, reconnect=False):
+        with self._lock:
+            self.errors += 1
+            if reconnect:
+                self.reconnects += 1
+
+    def percentile(self, p):
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(p / 100 * len(samples)))]
+
+    def summary(self):
+        return dict(
+            queries=self.count,
+            errors=self.errors,
+            reconnects=self.reconnects,
+            mean_ms=1000 * self.total / self.count if self.count else None,
+            p50_ms=1000 * (self.percentile(50) or 0),
+            p99_ms=1000 * (self.percentile(99) or 0),
+        )
+
+
+class ConnectionPool:
+    # Thread-safe pool of pymysql connections. Connections idle for longer
+    # than `ping_after` seconds are pinged (and reconnected) before use, and
+    # queries failing with a connection error are retried on a fresh
+    # connection with exponential backoff.
+    def __init__(self, db_vars, size=4, max_retries=5, retry_delay=1.0,
+                 ping_after=30.0, acquire_timeout=60.0):
+        self.db_vars = db_vars
+        self.size = size
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.ping_after = ping_after
+        self.acquire_timeout = acquire_timeout
+        self.stats = LatencyStats()
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _acquire(self):
+        try:
+            connection, last_used = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_create = self._created < self.size
+                if can_create:
+                    self._created += 1
+            if can_create:
+                try:
+                    return pymysql.connect(**self.db_vars)
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            try:
+                connection, last_used = self._idle.get(
+                    timeout=self.acquire_timeout)
+            except queue.Empty:
+                raise TimeoutError(
+                    'No MySQL connection available after {} seconds'.format(
+                        self.acquire_timeout)) from None
+
+        if time.monotonic() - last_used > self.ping_after:
+            try:
+                connection.ping(reconnect=True)
+            except Exception:
+                self._discard(connection)
+                raise
+        return connection
+
+    def _discard(self, connection):
+        with self._lock:
+            self._created -= 1
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    @contextlib.contextmanager
+    def connection(self):
+        connection = self._acquire()
+        try:
+            yield connection
+        except (pymysql.OperationalError, pymysql.InterfaceError):
+            self._discard(connection)
+            raise
+        except Exception:
+            self._idle.put((connection, time.monotonic()))
+            raise
+        else:
+            self._idle.put((connection, time.monotonic()))
+
+    def fetchall(self, query, args=None):
+        for attempt in range(self.max_retries + 1):
+            tic = time.perf_counter()
+            try:
+                with self.connection() as connection, \
+                        connection.cursor() as cursor:
+                    cursor.execute(query, args)
+                    rows = cursor.fetchall()
+            except (pymysql.OperationalError, pymysql.InterfaceError) as e:
+                if attempt == self.max_retries:
+                    self.stats.add_error()
+                    raise
+                self.stats.add_error(reconnect=True)
+                print('Warning: query failed, reconnecting:', e)
+                time.sleep(self.retry_delay * 2 ** attempt)
+                continue
+
+            self.stats.add(time.perf_counter() - tic)
+            return rows
+
+    def close(self):
+        while True:
+            try:
+                connection, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(connection)
+
+
+# PyMySQL has no server-side prepared statements, so the per-redirect
+# title lookups are folded into a single round trip instead.
+redirect_titles_query = '''
+    select p.page_title
+    from redirect r join page p on p.page_id = r.rd_from
+    where r.rd_namespace = 0 and r.rd_title = %s
+'''
+
+
+def decode_title(title):
+    if not isinstance(title, str):
+        title = title.decode('utf-8', errors='replace')
+    return title
+
+
+class RedirectResolver:
+    # Looks up the redirects of the pages of a record stream on a thread
+    # pool, a bounded number of records ahead of the consumer.
+    def __init__(self, pool, max_workers=8, max_in_flight=64,
+                 cache_size=1024):
+        self.pool = pool
+        self.max_workers = max_workers
+        self.max_in_flight = max_in_flight
+        self.cache_size = cache_size
+        self._cache = collections.OrderedDict()
+
+    def redirects_for(self, page_title):
+        page_title = page_title.replace(' ', '_')
+        rows = self.pool.fetchall(redirect_titles_query, (page_title,))
+        return [decode_title(row[0]) for row in rows]
+
+    def _cached(self, page_title):
+        redirects = self._cache.get(page_title)
+        if redirects is not None:
+            self._cache.move_to_end(page_title)
+        return redirects
+
+    def _remember(self, page_title, redirects):
+        self._cache[page_title] = redirects
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def map(self, records, title=lambda r: r.page_title):
+        # Yield (record, redirect titles) in input order
+        executor = concurrent.futures.ThreadPoolExecutor(self.max_workers)
+        with executor:
+            pending = collections.deque()
+            in_flight = {}
+            records = iter(records)
+            exhausted = False
+            while True:
+                while not exhausted and len(pending) < self.max_in_flight:
+                    record = next(records, None)
+                    if record is None:
+                        exhausted = True
+                        break
+                    page_title = title(record)
+                    if self._cached(page_title) is None and \
+                            page_title not in in_flight:
+                        in_flight[page_title] = executor.submit(
+                            self.redirects_for, page_title)
+                    pending.append((record, page_title))
+
+                if not pending:
+                    return
+
+                record, page_title = pending.popleft()
+                redirects = self._cached(page_title)
+                if redirects is None:
+                    future = in_flight.pop(page_title, None)
+                    if future is not None:
+                        redirects = future.result()
+                    else:
+                        # Cached when the record was enqueued, but evicted
+                        # since by a lookahead longer than the cache
+                        redirects = self.redirects_for(page_title)
+                    self._remember(page_title, redirects)
+                yield record, redirects
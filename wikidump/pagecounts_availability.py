@@ -0,0 +1,214 @@
+import argparse
+import collections
+import csv
+import pathlib
+import sqlite3
+
+from . import profiling
+from . import shared_series
+from . import utils
+
+Availability = collections.namedtuple(
+    'Availability',
+    'present first last',
+)
+
+ABSENT = Availability(False, None, None)
+
+
+class AvailabilityIndex:
+    # Per (project, page) record of whether the pagecounts dataset has any
+    # data for the page, and the unix timestamps of its first and last
+    # observations. Pages that have never been looked up are unknown (None).
+    #
+    # The index only holds for the dataset it was built from: `dataset`
+    # identifies it (see dataset_namespace), and the entries recorded for
+    # another dataset, or for the same one before it was extended, are
+    # dropped on opening.
+    def __init__(self, path, dataset, commit_every=1000):
+        self.path = path
+        self.commit_every = commit_every
+        self._pending = 0
+        self.connection = sqlite3.connect(str(path))
+        self.connection.execute('PRAGMA synchronous = OFF')
+        self.connection.executescript('''
+CREATE TABLE IF NOT EXISTS availability (
+    project TEXT NOT NULL,
+    page TEXT NOT NULL,
+    first INTEGER,
+    last INTEGER,
+    PRIMARY KEY (project, page)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+        ''')
+        self.reset_stale(dataset)
+
+    def reset_stale(self, dataset):
+        row = self.connection.execute(
+            "SELECT value FROM meta WHERE key = 'dataset'").fetchone()
+        if row is not None and row[0] == dataset:
+            return
+
+        dropped = self.connection.execute(
+            'DELETE FROM availability').rowcount
+        if dropped:
+            print('Availability index', self.path, 'was built from another '
+                  'counts dataset, dropped', dropped, 'entries')
+        self.connection.execute(
+            "INSERT OR REPLACE INTO meta VALUES ('dataset', ?)", (dataset,))
+        self.connection.commit()
+
+    def get(self, project, page):
+        row = self.connection.execute(
+            'SELECT first, last FROM availability '
+            'WHERE project = ? AND page = ?',
+            (project, page),
+        ).fetchone()
+        if row is None:
+            return None
+
+        first, last = row
+        if first is None:
+            return ABSENT
+        return Availability(True, first, last)
+
+    def record(self, project, page, first=None, last=None):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO availability VALUES (?, ?, ?, ?)',
+            (project, page, first, last),
+        )
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self.commit()
+
+    def record_observations(self, project, page, timestamps):
+        # timestamps: sorted unix timestamps of the page's observations
+        if len(timestamps) == 0:
+            self.record(project, page)
+            return ABSENT
+
+        first = int(timestamps[0])
+        last = int(timestamps[-1])
+        self.record(project, page, first, last)
+        return Availability(True, first, last)
+
+    def commit(self):
+        self.connection.commit()
+        self._pending = 0
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+
+def dataset_namespace(counts_dataset_dir):
+    return shared_series.dataset_namespace(counts_dataset_dir)
+
+
+def may_have_views(availability, start_date, end_date, granularity):
+    # Whether a page with the given availability can have a non-zero count
+    # over [start_date, end_date]. Cumulative counts are interpolated from
+    # one granularity step before the first observation, hence the margin.
+    if availability is None:
+        return True
+    if not availability.present:
+        return False
+
+    margin = int(granularity.total_seconds())
+    if end_date is not None and \
+            int(end_date.timestamp()) < availability.first - margin:
+        return False
+    if start_date is not None and \
+            int(start_date.timestamp()) > availability.last:
+        return False
+    return True
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Precompute which pages have pagecounts, by searching '
+                    'every page of the given identifier-history files once.',
+    )
+    parser.add_argument(
+        'counts_dataset_dir',
+        type=pathlib.Path,
+    )
+    parser.add_argument(
+        'index_file',
+        type=pathlib.Path,
+        help='Availability index sqlite file, created if missing',
+    )
+    parser.add_argument(
+        'input_files',
+        nargs='+',
+        type=pathlib.Path,
+        help='Identifier-history files, or two-column (project, page) '
+             'CSV files such as a list of redirect titles',
+    )
+    profiling.add_profile_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def iter_pages(input_file):
+    for row in csv.reader(input_file):
+        if len(row) == 2:
+            project, page = row
+        else:
+            project, page = row[0], row[2]
+        yield project, page.replace(' ', '_')
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    profiler = profiling.from_args(args)
+
+    import pagecountssearch
+    finder = pagecountssearch.Finder(args.counts_dataset_dir)
+    index = AvailabilityIndex(
+        args.index_file, dataset_namespace(args.counts_dataset_dir))
+
+    present = absent = known = 0
+    for file_path in args.input_files:
+        print('Reading', file_path, '...')
+        input_file = utils.open_compressed_file(file_path)
+        with input_file:
+            pages = profiler.wrap_iter('parse', iter_pages(input_file))
+            for project, page in pages:
+                if index.get(project, page) is not None:
+                    known += 1
+                    continue
+
+                with profiler.stage('search'):
+                    timestamps = [
+                        int(ts.timestamp())
+                        for ts, _, _ in finder.search(project, page)
+                    ]
+                if index.record_observations(
+                        project, page, timestamps).present:
+                    present += 1
+                else:
+                    absent += 1
+    index.close()
+
+    print('Pages with counts:', present)
+    print('Pages without counts:', absent)
+    print('Pages already indexed:', known)
+
+
+def test_availability_index_reset_stale():
+    index = AvailabilityIndex(':memory:', 'dataset-1')
+    index.record_observations('en', 'Page', [])
+    index.reset_stale('dataset-1')
+    assert index.get('en', 'Page') == ABSENT
+
+    # Extending the dataset may give the page views
+    index.reset_stale('dataset-2')
+    assert index.get('en', 'Page') is None
+    index.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,497 @@
+import argparse
+import array
+import datetime
+import gzip
+import json
+import mmap
+import os
+import pathlib
+import re
+import shutil
+import struct
+import tempfile
+import urllib.parse
+import zlib
+
+import numpy
+
+from . import profiling
+
+# A page-major store is a directory of segment files, each holding the
+# hourly views of every (project, page) over a contiguous range of hours.
+# A segment is one mmap-able file:
+#
+#     MAGIC, uint64 header length, JSON header, then 8-byte aligned arrays:
+#     bucket_offsets int64  first key of each hash bucket (n_buckets + 1)
+#     key_offsets    int64  start of each key in `keys` (n_keys + 1)
+#     keys           bytes  b'project\tpage', sorted within each bucket
+#     data_offsets   int64  start of each key's data (n_keys + 1)
+#     hours          int32  hours since the epoch with non-zero views
+#     views          int32  views in the matching hour
+#
+# Pages are keyed by their decoded, wikified title (as ViewsCounter looks
+# them up): the percent-encoded titles of the pagecounts files are decoded
+# and the views of the rows that map to the same title in an hour summed.
+#
+# Keys are spread over hash buckets so the builder can transpose the data
+# one bucket at a time; a lookup hashes the key and bisects its bucket.
+# All segments of a store have the same number of buckets, recorded in
+#
+#     store.json  {"buckets": N}
+MAGIC = b'PAGEMAJ2'
+# Segments with percent-encoded titles, to be rebuilt
+OLD_MAGICS = (b'PAGEMAJ1',)
+SEGMENT_SUFFIX = '.pms'
+MANIFEST = 'store.json'
+DEFAULT_BUCKETS = 256
+SECONDS_PER_HOUR = 60 * 60
+
+PAGECOUNTS_FILE_RE = re.compile(r'pagecounts-(\d{8})-(\d{2})\d{4}')
+
+SECTIONS = (
+    ('bucket_offsets', 'int64'),
+    ('key_offsets', 'int64'),
+    ('keys', 'uint8'),
+    ('data_offsets', 'int64'),
+    ('hours', 'int32'),
+    ('views', 'int32'),
+)
+
+
+def make_key(project, page):
+    return '{}\t{}'.format(project, page).encode('utf-8')
+
+
+def key_bucket(key, n_buckets):
+    return zlib.crc32(key) % n_buckets
+
+
+def read_buckets(store_dir):
+    path = pathlib.Path(store_dir) / MANIFEST
+    if not path.exists():
+        return None
+    with path.open(encoding='utf-8') as f:
+        return json.load(f)['buckets']
+
+
+def write_buckets(store_dir, n_buckets):
+    path = pathlib.Path(store_dir) / MANIFEST
+    tmp_path = path.with_suffix('.tmp')
+    with tmp_path.open('w', encoding='utf-8') as f:
+        json.dump(dict(buckets=n_buckets), f)
+    os.replace(str(tmp_path), str(path))
+
+
+def is_store(path):
+    path = pathlib.Path(path)
+    return path.is_dir() and any(path.glob('*' + SEGMENT_SUFFIX))
+
+
+class Segment:
+    def __init__(self, path):
+        self.path = path
+        self._file = open(str(path), 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic = self._mmap[:len(MAGIC)]
+        if magic in OLD_MAGICS:
+            raise ValueError(
+                '{} holds percent-encoded titles, rebuild the store'.format(
+                    path))
+        if magic != MAGIC:
+            raise ValueError('{} is not a page-major segment'.format(path))
+        header_len, = struct.unpack_from('<Q', self._mmap, len(MAGIC))
+        header_start = len(MAGIC) + 8
+        self.header = json.loads(
+            self._mmap[header_start:header_start + header_len].decode('utf-8'))
+
+        self.first_hour = self.header['first_hour']
+        self.last_hour = self.header['last_hour']
+        self.n_buckets = self.header['n_buckets']
+        for name, dtype in SECTIONS:
+            offset, count = self.header['sections'][name]
+            setattr(self, name, numpy.frombuffer(
+                self._mmap, dtype=dtype, count=count, offset=offset))
+
+    def _key_at(self, i):
+        return self.keys[self.key_offsets[i]:self.key_offsets[i + 1]].tobytes()
+
+    def find(self, key):
+        bucket = key_bucket(key, self.n_buckets)
+        lo = int(self.bucket_offsets[bucket])
+        hi = int(self.bucket_offsets[bucket + 1])
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.bucket_offsets[bucket + 1] and self._key_at(lo) == key:
+            return lo
+        return None
+
+    def search_arrays(self, key):
+        # int32 hours and views of the key, as slices of the mapped file
+        i = self.find(key)
+        if i is None:
+            return None
+        start, end = self.data_offsets[i], self.data_offsets[i + 1]
+        return self.hours[start:end], self.views[start:end]
+
+    def iter_keys(self):
+        # (key, index) in storage order, for sequential scans
+        for i in range(len(self.key_offsets) - 1):
+            yield self._key_at(i), i
+
+    def close(self):
+        for name, _ in SECTIONS:
+            delattr(self, name)
+        self._mmap.close()
+        self._file.close()
+
+
+class PageMajorStore:
+    # Drop-in replacement for pagecountssearch.Finder over a store directory
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.segments = [
+            Segment(p) for p in sorted(self.path.glob('*' + SEGMENT_SUFFIX))
+        ]
+        self.segments.sort(key=lambda s: s.first_hour)
+
+        # Stores built before the manifest take it from their segments
+        self.n_buckets = read_buckets(self.path)
+        if self.n_buckets is None and self.segments:
+            self.n_buckets = self.segments[0].n_buckets
+        for segment in self.segments:
+            if segment.n_buckets != self.n_buckets:
+                raise ValueError(
+                    '{} has {} buckets, not {} as its store'.format(
+                        segment.path, segment.n_buckets, self.n_buckets))
+
+    @property
+    def last_hour(self):
+        if not self.segments:
+            return None
+        return self.segments[-1].last_hour
+
+    def search_arrays(self, project, page):
+        # (unix timestamps, views) of the hours with views, as new int64
+        # arrays: the segments' int32 data is converted, hence copied
+        key = make_key(project, page)
+        parts = [s.search_arrays(key) for s in self.segments]
+        parts = [p for p in parts if p is not None]
+        if not parts:
+            empty = numpy.empty(0, dtype=numpy.int64)
+            return empty, empty
+        if len(parts) == 1:
+            hours, views = parts[0]
+        else:
+            hours = numpy.concatenate([h for h, _ in parts])
+            views = numpy.concatenate([v for _, v in parts])
+        return (
+            hours.astype(numpy.int64) * SECONDS_PER_HOUR,
+            views.astype(numpy.int64),
+        )
+
+    def key_order(self, project, page):
+        # Sort key of the pages in storage order: searching pages in this
+        # order reads every segment front to back
+        key = make_key(project, page)
+        if not self.segments:
+            return 0, key
+        return key_bucket(key, self.n_buckets), key
+
+    def search(self, project, page):
+        timestamps, views = self.search_arrays(project, page)
+        return [
+            (
+                datetime.datetime.fromtimestamp(
+                    int(ts), datetime.timezone.utc),
+                int(v),
+                None,
+            )
+            for ts, v in zip(timestamps, views)
+        ]
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+
+
+def hour_of_file(path):
+    match = PAGECOUNTS_FILE_RE.search(path.name)
+    if match is None:
+        return None
+    date, hour = match.groups()
+    timestamp = datetime.datetime.strptime(
+        date + hour, '%Y%m%d%H').replace(tzinfo=datetime.timezone.utc)
+    return int(timestamp.timestamp()) // SECONDS_PER_HOUR
+
+
+def find_hourly_files(paths):
+    files = []
+    for path in paths:
+        candidates = path.rglob('pagecounts-*') if path.is_dir() else [path]
+        for candidate in candidates:
+            hour = hour_of_file(candidate)
+            if hour is not None:
+                files.append((hour, candidate))
+    files.sort()
+    return files
+
+
+def iter_hourly_records(file_path, projects=None):
+    opener = gzip.open if file_path.suffix == '.gz' else open
+    with opener(str(file_path), 'rb') as f:
+        for line in f:
+            fields = line.split(b' ')
+            if len(fields) != 4 or b'\t' in fields[1]:
+                continue
+            project, page, views, _ = fields
+            if projects is not None and project not in projects:
+                continue
+            try:
+                views = int(views)
+            except ValueError:
+                continue
+            page = urllib.parse.unquote_to_bytes(page).replace(b' ', b'_')
+            if b'\t' in page or b'\n' in page:
+                continue
+            yield project + b'\t' + page, views
+
+
+def partition_hourly_files(files, tmp_dir, n_buckets, projects, profiler):
+    buckets = [
+        open(str(tmp_dir / 'bucket-{}.tsv'.format(b)), 'wb', buffering=1 << 18)
+        for b in range(n_buckets)
+    ]
+    try:
+        for hour, file_path in files:
+            print('Reading', file_path, '...')
+            records = profiler.wrap_iter(
+                'parse', iter_hourly_records(file_path, projects))
+            with profiler.stage('write'):
+                for key, views in records:
+                    buckets[key_bucket(key, n_buckets)].write(
+                        b'%s\t%d\t%d\n' % (key, hour, views))
+    finally:
+        for f in buckets:
+            f.close()
+
+
+def write_segment(path, tmp_dir, n_buckets, first_hour, last_hour, profiler):
+    sections = {
+        name: open(str(tmp_dir / (name + '.bin')), 'w+b')
+        for name, _ in SECTIONS
+    }
+    bucket_offsets = array.array('q', [0])
+    key_offsets = array.array('q', [0])
+    data_offsets = array.array('q', [0])
+    n_keys = n_keys_bytes = n_data = 0
+
+    for b in range(n_buckets):
+        bucket_path = tmp_dir / 'bucket-{}.tsv'.format(b)
+        pages = {}
+        with profiler.stage('transform'), open(str(bucket_path), 'rb') as f:
+            for line in f:
+                key, hour, views = line.rstrip(b'\n').rsplit(b'\t', 2)
+                hour = int(hour)
+                data = pages.get(key)
+                if data is None:
+                    data = pages[key] = (array.array('i'), array.array('i'))
+                # Hours are written in order: the rows of a title spelled
+                # in several ways in an hour are consecutive
+                if data[0] and data[0][-1] == hour:
+                    data[1][-1] += int(views)
+                else:
+                    data[0].append(hour)
+                    data[1].append(int(views))
+        bucket_path.unlink()
+
+        with profiler.stage('write'):
+            for key in sorted(pages):
+                hours, views = pages[key]
+                sections['keys'].write(key)
+                hours.tofile(sections['hours'])
+                views.tofile(sections['views'])
+                n_keys += 1
+                n_keys_bytes += len(key)
+                n_data += len(hours)
+                key_offsets.append(n_keys_bytes)
+                data_offsets.append(n_data)
+        bucket_offsets.append(n_keys)
+
+    bucket_offsets.tofile(sections['bucket_offsets'])
+    key_offsets.tofile(sections['key_offsets'])
+    data_offsets.tofile(sections['data_offsets'])
+
+    header = dict(
+        first_hour=first_hour,
+        last_hour=last_hour,
+        n_buckets=n_buckets,
+        sections={},
+    )
+    # Section offsets depend on the header length, which depends on the
+    # offsets: reserve a generous fixed header size.
+    header_size = 4096
+    offset = len(MAGIC) + 8 + header_size
+    for name, dtype in SECTIONS:
+        size = sections[name].tell()
+        header['sections'][name] = [
+            offset, size // numpy.dtype(dtype).itemsize]
+        offset += size + (-size % 8)
+
+    encoded = json.dumps(header).encode('utf-8')
+    assert len(encoded) <= header_size
+    tmp_path = path.with_suffix('.tmp')
+    with open(str(tmp_path), 'wb') as out:
+        out.write(MAGIC)
+        out.write(struct.pack('<Q', len(encoded)))
+        out.write(encoded.ljust(header_size, b' '))
+        for name, _ in SECTIONS:
+            f = sections[name]
+            size = f.tell()
+            f.seek(0)
+            shutil.copyfileobj(f, out, 1 << 24)
+            out.write(b'\0' * (-size % 8))
+            f.close()
+    os.replace(str(tmp_path), str(path))
+    return n_keys, n_data
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Build or extend a page-major pagecounts store from '
+                    'hourly pagecounts-YYYYMMDD-HH0000 files. Hours already '
+                    'in the store are skipped, so new months can be appended '
+                    'by running it again.',
+    )
+    parser.add_argument(
+        'store_dir',
+        type=pathlib.Path,
+    )
+    parser.add_argument(
+        'input_paths',
+        nargs='+',
+        type=pathlib.Path,
+        help='Hourly pagecounts files, or directories containing them',
+    )
+    parser.add_argument(
+        '--projects',
+        default=None,
+        help='Comma separated list of projects to keep (default: all)',
+    )
+    parser.add_argument(
+        '--buckets',
+        type=int,
+        default=None,
+        help='Number of hash buckets of a new store; each one is transposed '
+             'in memory, so use more for bigger inputs. An existing store '
+             'keeps its own (default: {})'.format(DEFAULT_BUCKETS),
+    )
+    parser.add_argument(
+        '--tmp-dir',
+        type=pathlib.Path,
+        default=None,
+    )
+    profiling.add_profile_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    profiler = profiling.from_args(args)
+
+    args.store_dir.mkdir(parents=True, exist_ok=True)
+    store = PageMajorStore(args.store_dir)
+    last_hour = store.last_hour
+    n_buckets = store.n_buckets
+    store.close()
+
+    if n_buckets is None:
+        n_buckets = args.buckets or DEFAULT_BUCKETS
+    elif args.buckets is not None and args.buckets != n_buckets:
+        raise ValueError('{} has {} buckets, not {}'.format(
+            args.store_dir, n_buckets, args.buckets))
+
+    files = find_hourly_files(args.input_paths)
+    if last_hour is not None:
+        files = [(h, p) for h, p in files if h > last_hour]
+    if not files:
+        print('No new hourly files to add')
+        return
+
+    projects = None
+    if args.projects:
+        projects = {p.encode('utf-8') for p in args.projects.split(',')}
+
+    first_hour, last_hour = files[0][0], files[-1][0]
+    segment_path = args.store_dir / 'segment-{}-{}{}'.format(
+        first_hour, last_hour, SEGMENT_SUFFIX)
+
+    with tempfile.TemporaryDirectory(dir=args.tmp_dir) as tmp_dir:
+        tmp_dir = pathlib.Path(tmp_dir)
+        partition_hourly_files(
+            files, tmp_dir, n_buckets, projects, profiler)
+        n_keys, n_data = write_segment(
+            segment_path, tmp_dir, n_buckets,
+            first_hour, last_hour, profiler)
+    write_buckets(args.store_dir, n_buckets)
+
+    print('Wrote', segment_path, 'with', n_keys, 'pages and',
+          n_data, 'hourly counts')
+
+
+def test_page_major_store():
+    hourly_lines = {
+        '20120101-000000': [
+            'en Caf%C3%A9 3 300',
+            'en Caf\xe9 2 200',
+            'en Main_Page 10 1000',
+            'de Caf%C3%A9 5 500',
+        ],
+        '20120101-010000': [
+            'en Caf%C3%A9 1 100',
+            'en Foo%20bar 4 400',
+            'en Foo_bar 1 100',
+        ],
+    }
+    expected = {
+        ('en', 'Café'): [(0, 5), (1, 1)],
+        ('en', 'Main_Page'): [(0, 10)],
+        ('de', 'Café'): [(0, 5)],
+        ('en', 'Foo_bar'): [(1, 5)],
+        ('en', 'Missing'): [],
+    }
+    start = datetime.datetime(2012, 1, 1, tzinfo=datetime.timezone.utc)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = pathlib.Path(tmp_dir)
+        for name, lines in hourly_lines.items():
+            path = tmp_dir / 'hourly' / 'pagecounts-{}.gz'.format(name)
+            path.parent.mkdir(exist_ok=True)
+            with gzip.open(str(path), 'wt', encoding='utf-8') as f:
+                f.write(''.join(line + '\n' for line in lines))
+        main([str(tmp_dir / 'store'), str(tmp_dir / 'hourly'),
+              '--buckets', '4', '--tmp-dir', str(tmp_dir)])
+
+        store = PageMajorStore(tmp_dir / 'store')
+        try:
+            for (project, page), observations in expected.items():
+                assert store.search(project, page) == [
+                    (start + datetime.timedelta(hours=hour), views, None)
+                    for hour, views in observations
+                ]
+                timestamps, views = store.search_arrays(project, page)
+                assert timestamps.tolist() == [
+                    int(start.timestamp()) + hour * SECONDS_PER_HOUR
+                    for hour, _ in observations
+                ]
+                assert views.tolist() == [v for _, v in observations]
+        finally:
+            store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,392 @@
+import csv
+import argparse
+import collections
+import heapq
+import io
+import pathlib
+import sqlite3
+import functools
+import time
+import dateutil.parser
+
+from . import profiling
+from . import progress
+from .utils import *
+
+insert_tpl = '''
+INSERT INTO Page VALUES (?, ?, ?)
+'''
+
+timestamp_parser_cached = functools.lru_cache(100000)(dateutil.parser.parse)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'input_files',
+        nargs='+',
+        type=pathlib.Path,
+    )
+    parser.add_argument(
+        'sqlite_file',
+    )
+    parser.add_argument(
+        '--create-tables', '-c',
+        action='store_true',
+        default=False,
+        required=False,
+    )
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help='Refresh an existing Page table from newer dumps: only the '
+             'pages added, retitled or deleted since are written. Pages of '
+             'projects missing from the input files are kept',
+    )
+    parser.add_argument(
+        '--sorted-input',
+        action='store_true',
+        help='With --incremental, the input files are each sorted by '
+             '(project, id, title) and are merged with the table as they '
+             'are read, instead of being staged in a temporary table first',
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=10000,
+        help='Changes written per transaction with --incremental '
+             '(default: %(default)s)',
+    )
+    profiling.add_profile_arguments(parser)
+    progress.add_progress_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def create_tables_and_indexes(connection):
+    with connection:
+        connection.executescript('''
+-- Table: Page
+CREATE TABLE IF NOT EXISTS Page (
+    "project" TEXT NOT NULL,
+    "id" INTEGER NOT NULL,
+    "title" TEXT NOT NULL,
+    PRIMARY KEY ("project", "id", "title")
+);
+
+-- Index: timestamp_asc
+CREATE INDEX IF NOT EXISTS title_asc ON Page (
+    "project" ASC,
+    "title" ASC
+);
+
+    ''')
+
+def parse_record(r, default_project=None):
+    # no project given
+    if len(r) == 2:
+        page_id, page_title = r
+        project = default_project
+    else:
+        project, page_id, page_title = r
+
+    return project, page_id, page_title
+
+def insert_pages(connection, input_file, default_project='en',
+                 profiler=profiling.NULL_PROFILER,
+                 reporter=progress.NULL_REPORTER):
+    csvreader = csv.reader(profiler.wrap_iter('decompress', input_file))
+    records = profiler.wrap_iter(
+        'parse',
+        (parse_record(r, default_project) for r in csvreader),
+    )
+
+    with profiler.stage('write'):
+        connection.executemany(insert_tpl, reporter.wrap_iter(records))
+
+# Numbers of pages, except for unchanged which counts rows
+PageChanges = collections.namedtuple(
+    'PageChanges',
+    'inserted retitled deleted unchanged',
+)
+
+
+def create_staging_tables(connection):
+    with connection:
+        connection.executescript('''
+-- Unindexed: sorting it once is cheaper than keeping it sorted
+CREATE TEMP TABLE IF NOT EXISTS page_staging (
+    "project" TEXT NOT NULL,
+    "id" INTEGER NOT NULL,
+    "title" TEXT NOT NULL
+);
+
+CREATE TEMP TABLE IF NOT EXISTS page_deletes (
+    "project" TEXT NOT NULL,
+    "id" INTEGER NOT NULL,
+    "title" TEXT NOT NULL
+);
+
+CREATE TEMP TABLE IF NOT EXISTS page_inserts (
+    "project" TEXT NOT NULL,
+    "id" INTEGER NOT NULL,
+    "title" TEXT NOT NULL
+);
+''')
+
+
+def check_sorted(rows):
+    last = None
+    for row in rows:
+        if last is not None and row < last:
+            raise ValueError(
+                'pages are not sorted by (project, id, title): {} after {}'
+                .format(row, last))
+        last = row
+        yield row
+
+
+def diff_pages(old_rows, new_rows, counts):
+    # Sort-merge of the (project, id, title) rows of the table and of the
+    # new dump, both sorted. Yields the rows to delete and to insert, as
+    # (old_row, None) and (None, new_row). Rows of projects that do not
+    # appear in the new rows are kept.
+    #
+    # counts (a Counter) gets the number of unchanged rows and of
+    # inserted, deleted and retitled pages. Most rows are unchanged, so
+    # pages are only told apart around rows that differ.
+    old = iter(old_rows)
+    new = iter(new_rows)
+    o = next(old, None)
+    n = next(new, None)
+    new_projects = set()
+    if n is not None:
+        new_projects.add(n[0])
+    unchanged = 0
+    last_equal = None
+    # [(project, id), in old rows, in new rows] of the page with changes
+    pending = None
+
+    def finish(pending):
+        _, in_old, in_new = pending
+        if in_old and in_new:
+            counts['retitled'] += 1
+        elif in_old:
+            counts['deleted'] += 1
+        else:
+            counts['inserted'] += 1
+
+    while o is not None or n is not None:
+        if o == n:
+            unchanged += 1
+            last_equal = o
+            if pending is not None:
+                if pending[0] == o[:2]:
+                    pending[1] = pending[2] = True
+                else:
+                    finish(pending)
+                    pending = None
+            o = next(old, None)
+            n = next(new, None)
+            if n is not None and n[0] not in new_projects:
+                new_projects.add(n[0])
+            continue
+
+        if n is None or (o is not None and o < n):
+            row, is_old = o, True
+            o = next(old, None)
+            if row[0] not in new_projects:
+                unchanged += 1
+                continue
+        else:
+            row, is_old = n, False
+            n = next(new, None)
+            if n is not None and n[0] not in new_projects:
+                new_projects.add(n[0])
+
+        key = row[:2]
+        if pending is None or pending[0] != key:
+            if pending is not None:
+                finish(pending)
+            in_both = last_equal is not None and last_equal[:2] == key
+            pending = [key, in_both, in_both]
+        if is_old:
+            pending[1] = True
+            yield row, None
+        else:
+            pending[2] = True
+            yield None, row
+
+    if pending is not None:
+        finish(pending)
+    counts['unchanged'] += unchanged
+
+
+def iter_file_pages(input_file, default_project='en',
+                    profiler=profiling.NULL_PROFILER,
+                    reporter=progress.NULL_REPORTER):
+    csvreader = csv.reader(profiler.wrap_iter('decompress', input_file))
+    for r in reporter.wrap_iter(csvreader):
+        project, page_id, page_title = parse_record(r, default_project)
+        yield project, int(page_id), page_title
+
+
+def stage_pages(connection, rows, profiler=profiling.NULL_PROFILER):
+    with profiler.stage('stage'), connection:
+        connection.executemany(
+            'INSERT INTO page_staging VALUES (?, ?, ?)',
+            rows,
+        )
+
+
+def record_changes(connection, new_rows, profiler=profiling.NULL_PROFILER):
+    # Diffs the Page table against new_rows into the page_deletes and
+    # page_inserts temporary tables; Page itself is only read.
+    old_rows = connection.execute(
+        'SELECT project, id, title FROM Page ORDER BY project, id, title')
+    counts = collections.Counter()
+
+    with profiler.stage('diff'), connection:
+        for old_row, new_row in diff_pages(old_rows, new_rows, counts):
+            if old_row is not None:
+                connection.execute(
+                    'INSERT INTO page_deletes VALUES (?, ?, ?)', old_row)
+            else:
+                connection.execute(
+                    'INSERT INTO page_inserts VALUES (?, ?, ?)', new_row)
+
+    return PageChanges(**{f: counts[f] for f in PageChanges._fields})
+
+
+def apply_changes(connection, batch_size=10000,
+                  profiler=profiling.NULL_PROFILER):
+    # Writes the recorded changes to Page, batch_size rows per transaction
+    for select, statement in (
+            ('SELECT project, id, title FROM page_deletes',
+             'DELETE FROM Page WHERE project = ? AND id = ? AND title = ?'),
+            ('SELECT project, id, title FROM page_inserts',
+             insert_tpl)):
+        cursor = connection.execute(select)
+        while True:
+            batch = cursor.fetchmany(batch_size)
+            if not batch:
+                break
+            with profiler.stage('write'), connection:
+                connection.executemany(statement, batch)
+
+    with connection:
+        connection.execute('DELETE FROM page_deletes')
+        connection.execute('DELETE FROM page_inserts')
+
+
+def estimate_reload_seconds(connection, n_rows, sample_size=20000):
+    # Lower bound of the time a full reload would take, extrapolated from
+    # loading a sample of the Page table with insert_pages into an empty
+    # in-memory copy of its schema. Building the indexes of a table that
+    # does not fit in memory only gets slower per row.
+    sample = connection.execute(
+        'SELECT project, id, title FROM Page LIMIT ?', (sample_size,),
+    ).fetchall()
+    if not sample:
+        return None
+    text = io.StringIO()
+    csv.writer(text).writerows(sample)
+    text.seek(0)
+
+    scratch = sqlite3.connect(':memory:')
+    create_tables_and_indexes(scratch)
+    tic = time.perf_counter()
+    with scratch:
+        insert_pages(scratch, text)
+    elapsed = time.perf_counter() - tic
+    scratch.close()
+    return elapsed * n_rows / len(sample)
+
+
+def refresh_pages(connection, input_files, sorted_input=False,
+                  batch_size=10000, profiler=profiling.NULL_PROFILER,
+                  reporters=None):
+    # Incremental refresh of Page from the pages of input_files (open
+    # text files). Returns the PageChanges applied.
+    create_staging_tables(connection)
+    if reporters is None:
+        reporters = [progress.NULL_REPORTER] * len(input_files)
+    pages = [
+        profiler.wrap_iter('parse', iter_file_pages(
+            f, profiler=profiler, reporter=reporter))
+        for f, reporter in zip(input_files, reporters)
+    ]
+
+    if sorted_input:
+        new_rows = heapq.merge(*(check_sorted(rows) for rows in pages))
+    else:
+        for rows in pages:
+            stage_pages(connection, rows, profiler)
+        new_rows = connection.execute(
+            'SELECT project, id, title FROM page_staging '
+            'ORDER BY project, id, title')
+
+    changes = record_changes(connection, new_rows, profiler)
+    apply_changes(connection, batch_size, profiler)
+
+    with connection:
+        connection.execute('DELETE FROM page_staging')
+    return changes
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    profiler = profiling.from_args(args)
+
+    conn = sqlite3.connect(args.sqlite_file)
+
+    if args.create_tables:
+        print('Creating tables and indexes')
+        create_tables_and_indexes(conn)
+
+    if args.incremental:
+        tic = time.perf_counter()
+        input_files = [open_compressed_file(p) for p in args.input_files]
+        reporters = [
+            progress.from_args(args, p, f)
+            for p, f in zip(args.input_files, input_files)
+        ]
+        try:
+            changes = refresh_pages(
+                conn,
+                input_files,
+                sorted_input=args.sorted_input,
+                batch_size=args.batch_size,
+                profiler=profiler,
+                reporters=reporters,
+            )
+        finally:
+            for f in input_files:
+                f.close()
+        for reporter in reporters:
+            reporter.close()
+        elapsed = time.perf_counter() - tic
+
+        print('Pages inserted: {}, retitled: {}, deleted: {}; '
+              'rows unchanged: {}'.format(*changes))
+        n_rows = conn.execute('SELECT count(*) FROM Page').fetchone()[0]
+        reload_seconds = estimate_reload_seconds(conn, n_rows)
+        print('Refresh took {:.1f}s'.format(elapsed), end='')
+        if reload_seconds is not None:
+            print(', a full reload of {} rows would take at least {:.1f}s '
+                  '(saved {:.1f}s)'.format(
+                      n_rows, reload_seconds, reload_seconds - elapsed),
+                  end='')
+        print()
+        return
+
+    for file_path in args.input_files:
+        print('Reading', file_path, '...')
+        input_file = open_compressed_file(file_path)
+        reporter = progress.from_args(args, file_path, input_file)
+        with input_file, conn:
+            insert_pages(
+                conn, input_file, profiler=profiler, reporter=reporter)
+        reporter.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+import atexit
+import contextlib
+import cProfile
+import json
+import os
+import pathlib
+import resource
+import sys
+import time
+import tracemalloc
+
+def add_profile_arguments(parser):
+    group = parser.add_argument_group('profiling')
+    group.add_argument(
+        '--profile',
+        choices=['cpu', 'mem', 'both'],
+        default=None,
+        help='Collect per-stage timings plus cProfile (cpu), '
+             'tracemalloc (mem) or both',
+    )
+    group.add_argument(
+        '--profile-output',
+        type=pathlib.Path,
+        default=None,
+        help='Path prefix of the .json/.pstats profile files '
+             '(default: profile-<script>-<pid>)',
+    )
+    return group
+
+
+def from_args(args):
+    if not getattr(args, 'profile', None):
+        return NULL_PROFILER
+
+    output = args.profile_output
+    if output is None:
+        # 'wikidump add-counts' when run through the wikidump command
+        script = pathlib.Path(sys.argv[0]).stem.replace(' ', '-')
+        script = script or 'wikidump'
+        output = pathlib.Path('profile-{}-{}'.format(script, os.getpid()))
+
+    profiler = Profiler(
+        cpu=args.profile in ('cpu', 'both'),
+        mem=args.profile in ('mem', 'both'),
+        output=output,
+    )
+    profiler.start()
+    return profiler
+
+
+class StageStats:
+    def __init__(self, name):
+        self.name = name
+        self.wall_time = 0.0
+        self.rows = 0
+        self.calls = 0
+        self.peak_memory = None
+
+    def as_dict(self):
+        return dict(
+            wall_time=self.wall_time,
+            rows=self.rows,
+            calls=self.calls,
+            rows_per_sec=(
+                self.rows / self.wall_time if self.wall_time else None),
+            peak_memory=self.peak_memory,
+        )
+
+
+class Profiler:
+    # Stages nest: time spent inside an inner stage (e.g. 'parse' pulled by
+    # an executemany in 'write') is charged to the inner stage only, so the
+    # per-stage wall times add up to the profiled total.
+    def __init__(self, cpu=True, mem=False, output=None):
+        self.cpu = cpu
+        self.mem = mem
+        self.output = output
+        self.stages = {}
+        self._stack = []
+        self._last = None
+        self._peak_memory = 0
+        self._cprofile = None
+        self._started = None
+        self._dumped = False
+
+    def start(self):
+        self._started = time.perf_counter()
+        self._last = self._started
+        if self.mem:
+            tracemalloc.start()
+        if self.cpu:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+        atexit.register(self.dump)
+
+    def _stats(self, name):
+        stats = self.stages.get(name)
+        if stats is None:
+            stats = self.stages[name] = StageStats(name)
+        return stats
+
+    def _switch(self):
+        now = time.perf_counter()
+        if self._stack:
+            self._stack[-1].wall_time += now - self._last
+        self._last = now
+
+    def _read_peak(self):
+        # Peak traced memory since the last stage entry or exit, after
+        # which the peak is measured again. Without reset_peak (before
+        # Python 3.9), the traced memory at the time.
+        current, peak = tracemalloc.get_traced_memory()
+        if not hasattr(tracemalloc, 'reset_peak'):
+            return current
+        self._peak_memory = max(self._peak_memory, peak)
+        tracemalloc.reset_peak()
+        return peak
+
+    def _charge_peak(self, peak):
+        # The peak of an inner stage is reached inside the enclosing ones
+        for stats in self._stack:
+            if stats.peak_memory is None or peak > stats.peak_memory:
+                stats.peak_memory = peak
+
+    def _enter(self, name):
+        self._switch()
+        if self.mem:
+            self._charge_peak(self._read_peak())
+        stats = self._stats(name)
+        stats.calls += 1
+        self._stack.append(stats)
+        return stats
+
+    def _exit(self):
+        self._switch()
+        if self.mem:
+            self._charge_peak(self._read_peak())
+        self._stack.pop()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        self._enter(name)
+        try:
+            yield self._stats(name)
+        finally:
+            self._exit()
+
+    def add_rows(self, name, rows):
+        self._stats(name).rows += rows
+
+    def wrap_iter(self, name, iterable):
+        iterator = iter(iterable)
+        stats = self._stats(name)
+        while True:
+            self._enter(name)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self._exit()
+            stats.rows += 1
+            yield item
+
+    def wrap_file(self, name, fileobj):
+        return ProfiledFile(self, name, fileobj)
+
+    def report(self):
+        total = time.perf_counter() - self._started
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        report = dict(
+            argv=sys.argv,
+            wall_time=total,
+            max_rss_kb=usage.ru_maxrss,
+            stages={
+                name: stats.as_dict() for name, stats in self.stages.items()
+            },
+        )
+        if self.mem:
+            _, peak = tracemalloc.get_traced_memory()
+            report['peak_traced_memory'] = max(peak, self._peak_memory)
+        return report
+
+    def dump(self):
+        if self._dumped:
+            return
+        self._dumped = True
+
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            pstats_path = '{}.pstats'.format(self.output)
+            self._cprofile.dump_stats(pstats_path)
+
+        report = self.report()
+        if self.mem:
+            tracemalloc.stop()
+
+        json_path = '{}.json'.format(self.output)
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+        print('Profile written to', json_path, file=sys.stderr)
+        for name, stats in report['stages'].items():
+            print(
+                '  {:<12} {:10.3f}s {:>12} rows {:>12} rows/s'.format(
+                    name,
+                    stats['wall_time'],
+                    stats['rows'],
+                    int(stats['rows_per_sec'] or 0),
+                ),
+                file=sys.stderr,
+            )
+
+
+class NullProfiler:
+    def stage(self, name):
+        return contextlib.nullcontext()
+
+    def add_rows(self, name, rows):
+        pass
+
+    def wrap_iter(self, name, iterable):
+        return iterable
+
+    def wrap_file(self, name, fileobj):
+        return fileobj
+
+    def dump(self):
+        pass
+
+
+class ProfiledFile:
+    def __init__(self, profiler, name, fileobj):
+        self._profiler = profiler
+        self._name = name
+        self._fileobj = fileobj
+
+    def read(self, *args):
+        with self._profiler.stage(self._name):
+            return self._fileobj.read(*args)
+
+    def readline(self, *args):
+        with self._profiler.stage(self._name):
+            return self._fileobj.readline(*args)
+
+    def __iter__(self):
+        return self._profiler.wrap_iter(self._name, self._fileobj)
+
+    def __enter__(self):
+        self._fileobj.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._fileobj.__exit__(*exc_info)
+
+    def __getattr__(self, name):
+        return getattr(self._fileobj, name)
+
+
+NULL_PROFILER = NullProfiler()
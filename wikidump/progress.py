@@ -0,0 +1,244 @@
+import datetime
+import functools
+import json
+import os
+import pathlib
+import sys
+import time
+
+
+def add_progress_arguments(parser):
+    group = parser.add_argument_group('progress')
+    group.add_argument(
+        '--progress',
+        choices=['text', 'json', 'none'],
+        default='text',
+        help='Report rows/s, MB/s of input and ETA on stderr, as text or '
+             'as one JSON object per line (default: %(default)s)',
+    )
+    group.add_argument(
+        '--progress-interval',
+        type=float,
+        default=10.0,
+        help='Seconds between progress reports (default: %(default)s)',
+    )
+    return group
+
+
+def from_args(args, file_path, fileobj=None):
+    # Reporter for one input file; `fileobj` is what open_compressed_file
+    # returned for it, used to find the position in the compressed input.
+    mode = getattr(args, 'progress', 'none')
+    if mode == 'none':
+        return NULL_REPORTER
+
+    file_path = pathlib.Path(file_path)
+    try:
+        total_bytes = file_path.stat().st_size
+    except OSError:
+        total_bytes = None
+
+    return ProgressReporter(
+        label=str(file_path),
+        total_bytes=total_bytes,
+        position=input_position(file_path, fileobj),
+        mode=mode,
+        interval=args.progress_interval,
+    )
+
+
+def input_position(file_path, fileobj):
+    # A callable returning how many bytes of `file_path` have been read, or
+    # None if that cannot be told.
+    if fileobj is None:
+        return None
+
+    # Files opened in-process (plain, gzip, bz2) all expose the descriptor
+    # of the compressed file, whose offset is the compressed position.
+    try:
+        fd = fileobj.fileno()
+        os.lseek(fd, 0, os.SEEK_CUR)
+    except (AttributeError, OSError, ValueError):
+        pass
+    else:
+        return functools.partial(fd_position, fd)
+
+    # External decompressors (7z, zstd) read the file themselves: look up
+    # their offset in /proc.
+    process = getattr(fileobj, 'process', None)
+    if process is not None:
+        return ProcessFilePosition(process.pid, file_path)
+    return None
+
+
+def fd_position(fd):
+    try:
+        return os.lseek(fd, 0, os.SEEK_CUR)
+    except OSError:
+        # The file was closed before the final report
+        return None
+
+
+class ProcessFilePosition:
+    def __init__(self, pid, file_path):
+        self.pid = pid
+        self.file_path = str(pathlib.Path(file_path).resolve())
+        self._fd = None
+
+    def _find_fd(self):
+        fd_dir = '/proc/{}/fd'.format(self.pid)
+        for fd in os.listdir(fd_dir):
+            try:
+                if os.readlink(os.path.join(fd_dir, fd)) == self.file_path:
+                    return fd
+            except OSError:
+                continue
+        return None
+
+    def __call__(self):
+        try:
+            if self._fd is None:
+                self._fd = self._find_fd()
+                if self._fd is None:
+                    return None
+            fdinfo = '/proc/{}/fdinfo/{}'.format(self.pid, self._fd)
+            with open(fdinfo) as f:
+                for line in f:
+                    if line.startswith('pos:'):
+                        return int(line.split()[1])
+        except OSError:
+            # Not Linux, or the decompressor has exited
+            self._fd = None
+        return None
+
+
+def format_duration(seconds):
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+
+class ProgressReporter:
+    # The clock is only read every `check_every` rows, so counting rows
+    # costs an integer increment and a comparison.
+    def __init__(self, label, total_bytes=None, position=None, mode='text',
+                 interval=10.0, stream=sys.stderr, check_every=1024):
+        self.label = label
+        self.total_bytes = total_bytes
+        self.position = position
+        self.mode = mode
+        self.interval = interval
+        self.stream = stream
+        self.check_every = check_every
+        self.rows = 0
+        self.bytes = 0
+        self._started = time.monotonic()
+        self._last_time = self._started
+        self._last_rows = 0
+        self._last_bytes = 0
+        self._next_check = check_every
+        self._closed = False
+
+    def wrap_iter(self, iterable):
+        for item in iterable:
+            self.rows += 1
+            if self.rows >= self._next_check:
+                self._next_check = self.rows + self.check_every
+                self.maybe_report()
+            yield item
+
+    def update(self, rows, position=None):
+        # For inputs read in batches, e.g. by worker processes
+        self.rows += rows
+        if position is not None:
+            self.bytes = position
+        self.maybe_report()
+
+    def maybe_report(self):
+        now = time.monotonic()
+        if now - self._last_time >= self.interval:
+            self.report(now)
+
+    def _read_position(self):
+        if self.position is not None:
+            position = self.position()
+            if position is not None:
+                self.bytes = position
+
+    def snapshot(self, now, done=False):
+        if done and self.total_bytes is not None:
+            self.bytes = self.total_bytes
+        else:
+            self._read_position()
+        elapsed = now - self._started
+        recent = now - self._last_time
+
+        fraction = eta = None
+        if self.total_bytes and self.bytes:
+            fraction = min(1.0, self.bytes / self.total_bytes)
+            if elapsed > 0 and not done:
+                bytes_per_sec = self.bytes / elapsed
+                eta = (self.total_bytes - self.bytes) / bytes_per_sec
+
+        return dict(
+            label=self.label,
+            done=done,
+            elapsed=elapsed,
+            rows=self.rows,
+            bytes=self.bytes,
+            total_bytes=self.total_bytes,
+            fraction=fraction,
+            rows_per_sec=(
+                (self.rows - self._last_rows) / recent if recent else None),
+            mb_per_sec=(
+                (self.bytes - self._last_bytes) / recent / 1e6
+                if recent else None),
+            eta=eta,
+        )
+
+    def report(self, now=None, done=False):
+        if now is None:
+            now = time.monotonic()
+        snapshot = self.snapshot(now, done)
+        self._last_time = now
+        self._last_rows = self.rows
+        self._last_bytes = self.bytes
+
+        if self.mode == 'json':
+            print(json.dumps(snapshot), file=self.stream, flush=True)
+            return
+
+        parts = [self.label]
+        if snapshot['fraction'] is not None:
+            parts.append('{:6.2%}'.format(snapshot['fraction']))
+        parts.append('{:,} rows'.format(self.rows))
+        if snapshot['rows_per_sec'] is not None:
+            parts.append('{:,.0f} rows/s'.format(snapshot['rows_per_sec']))
+            if self.position is not None or self.bytes:
+                parts.append('{:.1f} MB/s'.format(snapshot['mb_per_sec']))
+        if snapshot['eta'] is not None:
+            parts.append('ETA ' + format_duration(snapshot['eta']))
+        if done:
+            parts.append('done in ' + format_duration(snapshot['elapsed']))
+        print(' '.join(parts), file=self.stream, flush=True)
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            # Rates of the final report are averages over the whole input
+            self._last_time = self._started
+            self._last_rows = 0
+            self._last_bytes = 0
+            self.report(done=True)
+
+
+class NullReporter:
+    def wrap_iter(self, iterable):
+        return iterable
+
+    def update(self, rows, position=None):
+        pass
+
+    def close(self):
+        pass
+
+
+NULL_REPORTER = NullReporter()
@@ -0,0 +1,228 @@
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import pathlib
+import struct
+import time
+
+import numpy
+
+from . import cumulative_views
+
+# Cache of cumulative view series shared by the processes counting over the
+# same counts dataset on a host. Put it on a tmpfs such as /dev/shm: every
+# page's series is then held in memory once, however many processes use
+# it. The directory is the shared index:
+#
+#     <digest>.series   one series, named after the digest of its dataset
+#                       namespace, project and page. MAGIC, uint64 header
+#                       length, JSON header, then 8-byte aligned arrays
+#     <digest>.tmp-PID  a series being written by process PID
+#     evict.lock        locked by the process evicting entries
+#
+# The first process to build a series publishes it with a hard link, which
+# fails if another one got there first; either way, all processes map the
+# published file and share its pages. The modification time of an entry is
+# refreshed on every use, and entries are evicted least recently used first
+# once the directory grows over its size limit. Evicted entries stay valid
+# in the processes that already mapped them.
+MAGIC = b'SERIES01'
+SUFFIX = '.series'
+LOCK_NAME = 'evict.lock'
+
+# Evicting brings the cache down to this fraction of its limit, so that
+# evictions happen in batches
+LOW_WATERMARK = 0.9
+
+# Age in seconds after which a temporary file is left over by a dead process
+STALE_TMP_AGE = 3600
+
+# A page without views
+EMPTY = 'empty'
+
+
+def dataset_namespace(path, *params):
+    # Identifies a counts dataset as it is now, plus the parameters the
+    # series are computed with: entries of another dataset, or of the same
+    # one before it was extended, are never used.
+    path = pathlib.Path(path).resolve()
+    digest = hashlib.sha1(str(path).encode('utf-8'))
+    for entry in sorted(os.scandir(str(path)), key=lambda e: e.name):
+        stat = entry.stat()
+        digest.update('\0{}\0{}\0{}'.format(
+            entry.name, stat.st_size, stat.st_mtime_ns).encode('utf-8'))
+    for param in params:
+        digest.update('\0{}'.format(param).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def write_series(path, series):
+    if series is None:
+        header = dict(kind=EMPTY, scalars={}, sections={})
+        arrays = {}
+    else:
+        scalars, arrays = series.parts()
+        header = dict(kind=series.KIND, scalars=scalars, sections={})
+
+    # Section offsets depend on the header length, which depends on the
+    # offsets: reserve a fixed header size.
+    header_size = 1024
+    offset = len(MAGIC) + 8 + header_size
+    for name, values in arrays.items():
+        header['sections'][name] = [values.dtype.str, offset, len(values)]
+        offset += values.nbytes + (-values.nbytes % 8)
+
+    encoded = json.dumps(header).encode('utf-8')
+    assert len(encoded) <= header_size
+    with open(str(path), 'wb') as out:
+        out.write(MAGIC)
+        out.write(struct.pack('<Q', len(encoded)))
+        out.write(encoded.ljust(header_size, b' '))
+        for values in arrays.values():
+            out.write(numpy.ascontiguousarray(values).tobytes())
+            out.write(b'\0' * (-values.nbytes % 8))
+
+
+def map_series(path):
+    # Series whose arrays are zero-copy views of the mapped file, or EMPTY
+    with open(str(path), 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if buffer[:len(MAGIC)] != MAGIC:
+        raise ValueError('{} is not a shared series'.format(path))
+    header_len, = struct.unpack_from('<Q', buffer, len(MAGIC))
+    header_start = len(MAGIC) + 8
+    header = json.loads(
+        buffer[header_start:header_start + header_len].decode('utf-8'))
+
+    if header['kind'] == EMPTY:
+        return EMPTY
+    arrays = {
+        name: numpy.frombuffer(buffer, dtype=dtype, count=count, offset=offset)
+        for name, (dtype, offset, count) in header['sections'].items()
+    }
+    cls = cumulative_views.SERIES_KINDS[header['kind']]
+    return cls.from_parts(header['scalars'], arrays)
+
+
+class SharedSeriesCache:
+    def __init__(self, path, namespace, max_bytes=1 << 30):
+        self.path = pathlib.Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.namespace = namespace
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.published = 0
+        self.evicted = 0
+        self._written_since_check = 0
+
+    def entry_path(self, project, page):
+        digest = hashlib.sha1('\0'.join(
+            (self.namespace, project, page)).encode('utf-8')).hexdigest()
+        return self.path / (digest + SUFFIX)
+
+    def get(self, project, page):
+        # Mapped series, EMPTY for a page without views, or None when no
+        # process has published it yet
+        path = self.entry_path(project, page)
+        try:
+            series = map_series(path)
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(str(path))
+        except OSError:
+            # Evicted since it was mapped
+            pass
+        return series
+
+    def put(self, project, page, series):
+        # Publishes the series (None for a page without views) and returns
+        # the shared one, which is another process' if it won the race
+        path = self.entry_path(project, page)
+        tmp_path = path.with_name(
+            '{}.tmp-{}'.format(path.stem, os.getpid()))
+        try:
+            write_series(tmp_path, series)
+            size = tmp_path.stat().st_size
+            try:
+                os.link(str(tmp_path), str(path))
+            except FileExistsError:
+                pass
+            else:
+                self.published += 1
+                self._written_since_check += size
+        finally:
+            tmp_path.unlink()
+
+        if self._written_since_check > self.max_bytes // 64:
+            self._written_since_check = 0
+            self.evict()
+
+        shared = self.get(project, page)
+        if shared is None:
+            # Evicted right away: keep the private copy
+            return EMPTY if series is None else series
+        return shared
+
+    def get_or_build(self, project, page, build):
+        # Series of the page, built with build() unless another process
+        # already published it. None for a page without views.
+        series = self.get(project, page)
+        if series is None:
+            self.misses += 1
+            series = self.put(project, page, build())
+        else:
+            self.hits += 1
+        if series is EMPTY:
+            return None
+        return series
+
+    def evict(self):
+        # Removes the least recently used entries until the cache is under
+        # its low watermark. Only one process evicts at a time; the others
+        # carry on.
+        with open(str(self.path / LOCK_NAME), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+
+            now = time.time()
+            entries = []
+            total = 0
+            for entry in os.scandir(str(self.path)):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if entry.name.endswith(SUFFIX):
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+                elif '.tmp-' in entry.name and \
+                        now - stat.st_mtime > STALE_TMP_AGE:
+                    os.unlink(entry.path)
+
+            if total <= self.max_bytes:
+                return
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes * LOW_WATERMARK:
+                    break
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    continue
+                total -= size
+                self.evicted += 1
+
+    def summary(self):
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            published=self.published,
+            evicted=self.evicted,
+        )
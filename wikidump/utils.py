@@ -0,0 +1,421 @@
+import pathlib
+import subprocess
+import io
+import gzip
+import array
+import bisect
+import bz2
+import csv
+import functools
+import datetime
+import collections
+import hashlib
+import heapq
+import itertools
+import queue
+import re
+import shutil
+import sys
+import threading
+import urllib.parse
+import warnings
+
+IdentifiersHistoryRecord = collections.namedtuple(
+    'InputRecord',
+    [
+        'project',
+        'page_id',
+        'page_title',
+        'identifier_type',
+        'identifier_id',
+        'start_date',
+        'end_date',
+    ],
+)
+
+# Columns of an identifier-history file: page_id is an int64 array, dates
+# are datetime64[s] arrays (UTC) with NaT for empty values, the others are
+# lists of interned strings.
+IdentifiersHistoryBatch = collections.namedtuple(
+    'IdentifiersHistoryBatch',
+    IdentifiersHistoryRecord._fields,
+)
+
+
+def open_compressed_file(file_path):
+    mode = 'rt'
+    encoding = 'utf-8'
+
+    if not isinstance(file_path, pathlib.Path):
+        file_path = pathlib.Path(file_path)
+
+    if file_path.suffix == '.7z':
+        f = subprocess.Popen(
+            ['7z', 'e', '-so', str(file_path)],
+            stdout=subprocess.PIPE,
+        )
+        w = io.TextIOWrapper(f.stdout, encoding=encoding)
+        w.process = f
+        return w
+    elif file_path.suffix == '.zst':
+        f = subprocess.Popen(
+            ['zstd', '-q', '-d', '-c', str(file_path)],
+            stdout=subprocess.PIPE,
+        )
+        w = io.TextIOWrapper(f.stdout, encoding=encoding)
+        w.process = f
+        return w
+    elif file_path.suffix == '.gz':
+        return gzip.open(str(file_path), mode, encoding=encoding)
+    elif file_path.suffix == '.bz2':
+        return bz2.open(str(file_path), mode, encoding=encoding)
+    else:
+        return file_path.open(mode, encoding=encoding)
+
+
+OUTPUT_COMPRESSIONS = ('none', 'gz', 'bz2', 'zst')
+
+# Suffixes of the compressed files open_compressed_file reads
+COMPRESSED_SUFFIXES = ('.gz', '.bz2', '.zst', '.7z')
+
+# Parallel external compressors, preferred over the in-process ones
+EXTERNAL_COMPRESSORS = {
+    '.gz': [['pigz', '-c']],
+    '.bz2': [['lbzip2', '-c'], ['pbzip2', '-c']],
+    '.zst': [['zstd', '-q', '-c', '-T0']],
+}
+
+
+class ThreadedWriter(io.RawIOBase):
+    # Hands the buffers written to it over to a background thread that
+    # writes them to `fileobj`, so that compression (zlib and bz2 release
+    # the GIL) overlaps with the producer. The bounded queue applies
+    # backpressure when the producer is faster.
+    def __init__(self, fileobj, max_pending=16):
+        self.fileobj = fileobj
+        self._queue = queue.Queue(max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            data = self._queue.get()
+            if data is None:
+                break
+            if self._error is not None:
+                continue
+            try:
+                self.fileobj.write(data)
+            except BaseException as e:
+                self._error = e
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self._error is not None:
+            raise self._error
+        self._queue.put(bytes(data))
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self.fileobj.close()
+        super().close()
+        if self._error is not None:
+            raise self._error
+
+
+class ProcessWriter(io.RawIOBase):
+    # Pipes the output through an external compressor
+    def __init__(self, command, file_path):
+        self._output = open(str(file_path), 'wb')
+        self._process = subprocess.Popen(
+            command,
+            stdin=subprocess.PIPE,
+            stdout=self._output,
+        )
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self._process.stdin.write(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self._process.stdin.close()
+        returncode = self._process.wait()
+        self._output.close()
+        super().close()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(
+                returncode, self._process.args)
+
+
+def open_output_file(file_path, buffer_size=1 << 20, external=True):
+    # Text output compressed according to the file suffix. '-' is stdout.
+    encoding = 'utf-8'
+
+    if str(file_path) == '-':
+        return io.TextIOWrapper(
+            io.BufferedWriter(
+                io.FileIO(sys.stdout.fileno(), 'w', closefd=False),
+                buffer_size,
+            ),
+            encoding=encoding,
+        )
+
+    if not isinstance(file_path, pathlib.Path):
+        file_path = pathlib.Path(file_path)
+    suffix = file_path.suffix
+
+    raw = None
+    if external:
+        for command in EXTERNAL_COMPRESSORS.get(suffix, []):
+            if shutil.which(command[0]) is not None:
+                raw = ProcessWriter(command, file_path)
+                break
+
+    if raw is None:
+        if suffix == '.zst':
+            raise RuntimeError('zstd is needed to write {}'.format(file_path))
+        elif suffix == '.gz':
+            raw = ThreadedWriter(gzip.open(str(file_path), 'wb'))
+        elif suffix == '.bz2':
+            raw = ThreadedWriter(bz2.open(str(file_path), 'wb'))
+        else:
+            raw = ThreadedWriter(file_path.open('wb'))
+
+    return io.TextIOWrapper(
+        io.BufferedWriter(raw, buffer_size),
+        encoding=encoding,
+    )
+
+
+def output_file_path(output_dir, input_file_path, compression='none'):
+    # Output named after the input, with the input's own compression
+    # suffix replaced by the output one, or dropped for plain text.
+    name = pathlib.Path(pathlib.Path(input_file_path).name)
+    if name.suffix in COMPRESSED_SUFFIXES:
+        name = name.with_suffix('')
+    if compression == 'none':
+        return output_dir / name
+    return output_dir / '{}.{}'.format(name, compression)
+
+
+def add_utc_if_naive(timestamp: datetime.datetime):
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+
+    return timestamp
+
+
+@functools.lru_cache(10000)
+def parse_timestamp(timestamp: str):
+    import dateutil.parser
+    timestamp = dateutil.parser.parse(timestamp)
+
+    timestamp = add_utc_if_naive(timestamp)
+
+    return timestamp
+
+
+def parse_identifier_history_record(raw_record):
+    (
+        project, page_id, page_title,
+        identifier_type, identifier_id,
+        start_date, end_date,
+    ) = raw_record
+
+    page_id = int(page_id)
+    if not end_date:
+        end_date = None
+    else:
+        end_date = parse_timestamp(end_date)
+
+    if not start_date:
+        start_date = None
+    else:
+        start_date = start_date = parse_timestamp(start_date)
+
+    return IdentifiersHistoryRecord(
+        project,
+        page_id,
+        page_title,
+        identifier_type,
+        identifier_id,
+        start_date,
+        end_date,
+    )
+
+
+# Dates numpy parses like dateutil: YYYY-MM-DD, optionally followed by a time.
+# numpy would read compact forms such as 20140101 as a year.
+ISO_DATE_RE = re.compile(r'\d{4}-\d{2}-\d{2}(?:[T ]|$)')
+
+
+def parse_date_column(values):
+    import numpy
+
+    values = [v if v else 'NaT' for v in values]
+    if all(v == 'NaT' or ISO_DATE_RE.match(v) for v in values):
+        try:
+            # numpy parses ISO 8601 dates natively, but only warns about
+            # timezone offsets: fall back to dateutil for anything unusual.
+            with warnings.catch_warnings():
+                warnings.simplefilter('error')
+                return numpy.array(values, dtype='datetime64[s]')
+        except (ValueError, Warning):
+            pass
+
+    nat = numpy.datetime64('NaT', 's')
+    return numpy.array(
+        [
+            nat if v == 'NaT'
+            else numpy.datetime64(int(parse_timestamp(v).timestamp()), 's')
+            for v in values
+        ],
+        dtype='datetime64[s]',
+    )
+
+
+def test_output_file_path():
+    output_dir = pathlib.Path('out')
+    assert output_file_path(output_dir, 'in/x.csv') == output_dir / 'x.csv'
+    assert output_file_path(output_dir, 'in/x.csv.gz') == output_dir / 'x.csv'
+    assert output_file_path(output_dir, 'in/x.csv.7z') == output_dir / 'x.csv'
+    assert output_file_path(output_dir, 'in/x.csv.gz', 'zst') == \
+        output_dir / 'x.csv.zst'
+    assert output_file_path(output_dir, 'in/x.csv', 'gz') == \
+        output_dir / 'x.csv.gz'
+
+
+def test_parse_date_column():
+    import numpy
+
+    def expected(values):
+        return numpy.array(
+            [
+                numpy.datetime64('NaT', 's') if not v
+                else numpy.datetime64(int(parse_timestamp(v).timestamp()), 's')
+                for v in values
+            ],
+            dtype='datetime64[s]',
+        )
+
+    for values in (
+        ['2014-01-01', '2015-06-30 12:30:00', '2016-02-29T01:02:03', ''],
+        ['20140101', '2014-01-02'],
+        ['2014'],
+        ['2014-01-01T00:00:00+02:00'],
+        ['Jan 3 2014', ''],
+    ):
+        parsed = parse_date_column(values)
+        assert numpy.array_equal(parsed, expected(values), equal_nan=True), \
+            values
+
+    assert parse_date_column(['20140101'])[0] == \
+        numpy.datetime64('2014-01-01T00:00:00')
+
+
+def iter_identifier_history_batches(input_file, batch_size=65536):
+    import numpy
+
+    reader = csv.reader(input_file)
+    n_fields = len(IdentifiersHistoryBatch._fields)
+    intern = sys.intern
+    while True:
+        rows = list(itertools.islice(reader, batch_size))
+        if not rows:
+            return
+
+        if any(len(r) != n_fields for r in rows):
+            raise ValueError(
+                'Expected {} fields per identifier-history row'.format(
+                    n_fields))
+
+        (
+            project, page_id, page_title,
+            identifier_type, identifier_id,
+            start_date, end_date,
+        ) = zip(*rows)
+
+        yield IdentifiersHistoryBatch(
+            list(map(intern, project)),
+            numpy.fromiter(map(int, page_id), numpy.int64, len(rows)),
+            list(map(intern, page_title)),
+            list(map(intern, identifier_type)),
+            list(map(intern, identifier_id)),
+            parse_date_column(start_date),
+            parse_date_column(end_date),
+        )
+
+
+def parse_mysql_url(url):
+    db_url = urllib.parse.urlparse(url)
+    db_vars = dict(
+        host=db_url.hostname,
+        port=db_url.port or 3306,
+        user=db_url.username,
+        password=db_url.password or '',
+        database=db_url.path.rpartition('/')[-1],
+        charset='utf8',
+    )
+    return db_vars
+
+
+class SeenKeys:
+    # Compact set of string keys for deduplicating streams of 100M+ rows.
+    # Keys are stored as 64-bit digests: recent ones in a set, older ones in
+    # a handful of sorted arrays (8 bytes per key) that are merged pairwise
+    # as they grow, so there are only O(log n) arrays to bisect.
+    # Two distinct keys colliding on the digest is astronomically unlikely.
+    def __init__(self, buffer_size=1 << 20):
+        self.buffer_size = buffer_size
+        self._buffer = set()
+        self._runs = []
+
+    @staticmethod
+    def _digest(key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest()
+        return int.from_bytes(digest, 'little')
+
+    def _contains_digest(self, digest):
+        if digest in self._buffer:
+            return True
+
+        for run in self._runs:
+            i = bisect.bisect_left(run, digest)
+            if i < len(run) and run[i] == digest:
+                return True
+        return False
+
+    def __contains__(self, key):
+        return self._contains_digest(self._digest(key))
+
+    def __len__(self):
+        return len(self._buffer) + sum(len(run) for run in self._runs)
+
+    def add(self, key):
+        # Return whether the key was new.
+        digest = self._digest(key)
+        if self._contains_digest(digest):
+            return False
+
+        self._buffer.add(digest)
+        if len(self._buffer) >= self.buffer_size:
+            self._flush()
+        return True
+
+    def _flush(self):
+        run = array.array('Q', sorted(self._buffer))
+        self._buffer = set()
+        while self._runs and len(self._runs[-1]) <= 2 * len(run):
+            run = array.array('Q', heapq.merge(self._runs.pop(), run))
+        self._runs.append(run)